@@ -1,32 +1,44 @@
+import hashlib
 import multiprocessing
 import os
 from time import sleep
-from typing import List, Type, Union
+from typing import List, Type, Union, Tuple
 
 import numpy as np
-from batchgenerators.utilities.file_and_folder_operations import load_json, join, save_json, isfile, maybe_mkdir_p
+from batchgenerators.utilities.file_and_folder_operations import load_json, join, save_json, isfile, maybe_mkdir_p, \
+    load_pickle, write_pickle, subfiles
 
 from nnunetv2.imageio.base_reader_writer import BaseReaderWriter
 from nnunetv2.imageio.reader_writer_registry import determine_reader_writer_from_dataset_json
 from nnunetv2.paths import nnUNet_raw, nnUNet_preprocessed
 from nnunetv2.preprocessing.cropping.cropping import crop_to_nonzero
 from nnunetv2.utilities.dataset_name_id_conversion import maybe_convert_to_dataset_name
+from nnunetv2.utilities.file_hashing import get_file_record
 from nnunetv2.utilities.utils import get_identifiers_from_splitted_dataset_folder, \
     create_lists_from_splitted_dataset_folder
 from tqdm import tqdm
 
+# increase when analyze_case changes, this invalidates all cached case results
+CASE_CACHE_VERSION = 1
+
 
 class DatasetFingerprintExtractor(object):
-    def __init__(self, dataset_name_or_id: Union[str, int], num_processes: int = 8, verbose: bool = False):
+    def __init__(self, dataset_name_or_id: Union[str, int], num_processes: int = 8, verbose: bool = False,
+                 use_case_cache: bool = False):
         """
         extracts the dataset fingerprint used for experiment planning. The dataset fingerprint will be saved as a
         json file in the input_folder
 
         Philosophy here is to do only what we really need. Don't store stuff that we can easily read from somewhere
         else. Don't compute stuff we don't need (except for intensity_statistics_per_channel)
+
+        If use_case_cache is True, the results of analyze_case are kept in nnUNet_preprocessed/DATASET/
+        fingerprint_cache, keyed by the hashes of the image and label files of each case. Extracting the fingerprint
+        again (after adding cases, with --clean, ...) only analyzes cases whose files are new or have changed
         """
         dataset_name = maybe_convert_to_dataset_name(dataset_name_or_id)
         self.verbose = verbose
+        self.use_case_cache = use_case_cache
 
         self.dataset_name = dataset_name
         self.input_folder = join(nnUNet_raw, dataset_name)
@@ -129,31 +141,51 @@ class DatasetFingerprintExtractor(object):
             num_foreground_samples_per_case = int(self.num_foreground_voxels_for_intensitystats //
                                                   len(training_identifiers))
 
-            r = []
-            with multiprocessing.get_context("spawn").Pool(self.num_processes) as p:
-                for ti, tl in zip(training_images_per_case, training_labels_per_case):
-                    r.append(p.starmap_async(DatasetFingerprintExtractor.analyze_case,
-                                             ((ti, tl, reader_writer_class, num_foreground_samples_per_case),)))
-                remaining = list(range(len(training_images_per_case)))
-                # p is pretty nifti. If we kill workers they just respawn but don't do any work.
-                # So we need to store the original pool of workers.
-                workers = [j for j in p._pool]
-                with tqdm(desc=None, total=len(training_images_per_case), disable=self.verbose) as pbar:
-                    while len(remaining) > 0:
-                        all_alive = all([j.is_alive() for j in workers])
-                        if not all_alive:
-                            raise RuntimeError('Some background worker is 6 feet under. Yuck.')
-                        done = [i for i in remaining if r[i].ready()]
-                        for _ in done:
-                            pbar.update()
-                        remaining = [i for i in remaining if i not in done]
-                        sleep(0.1)
+            if self.use_case_cache:
+                cache_keys = self._get_case_cache_keys(
+                    [ti + [tl] for ti, tl in zip(training_images_per_case, training_labels_per_case)],
+                    reader_writer_class)
+                results = [self._load_cached_case(k, num_foreground_samples_per_case) for k in cache_keys]
+            else:
+                results = [None] * len(training_images_per_case)
+            todo = [i for i in range(len(results)) if results[i] is None]
+            if self.use_case_cache:
+                print(f'Fingerprint extraction: {len(results) - len(todo)} of {len(results)} cases were found in '
+                      f'the cache')
+
+            r = {}
+            if len(todo) > 0:
+                with multiprocessing.get_context("spawn").Pool(self.num_processes) as p:
+                    for i in todo:
+                        r[i] = p.starmap_async(DatasetFingerprintExtractor.analyze_case,
+                                               ((training_images_per_case[i], training_labels_per_case[i],
+                                                 reader_writer_class, num_foreground_samples_per_case),))
+                    remaining = list(todo)
+                    # p is pretty nifti. If we kill workers they just respawn but don't do any work.
+                    # So we need to store the original pool of workers.
+                    workers = [j for j in p._pool]
+                    with tqdm(desc=None, total=len(todo), disable=self.verbose) as pbar:
+                        while len(remaining) > 0:
+                            all_alive = all([j.is_alive() for j in workers])
+                            if not all_alive:
+                                raise RuntimeError('Some background worker is 6 feet under. Yuck.')
+                            done = [i for i in remaining if r[i].ready()]
+                            for i in done:
+                                pbar.update()
+                                if self.use_case_cache:
+                                    self._save_cached_case(cache_keys[i], r[i].get()[0],
+                                                           num_foreground_samples_per_case)
+                            remaining = [i for i in remaining if i not in done]
+                            sleep(0.1)
 
             # results = ptqdm(DatasetFingerprintExtractor.analyze_case,
             #                 (training_images_per_case, training_labels_per_case),
             #                 processes=self.num_processes, zipped=True, reader_writer_class=reader_writer_class,
             #                 num_samples=num_foreground_samples_per_case, disable=self.verbose)
-            results = [i.get()[0] for i in r]
+            for i in todo:
+                results[i] = r[i].get()[0]
+            if self.use_case_cache:
+                self._remove_unused_cached_cases(cache_keys)
 
             shapes_after_crop = [r[0] for r in results]
             spacings = [r[1] for r in results]
@@ -195,6 +227,65 @@ class DatasetFingerprintExtractor(object):
             fingerprint = load_json(properties_file)
         return fingerprint
 
+    @property
+    def case_cache_folder(self) -> str:
+        return join(nnUNet_preprocessed, self.dataset_name, 'fingerprint_cache')
+
+    def _get_case_cache_keys(self, files_per_case: List[List[str]], reader_writer_class: Type[BaseReaderWriter]) \
+            -> List[str]:
+        """
+        The key of a case is a hash of the content of its files (and of the fingerprint extractor class and the
+        reader/writer, which determine how they are analyzed). Files are only hashed if their size or modification
+        time differ from the last run (see file_records.json in the cache folder)
+        """
+        maybe_mkdir_p(self.case_cache_folder)
+        records_file = join(self.case_cache_folder, 'file_records.json')
+        previous_records = load_json(records_file) if isfile(records_file) else {}
+        records = {}
+        keys = []
+        for files in files_per_case:
+            hasher = hashlib.sha256(
+                f'{CASE_CACHE_VERSION}{self.__class__.__name__}{reader_writer_class.__name__}'.encode())
+            for f in files:
+                k = os.path.relpath(f, self.input_folder)
+                records[k] = get_file_record(f, previous_records.get(k))
+                hasher.update(records[k]['sha256'].encode())
+            keys.append(hasher.hexdigest())
+        save_json(records, records_file + '.tmp', sort_keys=False)
+        os.replace(records_file + '.tmp', records_file)
+        return keys
+
+    def _load_cached_case(self, key: str, num_samples: int) -> Union[Tuple, None]:
+        """
+        Returns the analyze_case result of the case with this key or None if it is not in the cache. Cached
+        foreground intensities are truncated to num_samples. For the first channel this gives exactly the samples
+        that analyze_case would draw (same seed), for the others statistically equivalent ones. Entries with fewer
+        than num_samples samples (the dataset has shrunk since) are treated as missing
+        """
+        try:
+            entry = load_pickle(join(self.case_cache_folder, key + '.pkl'))
+        except (FileNotFoundError, EOFError):
+            return None
+        if entry['num_samples'] < num_samples:
+            return None
+        shape_after_crop, spacing, foreground_intensities_per_channel, foreground_intensity_stats_per_channel, \
+            relative_size_after_cropping = entry['result']
+        foreground_intensities_per_channel = [i[:num_samples] for i in foreground_intensities_per_channel]
+        return shape_after_crop, spacing, foreground_intensities_per_channel, foreground_intensity_stats_per_channel, \
+            relative_size_after_cropping
+
+    def _save_cached_case(self, key: str, result: Tuple, num_samples: int) -> None:
+        filename = join(self.case_cache_folder, key + '.pkl')
+        # write and rename so that an interrupted run cannot leave broken entries behind
+        write_pickle({'result': result, 'num_samples': num_samples}, filename + '.tmp')
+        os.replace(filename + '.tmp', filename)
+
+    def _remove_unused_cached_cases(self, keys: List[str]) -> None:
+        keys = set(keys)
+        for f in subfiles(self.case_cache_folder, suffix='.pkl', join=False):
+            if f[:-4] not in keys:
+                os.remove(join(self.case_cache_folder, f))
+
 
 if __name__ == '__main__':
     dfe = DatasetFingerprintExtractor(2, 8)
@@ -1,3 +1,4 @@
+import os
 import shutil
 from typing import List, Type, Optional, Tuple, Union
 
@@ -18,9 +19,11 @@ def extract_fingerprint_dataset(dataset_id: int,
                                 fingerprint_extractor_class: Type[
                                     DatasetFingerprintExtractor] = DatasetFingerprintExtractor,
                                 num_processes: int = default_num_processes, check_dataset_integrity: bool = False,
-                                clean: bool = True, verbose: bool = True):
+                                clean: bool = True, verbose: bool = True, use_case_cache: bool = False):
     """
     Returns the fingerprint as a dictionary (additionally to saving it)
+
+    use_case_cache: see DatasetFingerprintExtractor
     """
     dataset_name = convert_id_to_dataset_name(dataset_id)
     print(dataset_name)
@@ -28,13 +31,13 @@ def extract_fingerprint_dataset(dataset_id: int,
     if check_dataset_integrity:
         verify_dataset_integrity(join(nnUNet_raw, dataset_name), num_processes)
 
-    fpe = fingerprint_extractor_class(dataset_id, num_processes, verbose=verbose)
+    fpe = fingerprint_extractor_class(dataset_id, num_processes, verbose=verbose, use_case_cache=use_case_cache)
     return fpe.run(overwrite_existing=clean)
 
 
 def extract_fingerprints(dataset_ids: List[int], fingerprint_extractor_class_name: str = 'DatasetFingerprintExtractor',
                          num_processes: int = default_num_processes, check_dataset_integrity: bool = False,
-                         clean: bool = True, verbose: bool = True):
+                         clean: bool = True, verbose: bool = True, use_case_cache: bool = False):
     """
     clean = False will not actually run this. This is just a switch for use with nnUNetv2_plan_and_preprocess where
     we don't want to rerun fingerprint extraction every time.
@@ -44,7 +47,7 @@ def extract_fingerprints(dataset_ids: List[int], fingerprint_extractor_class_nam
                                                               current_module="nnunetv2.experiment_planning")
     for d in dataset_ids:
         extract_fingerprint_dataset(d, fingerprint_extractor_class, num_processes, check_dataset_integrity, clean,
-                                    verbose)
+                                    verbose, use_case_cache)
 
 
 def plan_experiment_dataset(dataset_id: int,
@@ -87,7 +90,7 @@ def preprocess_dataset(dataset_id: int,
                        plans_identifier: str = 'nnUNetPlans',
                        configurations: Union[Tuple[str], List[str]] = ('2d', '3d_fullres', '3d_lowres'),
                        num_processes: Union[int, Tuple[int, ...], List[int]] = (8, 4, 8),
-                       verbose: bool = False) -> None:
+                       verbose: bool = False, chunked_storage: bool = False, incremental: bool = False) -> None:
     if not isinstance(num_processes, list):
         num_processes = list(num_processes)
     if len(num_processes) == 1:
@@ -112,8 +115,14 @@ def preprocess_dataset(dataset_id: int,
             continue
         configuration_manager = plans_manager.get_configuration(c)
         preprocessor = configuration_manager.preprocessor_class(verbose=verbose)
-        preprocessor.run(dataset_id, c, plans_identifier, num_processes=n)
+        preprocessor.run(dataset_id, c, plans_identifier, num_processes=n, chunked_storage=chunked_storage,
+                         incremental=incremental)
     maybe_mkdir_p(join(nnUNet_preprocessed, dataset_name, 'gt_segmentations'))
+    if incremental:
+        # remove the segmentations of cases that are no longer in the dataset
+        labels = set(subfiles(join(nnUNet_raw, dataset_name, 'labelsTr'), join=False))
+        [os.remove(i) for i in subfiles(join(nnUNet_preprocessed, dataset_name, 'gt_segmentations'))
+         if os.path.basename(i) not in labels]
     [shutil.copy(i, join(join(nnUNet_preprocessed, dataset_name, 'gt_segmentations'))) for i in
      subfiles(join(nnUNet_raw, dataset_name, 'labelsTr'))]
 
@@ -122,6 +131,6 @@ def preprocess(dataset_ids: List[int],
                plans_identifier: str = 'nnUNetPlans',
                configurations: Union[Tuple[str], List[str]] = ('2d', '3d_fullres', '3d_lowres'),
                num_processes: Union[int, Tuple[int, ...], List[int]] = (8, 4, 8),
-               verbose: bool = False):
+               verbose: bool = False, chunked_storage: bool = False, incremental: bool = False):
     for d in dataset_ids:
-        preprocess_dataset(d, plans_identifier, configurations, num_processes, verbose)
+        preprocess_dataset(d, plans_identifier, configurations, num_processes, verbose, chunked_storage, incremental)
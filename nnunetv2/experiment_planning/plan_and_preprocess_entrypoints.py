@@ -20,11 +20,17 @@ def extract_fingerprint_entry():
     parser.add_argument("--clean", required=False, default=False, action="store_true",
                         help='[OPTIONAL] Set this flag to overwrite existing fingerprints. If this flag is not set and a '
                              'fingerprint already exists, the fingerprint extractor will not run.')
+    parser.add_argument('--fingerprint_cache', required=False, action='store_true',
+                        help='[OPTIONAL] Keep the analysis of each case in nnUNet_preprocessed/DATASET/'
+                             'fingerprint_cache. Rerunning fingerprint extraction with --clean and this flag only '
+                             'analyzes cases whose images/labels are new or have changed. Without this flag the cache '
+                             'is neither read nor written. Delete that folder if you modified analyze_case.')
     parser.add_argument('--verbose', required=False, action='store_true',
                         help='Set this to print a lot of stuff. Useful for debugging. Will disable progrewss bar! '
                              'Recommended for cluster environments')
     args, unrecognized_args = parser.parse_known_args()
-    extract_fingerprints(args.d, args.fpe, args.np, args.verify_dataset_integrity, args.clean, args.verbose)
+    extract_fingerprints(args.d, args.fpe, args.np, args.verify_dataset_integrity, args.clean, args.verbose,
+                         args.fingerprint_cache)
 
 
 def plan_experiment_entry():
@@ -93,6 +99,15 @@ def preprocess_entry():
     parser.add_argument('--verbose', required=False, action='store_true',
                         help='Set this to print a lot of stuff. Useful for debugging. Will disable progrewss bar! '
                              'Recommended for cluster environments')
+    parser.add_argument('--chunked_storage', required=False, action='store_true',
+                        help='[OPTIONAL] Save the preprocessed cases as chunked, zstd compressed blosc2 arrays (.b2nd) '
+                             'instead of npz. Training reads patches directly from these files, so the dataset does '
+                             'not have to be unpacked (no additional disk space, no waiting before the first epoch)')
+    parser.add_argument('--incremental', required=False, action='store_true',
+                        help='[OPTIONAL] Only preprocess cases that are new or whose images/labels have changed since '
+                             'the last (incremental) preprocessing and delete the preprocessed files of cases that '
+                             'were removed from the dataset. If the preprocessing relevant parts of the plans have '
+                             'changed, all cases are preprocessed again')
     args, unrecognized_args = parser.parse_known_args()
     if args.np is None:
         default_np = {
@@ -103,7 +118,8 @@ def preprocess_entry():
         np = {default_np[c] if c in default_np.keys() else 4 for c in args.c}
     else:
         np = args.np
-    preprocess(args.d, args.plans_name, configurations=args.c, num_processes=np, verbose=args.verbose)
+    preprocess(args.d, args.plans_name, configurations=args.c, num_processes=np, verbose=args.verbose,
+               chunked_storage=args.chunked_storage, incremental=args.incremental)
 
 
 def plan_and_preprocess_entry():
@@ -127,6 +143,11 @@ def plan_and_preprocess_entry():
                         help='[OPTIONAL] Set this flag to overwrite existing fingerprints. If this flag is not set and a '
                              'fingerprint already exists, the fingerprint extractor will not run. REQUIRED IF YOU '
                              'CHANGE THE DATASET FINGERPRINT EXTRACTOR OR MAKE CHANGES TO THE DATASET!')
+    parser.add_argument('--fingerprint_cache', required=False, action='store_true',
+                        help='[OPTIONAL] Keep the analysis of each case in nnUNet_preprocessed/DATASET/'
+                             'fingerprint_cache. Rerunning fingerprint extraction with --clean and this flag only '
+                             'analyzes cases whose images/labels are new or have changed. Without this flag the cache '
+                             'is neither read nor written. Delete that folder if you modified analyze_case.')
     parser.add_argument('-pl', type=str, default='ExperimentPlanner', required=False,
                         help='[OPTIONAL] Name of the Experiment Planner class that should be used. Default is '
                              '\'ExperimentPlanner\'. Note: There is no longer a distinction between 2d and 3d planner. '
@@ -175,11 +196,21 @@ def plan_and_preprocess_entry():
     parser.add_argument('--verbose', required=False, action='store_true',
                         help='Set this to print a lot of stuff. Useful for debugging. Will disable progrewss bar! '
                              'Recommended for cluster environments')
+    parser.add_argument('--chunked_storage', required=False, action='store_true',
+                        help='[OPTIONAL] Save the preprocessed cases as chunked, zstd compressed blosc2 arrays (.b2nd) '
+                             'instead of npz. Training reads patches directly from these files, so the dataset does '
+                             'not have to be unpacked (no additional disk space, no waiting before the first epoch)')
+    parser.add_argument('--incremental', required=False, action='store_true',
+                        help='[OPTIONAL] Only preprocess cases that are new or whose images/labels have changed since '
+                             'the last (incremental) preprocessing and delete the preprocessed files of cases that '
+                             'were removed from the dataset. If the preprocessing relevant parts of the plans have '
+                             'changed, all cases are preprocessed again')
     args = parser.parse_args()
 
     # fingerprint extraction
     print("Fingerprint extraction...")
-    extract_fingerprints(args.d, args.fpe, args.npfp, args.verify_dataset_integrity, args.clean, args.verbose)
+    extract_fingerprints(args.d, args.fpe, args.npfp, args.verify_dataset_integrity, args.clean, args.verbose,
+                         args.fingerprint_cache)
 
     # experiment planning
     print('Experiment planning...')
@@ -194,7 +225,7 @@ def plan_and_preprocess_entry():
     # preprocessing
     if not args.no_pp:
         print('Preprocessing...')
-        preprocess(args.d, args.overwrite_plans_name, args.c, np, args.verbose)
+        preprocess(args.d, args.overwrite_plans_name, args.c, np, args.verbose, args.chunked_storage, args.incremental)
 
 
 if __name__ == '__main__':
@@ -1,4 +1,5 @@
 import multiprocessing
+import os
 import queue
 from torch.multiprocessing import Event, Process, Queue, Manager
 
@@ -9,9 +10,13 @@ import numpy as np
 import torch
 from batchgenerators.dataloading.data_loader import DataLoader
 
+from nnunetv2.inference.preprocessing_cache import PreprocessingCache
+from nnunetv2.inference.shared_memory import array_to_shared_file, release_shared_file
+from nnunetv2.inference.work_queue import FileLockWorkQueue
 from nnunetv2.preprocessing.preprocessors.default_preprocessor import DefaultPreprocessor
 from nnunetv2.utilities.label_handling.label_handling import convert_labelmap_to_one_hot
 from nnunetv2.utilities.plans_handling.plans_handler import PlansManager, ConfigurationManager
+from nnunetv2.utilities.profiling import profile_span, set_profiled_case
 
 
 def preprocess_fromfiles_save_to_queue(list_of_lists: List[List[str]],
@@ -23,40 +28,107 @@ def preprocess_fromfiles_save_to_queue(list_of_lists: List[List[str]],
                                        target_queue: Queue,
                                        done_event: Event,
                                        abort_event: Event,
-                                       verbose: bool = False):
+                                       verbose: bool = False,
+                                       shared_memory_folder: Union[str, None] = None,
+                                       work_queue: Union[FileLockWorkQueue, None] = None,
+                                       preprocessing_cache: Union[PreprocessingCache, None] = None,
+                                       foreground_mask_threshold: Union[float, None] = None):
     try:
         label_manager = plans_manager.get_label_manager(dataset_json)
-        preprocessor = configuration_manager.preprocessor_class(verbose=verbose)
-        for idx in range(len(list_of_lists)):
-            data, seg, data_properites = preprocessor.run_case(list_of_lists[idx],
-                                                               list_of_segs_from_prev_stage_files[
-                                                                   idx] if list_of_segs_from_prev_stage_files is not None else None,
-                                                               plans_manager,
-                                                               configuration_manager,
-                                                               dataset_json)
+        preprocessor = configuration_manager.preprocessor_class(verbose=verbose,
+                                                                foreground_mask_threshold=foreground_mask_threshold)
+        # with a work queue, cases are claimed one at a time (only when we are ready to process them)
+        indices = range(len(list_of_lists)) if work_queue is None else iter(work_queue.claim_next, None)
+        for idx in indices:
+            set_profiled_case(os.path.basename(output_filenames_truncated[idx]) if output_filenames_truncated is not None
+                              else None)
+            run_case_args = (list_of_lists[idx],
+                             list_of_segs_from_prev_stage_files[
+                                 idx] if list_of_segs_from_prev_stage_files is not None else None,
+                             plans_manager,
+                             configuration_manager,
+                             dataset_json)
+            if preprocessing_cache is None:
+                data, seg, data_properites = preprocessor.run_case(*run_case_args)
+            else:
+                data, seg, data_properites = preprocessing_cache.run_case(preprocessor, *run_case_args)
             if list_of_segs_from_prev_stage_files is not None and list_of_segs_from_prev_stage_files[idx] is not None:
                 seg_onehot = convert_labelmap_to_one_hot(seg[0], label_manager.foreground_labels, data.dtype)
                 data = np.vstack((data, seg_onehot))
 
             data = torch.from_numpy(data).contiguous().float()
+            if shared_memory_folder is not None:
+                # only the filename goes through the queue, see shared_memory.py
+                data = array_to_shared_file(data, shared_memory_folder)
 
             item = {'data': data, 'data_properites': data_properites,
                     'ofile': output_filenames_truncated[idx] if output_filenames_truncated is not None else None}
-            success = False
-            while not success:
-                try:
-                    if abort_event.is_set():
-                        return
-                    target_queue.put(item, timeout=0.01)
-                    success = True
-                except queue.Full:
-                    pass
+            # time spent here means the main process is not consuming fast enough
+            with profile_span('queue_put_wait'):
+                success = False
+                while not success:
+                    try:
+                        if abort_event.is_set():
+                            if isinstance(item['data'], str):
+                                release_shared_file(item['data'])
+                            return
+                        target_queue.put(item, timeout=0.01)
+                        success = True
+                    except queue.Full:
+                        pass
+        set_profiled_case(None)
         done_event.set()
     except Exception as e:
         abort_event.set()
         raise e
 
 
+def _check_workers_alive(processes: List[Process], done_events: List[Event], abort_event: Event) -> None:
+    all_ok = all(
+        [i.is_alive() or j.is_set() for i, j in zip(processes, done_events)]) and not abort_event.is_set()
+    if not all_ok:
+        raise RuntimeError('Background workers died. Look for the error message further up! If there is '
+                           'none then your RAM was full and the worker was killed by the OS. Use fewer '
+                           'workers or get more RAM in that case!')
+
+
+def _consume_round_robin(target_queues: List[Queue], done_events: List[Event], processes: List[Process],
+                         abort_event: Event):
+    num_processes = len(target_queues)
+    worker_ctr = 0
+    while (not done_events[worker_ctr].is_set()) or (not target_queues[worker_ctr].empty()):
+        if not target_queues[worker_ctr].empty():
+            item = target_queues[worker_ctr].get()
+            worker_ctr = (worker_ctr + 1) % num_processes
+        else:
+            _check_workers_alive(processes, done_events, abort_event)
+            sleep(0.01)
+            continue
+        yield item
+
+
+def _consume_when_ready(target_queues: List[Queue], done_events: List[Event], processes: List[Process],
+                        abort_event: Event):
+    num_processes = len(target_queues)
+    worker_ctr = 0
+    while True:
+        item = None
+        for _ in range(num_processes):
+            q = target_queues[worker_ctr]
+            worker_ctr = (worker_ctr + 1) % num_processes
+            if not q.empty():
+                item = q.get()
+                break
+        if item is None:
+            # done_events must be checked before the queues: a worker sets its event only after its last put
+            if all([i.is_set() for i in done_events]) and all([q.empty() for q in target_queues]):
+                break
+            _check_workers_alive(processes, done_events, abort_event)
+            sleep(0.01)
+            continue
+        yield item
+
+
 def preprocessing_iterator_fromfiles(list_of_lists: List[List[str]],
                                      list_of_segs_from_prev_stage_files: Union[None, List[str]],
                                      output_filenames_truncated: Union[None, List[str]],
@@ -65,7 +137,23 @@ def preprocessing_iterator_fromfiles(list_of_lists: List[List[str]],
                                      configuration_manager: ConfigurationManager,
                                      num_processes: int,
                                      pin_memory: bool = False,
-                                     verbose: bool = False):
+                                     verbose: bool = False,
+                                     shared_memory_folder: Union[str, None] = None,
+                                     work_queue: Union[FileLockWorkQueue, None] = None,
+                                     preprocessing_cache: Union[PreprocessingCache, None] = None,
+                                     foreground_mask_threshold: Union[float, None] = None):
+    """
+    if shared_memory_folder is given, 'data' of the returned items is the filename of a .npy file in that folder
+    (see shared_memory.py) instead of a tensor
+
+    if preprocessing_cache is given, preprocessed cases are taken from/added to it (see PreprocessingCache)
+
+    if foreground_mask_threshold is given, the properties contain a foreground mask for skipping tiles (see
+    DefaultPreprocessor.foreground_mask_threshold)
+
+    if work_queue is given (its case_identifiers must match list_of_lists), each worker gets all cases and claims them
+    dynamically instead of processing a fixed subset
+    """
     context = multiprocessing.get_context('spawn')
     manager = Manager()
     num_processes = min(len(list_of_lists), num_processes)
@@ -77,40 +165,41 @@ def preprocessing_iterator_fromfiles(list_of_lists: List[List[str]],
     for i in range(num_processes):
         event = manager.Event()
         queue = Manager().Queue(maxsize=1)
+        # with a work queue all workers see all cases
+        worker_slice = slice(i, None, num_processes) if work_queue is None else slice(None)
         pr = context.Process(target=preprocess_fromfiles_save_to_queue,
                      args=(
-                         list_of_lists[i::num_processes],
+                         list_of_lists[worker_slice],
                          list_of_segs_from_prev_stage_files[
-                         i::num_processes] if list_of_segs_from_prev_stage_files is not None else None,
+                         worker_slice] if list_of_segs_from_prev_stage_files is not None else None,
                          output_filenames_truncated[
-                         i::num_processes] if output_filenames_truncated is not None else None,
+                         worker_slice] if output_filenames_truncated is not None else None,
                          plans_manager,
                          dataset_json,
                          configuration_manager,
                          queue,
                          event,
                          abort_event,
-                         verbose
+                         verbose,
+                         shared_memory_folder,
+                         work_queue,
+                         preprocessing_cache,
+                         foreground_mask_threshold
                      ), daemon=True)
         pr.start()
         target_queues.append(queue)
         done_events.append(event)
         processes.append(pr)
 
-    worker_ctr = 0
-    while (not done_events[worker_ctr].is_set()) or (not target_queues[worker_ctr].empty()):
-        if not target_queues[worker_ctr].empty():
-            item = target_queues[worker_ctr].get()
-            worker_ctr = (worker_ctr + 1) % num_processes
-        else:
-            all_ok = all(
-                [i.is_alive() or j.is_set() for i, j in zip(processes, done_events)]) and not abort_event.is_set()
-            if not all_ok:
-                raise RuntimeError('Background workers died. Look for the error message further up! If there is '
-                                   'none then your RAM was full and the worker was killed by the OS. Use fewer '
-                                   'workers or get more RAM in that case!')
-            sleep(0.01)
-            continue
+    if work_queue is None:
+        # the workers process interleaved subsets of the cases. Strict round robin returns them in the order of
+        # list_of_lists, which callers that collect the results instead of writing them to files rely on
+        items = _consume_round_robin(target_queues, done_events, processes, abort_event)
+    else:
+        # workers claim cases dynamically and yield different numbers of them. Every output goes to its own file, so
+        # the order does not matter and we take whatever is ready until every worker is done and every queue is empty
+        items = _consume_when_ready(target_queues, done_events, processes, abort_event)
+    for item in items:
         if pin_memory:
             [i.pin_memory() for i in item.values() if isinstance(i, torch.Tensor)]
         yield item
@@ -124,9 +213,11 @@ class PreprocessAdapter(DataLoader):
                  plans_manager: PlansManager,
                  dataset_json: dict,
                  configuration_manager: ConfigurationManager,
-                 num_threads_in_multithreaded: int = 1):
+                 num_threads_in_multithreaded: int = 1,
+                 preprocessing_cache: Union[PreprocessingCache, None] = None):
         self.preprocessor, self.plans_manager, self.configuration_manager, self.dataset_json = \
             preprocessor, plans_manager, configuration_manager, dataset_json
+        self.preprocessing_cache = preprocessing_cache
 
         self.label_manager = plans_manager.get_label_manager(dataset_json)
 
@@ -150,9 +241,15 @@ class PreprocessAdapter(DataLoader):
         # if we have a segmentation from the previous stage we have to process it together with the images so that we
         # can crop it appropriately (if needed). Otherwise it would just be resized to the shape of the data after
         # preprocessing and then there might be misalignments
-        data, seg, data_properites = self.preprocessor.run_case(files, seg_prev_stage, self.plans_manager,
-                                                                self.configuration_manager,
-                                                                self.dataset_json)
+        if self.preprocessing_cache is None:
+            data, seg, data_properites = self.preprocessor.run_case(files, seg_prev_stage, self.plans_manager,
+                                                                    self.configuration_manager,
+                                                                    self.dataset_json)
+        else:
+            data, seg, data_properites = self.preprocessing_cache.run_case(self.preprocessor, files, seg_prev_stage,
+                                                                           self.plans_manager,
+                                                                           self.configuration_manager,
+                                                                           self.dataset_json)
         if seg_prev_stage is not None:
             seg_onehot = convert_labelmap_to_one_hot(seg[0], self.label_manager.foreground_labels, data.dtype)
             data = np.vstack((data, seg_onehot))
@@ -168,10 +265,14 @@ class PreprocessAdapterFromNpy(DataLoader):
                  list_of_image_properties: List[dict],
                  truncated_ofnames: Union[List[str], None],
                  plans_manager: PlansManager, dataset_json: dict, configuration_manager: ConfigurationManager,
-                 num_threads_in_multithreaded: int = 1, verbose: bool = False):
-        preprocessor = configuration_manager.preprocessor_class(verbose=verbose)
+                 num_threads_in_multithreaded: int = 1, verbose: bool = False,
+                 preprocessing_cache: Union[PreprocessingCache, None] = None,
+                 foreground_mask_threshold: Union[float, None] = None):
+        preprocessor = configuration_manager.preprocessor_class(verbose=verbose,
+                                                                foreground_mask_threshold=foreground_mask_threshold)
         self.preprocessor, self.plans_manager, self.configuration_manager, self.dataset_json, self.truncated_ofnames = \
             preprocessor, plans_manager, configuration_manager, dataset_json, truncated_ofnames
+        self.preprocessing_cache = preprocessing_cache
 
         self.label_manager = plans_manager.get_label_manager(dataset_json)
 
@@ -197,10 +298,16 @@ class PreprocessAdapterFromNpy(DataLoader):
         # if we have a segmentation from the previous stage we have to process it together with the images so that we
         # can crop it appropriately (if needed). Otherwise it would just be resized to the shape of the data after
         # preprocessing and then there might be misalignments
-        data, seg = self.preprocessor.run_case_npy(image, seg_prev_stage, props,
-                                                   self.plans_manager,
-                                                   self.configuration_manager,
-                                                   self.dataset_json)
+        if self.preprocessing_cache is None:
+            data, seg = self.preprocessor.run_case_npy(image, seg_prev_stage, props,
+                                                       self.plans_manager,
+                                                       self.configuration_manager,
+                                                       self.dataset_json)
+        else:
+            data, seg = self.preprocessing_cache.run_case_npy(self.preprocessor, image, seg_prev_stage, props,
+                                                              self.plans_manager,
+                                                              self.configuration_manager,
+                                                              self.dataset_json)
         if seg_prev_stage is not None:
             seg_onehot = convert_labelmap_to_one_hot(seg[0], self.label_manager.foreground_labels, data.dtype)
             data = np.vstack((data, seg_onehot))
@@ -220,35 +327,53 @@ def preprocess_fromnpy_save_to_queue(list_of_images: List[np.ndarray],
                                      target_queue: Queue,
                                      done_event: Event,
                                      abort_event: Event,
-                                     verbose: bool = False):
+                                     verbose: bool = False,
+                                     shared_memory_folder: Union[str, None] = None,
+                                     preprocessing_cache: Union[PreprocessingCache, None] = None,
+                                     foreground_mask_threshold: Union[float, None] = None):
     try:
         label_manager = plans_manager.get_label_manager(dataset_json)
-        preprocessor = configuration_manager.preprocessor_class(verbose=verbose)
+        preprocessor = configuration_manager.preprocessor_class(verbose=verbose,
+                                                                foreground_mask_threshold=foreground_mask_threshold)
         for idx in range(len(list_of_images)):
-            data, seg = preprocessor.run_case_npy(list_of_images[idx],
-                                                  list_of_segs_from_prev_stage[
-                                                      idx] if list_of_segs_from_prev_stage is not None else None,
-                                                  list_of_image_properties[idx],
-                                                  plans_manager,
-                                                  configuration_manager,
-                                                  dataset_json)
+            set_profiled_case(os.path.basename(truncated_ofnames[idx]) if truncated_ofnames is not None and
+                              truncated_ofnames[idx] is not None else None)
+            run_case_args = (list_of_images[idx],
+                             list_of_segs_from_prev_stage[
+                                 idx] if list_of_segs_from_prev_stage is not None else None,
+                             list_of_image_properties[idx],
+                             plans_manager,
+                             configuration_manager,
+                             dataset_json)
+            if preprocessing_cache is None:
+                data, seg = preprocessor.run_case_npy(*run_case_args)
+            else:
+                data, seg = preprocessing_cache.run_case_npy(preprocessor, *run_case_args)
             if list_of_segs_from_prev_stage is not None and list_of_segs_from_prev_stage[idx] is not None:
                 seg_onehot = convert_labelmap_to_one_hot(seg[0], label_manager.foreground_labels, data.dtype)
                 data = np.vstack((data, seg_onehot))
 
             data = torch.from_numpy(data).contiguous().float()
+            if shared_memory_folder is not None:
+                # only the filename goes through the queue, see shared_memory.py
+                data = array_to_shared_file(data, shared_memory_folder)
 
             item = {'data': data, 'data_properites': list_of_image_properties[idx],
                     'ofile': truncated_ofnames[idx] if truncated_ofnames is not None else None}
-            success = False
-            while not success:
-                try:
-                    if abort_event.is_set():
-                        return
-                    target_queue.put(item, timeout=0.01)
-                    success = True
-                except queue.Full:
-                    pass
+            # time spent here means the main process is not consuming fast enough
+            with profile_span('queue_put_wait'):
+                success = False
+                while not success:
+                    try:
+                        if abort_event.is_set():
+                            if isinstance(item['data'], str):
+                                release_shared_file(item['data'])
+                            return
+                        target_queue.put(item, timeout=0.01)
+                        success = True
+                    except queue.Full:
+                        pass
+        set_profiled_case(None)
         done_event.set()
     except Exception as e:
         abort_event.set()
@@ -264,7 +389,19 @@ def preprocessing_iterator_fromnpy(list_of_images: List[np.ndarray],
                                    configuration_manager: ConfigurationManager,
                                    num_processes: int,
                                    pin_memory: bool = False,
-                                   verbose: bool = False):
+                                   verbose: bool = False,
+                                   shared_memory_folder: Union[str, None] = None,
+                                   preprocessing_cache: Union[PreprocessingCache, None] = None,
+                                   foreground_mask_threshold: Union[float, None] = None):
+    """
+    if shared_memory_folder is given, 'data' of the returned items is the filename of a .npy file in that folder
+    (see shared_memory.py) instead of a tensor
+
+    if preprocessing_cache is given, preprocessed cases are taken from/added to it (see PreprocessingCache)
+
+    if foreground_mask_threshold is given, the properties contain a foreground mask for skipping tiles (see
+    DefaultPreprocessor.foreground_mask_threshold)
+    """
     context = multiprocessing.get_context('spawn')
     manager = Manager()
     num_processes = min(len(list_of_images), num_processes)
@@ -289,7 +426,10 @@ def preprocessing_iterator_fromnpy(list_of_images: List[np.ndarray],
                          queue,
                          event,
                          abort_event,
-                         verbose
+                         verbose,
+                         shared_memory_folder,
+                         preprocessing_cache,
+                         foreground_mask_threshold
                      ), daemon=True)
         pr.start()
         done_events.append(event)
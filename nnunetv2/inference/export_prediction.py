@@ -1,6 +1,6 @@
 import os
 from copy import deepcopy
-from typing import Union, List
+from typing import Union, List, Tuple
 
 import numpy as np
 import torch
@@ -8,48 +8,63 @@ from acvl_utils.cropping_and_padding.bounding_boxes import bounding_box_to_slice
 from batchgenerators.utilities.file_and_folder_operations import load_json, isfile, save_pickle
 
 from nnunetv2.configuration import default_num_processes
+from nnunetv2.inference.shared_memory import open_shared_file, release_shared_file
 from nnunetv2.utilities.label_handling.label_handling import LabelManager
 from nnunetv2.utilities.plans_handling.plans_handler import PlansManager, ConfigurationManager
+from nnunetv2.utilities.profiling import profile_span, set_profiled_case
 
 
-def convert_predicted_logits_to_segmentation_with_correct_shape(predicted_logits: Union[torch.Tensor, np.ndarray],
+def convert_predicted_logits_to_segmentation_with_correct_shape(predicted_logits: Union[torch.Tensor, np.ndarray, str],
                                                                 plans_manager: PlansManager,
                                                                 configuration_manager: ConfigurationManager,
                                                                 label_manager: LabelManager,
                                                                 properties_dict: dict,
                                                                 return_probabilities: bool = False,
-                                                                num_threads_torch: int = default_num_processes):
+                                                                num_threads_torch: int = default_num_processes,
+                                                                class_chunk_size: Union[int, None] = None):
+    """
+    predicted_logits can also be the filename of a .npy file (memory mapped logits, see
+    nnUNetPredictor.logits_ram_budget_gb and shared_memory.py). It will be memory mapped and deleted once we are done
+
+    If class_chunk_size is given and we don't need to return probabilities, only class_chunk_size channels are
+    resampled at a time and the segmentation is built from a running max/argmax. This keeps peak memory
+    independent of the number of classes
+    """
     old_threads = torch.get_num_threads()
     torch.set_num_threads(num_threads_torch)
 
+    logits_file = None
+    if isinstance(predicted_logits, str):
+        logits_file = predicted_logits
+        predicted_logits = open_shared_file(logits_file)
+
     # resample to original shape
     current_spacing = configuration_manager.spacing if \
         len(configuration_manager.spacing) == \
         len(properties_dict['shape_after_cropping_and_before_resampling']) else \
         [properties_dict['spacing'][0], *configuration_manager.spacing]
-    predicted_logits = configuration_manager.resampling_fn_probabilities(predicted_logits,
-                                            properties_dict['shape_after_cropping_and_before_resampling'],
-                                            current_spacing,
-                                            properties_dict['spacing'])
-    # return value of resampling_fn_probabilities can be ndarray or Tensor but that doesnt matter because
-    # apply_inference_nonlin will covnert to torch
-    predicted_probabilities = label_manager.apply_inference_nonlin(predicted_logits)
-    del predicted_logits
-    segmentation = label_manager.convert_probabilities_to_segmentation(predicted_probabilities)
-
-    # segmentation may be torch.Tensor but we continue with numpy
-    if isinstance(segmentation, torch.Tensor):
-        segmentation = segmentation.cpu().numpy()
+    with profile_span('export_resample'):
+        if class_chunk_size is not None and not return_probabilities:
+            segmentation = resample_and_convert_logits_to_segmentation_chunked(
+                predicted_logits, properties_dict['shape_after_cropping_and_before_resampling'], current_spacing,
+                properties_dict['spacing'], configuration_manager, label_manager, class_chunk_size)
+            del predicted_logits
+        else:
+            predicted_logits = configuration_manager.resampling_fn_probabilities(predicted_logits,
+                                                    properties_dict['shape_after_cropping_and_before_resampling'],
+                                                    current_spacing,
+                                                    properties_dict['spacing'])
+            # return value of resampling_fn_probabilities can be ndarray or Tensor but that doesnt matter because
+            # apply_inference_nonlin will covnert to torch
+            predicted_probabilities = label_manager.apply_inference_nonlin(predicted_logits)
+            del predicted_logits
+            segmentation = label_manager.convert_probabilities_to_segmentation(predicted_probabilities)
+    if logits_file is not None:
+        release_shared_file(logits_file)
 
-    # put segmentation in bbox (revert cropping)
-    segmentation_reverted_cropping = np.zeros(properties_dict['shape_before_cropping'],
-                                              dtype=np.uint8 if len(label_manager.foreground_labels) < 255 else np.uint16)
-    slicer = bounding_box_to_slice(properties_dict['bbox_used_for_cropping'])
-    segmentation_reverted_cropping[slicer] = segmentation
+    segmentation_reverted_cropping = revert_cropping_and_transpose_segmentation(segmentation, plans_manager,
+                                                                                label_manager, properties_dict)
     del segmentation
-
-    # revert transpose
-    segmentation_reverted_cropping = segmentation_reverted_cropping.transpose(plans_manager.transpose_backward)
     if return_probabilities:
         # revert cropping
         predicted_probabilities = label_manager.revert_cropping_on_probabilities(predicted_probabilities,
@@ -68,42 +83,139 @@ def convert_predicted_logits_to_segmentation_with_correct_shape(predicted_logits
         return segmentation_reverted_cropping
 
 
-def export_prediction_from_logits(predicted_array_or_file: Union[np.ndarray, torch.Tensor], properties_dict: dict,
+def revert_cropping_and_transpose_segmentation(segmentation: Union[torch.Tensor, np.ndarray],
+                                                plans_manager: PlansManager, label_manager: LabelManager,
+                                                properties_dict: dict) -> np.ndarray:
+    """
+    segmentation must already be resampled to properties_dict['shape_after_cropping_and_before_resampling']
+    """
+    # segmentation may be torch.Tensor but we continue with numpy
+    if isinstance(segmentation, torch.Tensor):
+        segmentation = segmentation.cpu().numpy()
+
+    # put segmentation in bbox (revert cropping)
+    segmentation_reverted_cropping = np.zeros(properties_dict['shape_before_cropping'],
+                                              dtype=np.uint8 if len(label_manager.foreground_labels) < 255 else np.uint16)
+    slicer = bounding_box_to_slice(properties_dict['bbox_used_for_cropping'])
+    segmentation_reverted_cropping[slicer] = segmentation
+    del segmentation
+
+    # revert transpose
+    return segmentation_reverted_cropping.transpose(plans_manager.transpose_backward)
+
+
+def get_class_chunk_size(target_shape: Union[List[int], Tuple[int, ...]], ram_budget_gb: float) -> int:
+    """
+    number of logit channels that can be resampled to target_shape at a time within ram_budget_gb. Assumes 8 bytes per
+    voxel and channel (the resampled float32 channels plus an intermediate copy)
+    """
+    return max(1, int(ram_budget_gb * 1e9 // (np.prod(target_shape, dtype=np.int64) * 8)))
+
+
+def resample_and_convert_logits_to_segmentation_chunked(predicted_logits: Union[torch.Tensor, np.ndarray],
+                                                        target_shape: Union[List[int], Tuple[int, ...]],
+                                                        current_spacing: Union[List[float], Tuple[float, ...]],
+                                                        target_spacing: Union[List[float], Tuple[float, ...]],
+                                                        configuration_manager: ConfigurationManager,
+                                                        label_manager: LabelManager,
+                                                        class_chunk_size: int) -> np.ndarray:
+    """
+    Resamples class_chunk_size logit channels at a time and never holds all resampled channels in memory.
+    Softmax is monotonic, so argmax over the logits gives the same segmentation as argmax over the probabilities.
+    For regions, sigmoid(x) > 0.5 is the same as x > 0. Resampling is done per channel anyway, so chunking does not
+    change the result.
+    """
+    assert class_chunk_size > 0
+    if label_manager.has_regions:
+        assert label_manager.regions_class_order is not None, 'if region-based training is requested then you ' \
+                                                              'need to define regions_class_order!'
+    segmentation = None
+    running_max = None
+    # same dtype as the final segmentation (see revert_cropping_and_transpose_segmentation). argmax returns int64,
+    # which would be 8x larger at full resolution
+    dtype = np.uint8 if len(label_manager.foreground_labels) < 255 else np.uint16
+    for start in range(0, predicted_logits.shape[0], class_chunk_size):
+        resampled = configuration_manager.resampling_fn_probabilities(
+            predicted_logits[start:start + class_chunk_size], target_shape, current_spacing, target_spacing)
+        if isinstance(resampled, torch.Tensor):
+            resampled = resampled.cpu().numpy()
+        resampled = resampled.astype(np.float32, copy=False)
+
+        if label_manager.has_regions:
+            if segmentation is None:
+                segmentation = np.zeros(resampled.shape[1:], dtype=dtype)
+            # later regions overwrite earlier ones, same as LabelManager.convert_probabilities_to_segmentation
+            for i in range(resampled.shape[0]):
+                segmentation[resampled[i] > 0] = label_manager.regions_class_order[start + i]
+        else:
+            chunk_argmax = resampled.argmax(0).astype(dtype)
+            chunk_max = np.take_along_axis(resampled, chunk_argmax[None], 0)[0]
+            chunk_argmax += start
+            if segmentation is None:
+                segmentation, running_max = chunk_argmax, chunk_max
+            else:
+                # strictly greater: on ties the lower class index wins, just like argmax
+                better = chunk_max > running_max
+                segmentation[better] = chunk_argmax[better]
+                running_max[better] = chunk_max[better]
+        del resampled
+    return segmentation
+
+
+def export_prediction_from_logits(predicted_array_or_file: Union[np.ndarray, torch.Tensor, str], properties_dict: dict,
                                   configuration_manager: ConfigurationManager,
                                   plans_manager: PlansManager,
                                   dataset_json_dict_or_file: Union[dict, str], output_file_truncated: str,
-                                  save_probabilities: bool = False):
-    # if isinstance(predicted_array_or_file, str):
-    #     tmp = deepcopy(predicted_array_or_file)
-    #     if predicted_array_or_file.endswith('.npy'):
-    #         predicted_array_or_file = np.load(predicted_array_or_file)
-    #     elif predicted_array_or_file.endswith('.npz'):
-    #         predicted_array_or_file = np.load(predicted_array_or_file)['softmax']
-    #     os.remove(tmp)
-
+                                  save_probabilities: bool = False, class_chunk_size: Union[int, None] = None):
+    # if predicted_array_or_file is a str (memory mapped .npy logits), it is opened and removed by
+    # convert_predicted_logits_to_segmentation_with_correct_shape
+    set_profiled_case(os.path.basename(output_file_truncated))
     if isinstance(dataset_json_dict_or_file, str):
         dataset_json_dict_or_file = load_json(dataset_json_dict_or_file)
 
     label_manager = plans_manager.get_label_manager(dataset_json_dict_or_file)
     ret = convert_predicted_logits_to_segmentation_with_correct_shape(
         predicted_array_or_file, plans_manager, configuration_manager, label_manager, properties_dict,
-        return_probabilities=save_probabilities
+        return_probabilities=save_probabilities, class_chunk_size=class_chunk_size
     )
     del predicted_array_or_file
 
     # save
-    if save_probabilities:
-        segmentation_final, probabilities_final = ret
-        np.savez_compressed(output_file_truncated + '.npz', probabilities=probabilities_final)
-        save_pickle(properties_dict, output_file_truncated + '.pkl')
-        del probabilities_final, ret
-    else:
-        segmentation_final = ret
-        del ret
+    with profile_span('write'):
+        if save_probabilities:
+            segmentation_final, probabilities_final = ret
+            np.savez_compressed(output_file_truncated + '.npz', probabilities=probabilities_final)
+            save_pickle(properties_dict, output_file_truncated + '.pkl')
+            del probabilities_final, ret
+        else:
+            segmentation_final = ret
+            del ret
+
+        rw = plans_manager.image_reader_writer_class()
+        rw.write_seg(segmentation_final, output_file_truncated + dataset_json_dict_or_file['file_ending'],
+                     properties_dict)
+    set_profiled_case(None)
 
-    rw = plans_manager.image_reader_writer_class()
-    rw.write_seg(segmentation_final, output_file_truncated + dataset_json_dict_or_file['file_ending'],
-                 properties_dict)
+
+def export_segmentation(segmentation: Union[torch.Tensor, np.ndarray], properties_dict: dict,
+                        plans_manager: PlansManager, dataset_json_dict_or_file: Union[dict, str],
+                        output_file_truncated: str):
+    """
+    Same as export_prediction_from_logits but for a segmentation that was already resampled to the shape after
+    cropping (see nnUNetPredictor.predict_segmentation_2d_streaming)
+    """
+    set_profiled_case(os.path.basename(output_file_truncated))
+    if isinstance(dataset_json_dict_or_file, str):
+        dataset_json_dict_or_file = load_json(dataset_json_dict_or_file)
+
+    label_manager = plans_manager.get_label_manager(dataset_json_dict_or_file)
+    segmentation_final = revert_cropping_and_transpose_segmentation(segmentation, plans_manager, label_manager,
+                                                                    properties_dict)
+    with profile_span('write'):
+        rw = plans_manager.image_reader_writer_class()
+        rw.write_seg(segmentation_final, output_file_truncated + dataset_json_dict_or_file['file_ending'],
+                     properties_dict)
+    set_profiled_case(None)
 
 
 def resample_and_save(predicted: Union[torch.Tensor, np.ndarray], target_shape: List[int], output_file: str,
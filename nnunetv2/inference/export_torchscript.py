@@ -0,0 +1,172 @@
+import json
+from typing import Union, Tuple, List
+
+import torch
+from batchgenerators.utilities.file_and_folder_operations import load_json, join, isfile
+from torch import nn
+
+import nnunetv2
+from nnunetv2.utilities.file_path_utilities import get_output_folder
+from nnunetv2.utilities.find_class_by_name import recursive_find_python_class
+from nnunetv2.utilities.label_handling.label_handling import determine_num_input_channels
+from nnunetv2.utilities.plans_handling.plans_handler import PlansManager
+
+TORCHSCRIPT_METADATA_FILE = 'nnunet_metadata.json'
+
+
+def get_torchscript_filename(checkpoint_name: str, quantized: bool = False) -> str:
+    """
+    checkpoint_final.pth -> checkpoint_final.torchscript.pt (checkpoint_final.int8.torchscript.pt if quantized)
+    """
+    if checkpoint_name.endswith('.pth'):
+        checkpoint_name = checkpoint_name[:-4]
+    return checkpoint_name + ('.int8' if quantized else '') + '.torchscript.pt'
+
+
+def get_memory_format(patch_size: Union[Tuple[int, ...], List[int]]) -> torch.memory_format:
+    return torch.channels_last_3d if len(patch_size) == 3 else torch.channels_last
+
+
+def load_eager_network_from_checkpoint(model_training_output_dir: str, fold: Union[int, str],
+                                       checkpoint_name: str = 'checkpoint_final.pth'):
+    """
+    Builds the network exactly like nnUNetPredictor.initialize_from_trained_model_folder does and loads the weights
+    of the requested fold. Returns the network (eval mode, cpu) and the metadata needed for inference
+    """
+    dataset_json = load_json(join(model_training_output_dir, 'dataset.json'))
+    plans_manager = PlansManager(load_json(join(model_training_output_dir, 'plans.json')))
+
+    checkpoint = torch.load(join(model_training_output_dir, f'fold_{fold}', checkpoint_name),
+                            map_location=torch.device('cpu'))
+    trainer_name = checkpoint['trainer_name']
+    configuration_name = checkpoint['init_args']['configuration']
+    inference_allowed_mirroring_axes = checkpoint['inference_allowed_mirroring_axes'] if \
+        'inference_allowed_mirroring_axes' in checkpoint.keys() else None
+
+    configuration_manager = plans_manager.get_configuration(configuration_name)
+    num_input_channels = determine_num_input_channels(plans_manager, configuration_manager, dataset_json)
+    trainer_class = recursive_find_python_class(join(nnunetv2.__path__[0], "training", "nnUNetTrainer"),
+                                                trainer_name, 'nnunetv2.training.nnUNetTrainer')
+    network = trainer_class.build_network_architecture(plans_manager, dataset_json, configuration_manager,
+                                                       num_input_channels, enable_deep_supervision=False)
+    network.load_state_dict(checkpoint['network_weights'])
+    network.eval()
+
+    metadata = {
+        'trainer_name': trainer_name,
+        'configuration': configuration_name,
+        'inference_allowed_mirroring_axes': inference_allowed_mirroring_axes,
+        'num_input_channels': num_input_channels,
+        'patch_size': list(configuration_manager.patch_size),
+    }
+    return network, metadata
+
+
+def check_torchscript_parity(eager_network: nn.Module, exported_network: nn.Module,
+                             input_shape: Tuple[int, ...], num_samples: int = 2,
+                             device: torch.device = torch.device('cpu'),
+                             memory_format: torch.memory_format = torch.contiguous_format) -> float:
+    """
+    Runs eager_network and exported_network on the same random inputs and returns the largest absolute difference of
+    the logits. Both networks must already be on device
+    """
+    max_abs_diff = 0.
+    generator = torch.Generator().manual_seed(1234)
+    with torch.inference_mode():
+        for _ in range(num_samples):
+            x = torch.randn(input_shape, generator=generator).to(device).contiguous(memory_format=memory_format)
+            diff = (eager_network(x).float() - exported_network(x).float()).abs().max().item()
+            max_abs_diff = max(max_abs_diff, diff)
+    return max_abs_diff
+
+
+def export_fold_to_torchscript(model_training_output_dir: str, fold: Union[int, str],
+                               checkpoint_name: str = 'checkpoint_final.pth', output_file: str = None,
+                               channels_last: bool = False, parity_tolerance: Union[float, None] = 1e-3,
+                               verbose: bool = True) -> str:
+    """
+    Traces the network of one fold with an input of patch size, freezes it (weights become constants, conv/bn are
+    folded where possible) and saves it next to the checkpoint. The nnU-Net metadata the predictor needs (trainer,
+    configuration, mirror axes) is stored in the artifact itself, so nnUNetPredictor.
+    initialize_from_torchscript_model_folder does not have to rebuild the architecture.
+
+    Tracing is done on the CPU. The traced graph does not depend on the input shape (nnU-Net architectures have no
+    shape dependent control flow), so the artifact can be run with any tile size that the network accepts and any
+    batch size.
+
+    If parity_tolerance is not None, the frozen network is compared against the eager model on random inputs and a
+    RuntimeError is raised if the logits deviate by more than parity_tolerance.
+    """
+    if output_file is None:
+        output_file = join(model_training_output_dir, f'fold_{fold}', get_torchscript_filename(checkpoint_name))
+
+    network, metadata = load_eager_network_from_checkpoint(model_training_output_dir, fold, checkpoint_name)
+    input_shape = (1, metadata['num_input_channels'], *metadata['patch_size'])
+    memory_format = get_memory_format(metadata['patch_size']) if channels_last else torch.contiguous_format
+    network = network.to(memory_format=memory_format)
+    metadata['checkpoint_name'] = checkpoint_name
+    metadata['channels_last'] = channels_last
+
+    example_input = torch.randn(input_shape).contiguous(memory_format=memory_format)
+    with torch.inference_mode():
+        traced = torch.jit.trace(network, example_input, check_trace=False)
+    frozen = torch.jit.freeze(traced)
+
+    if parity_tolerance is not None:
+        max_abs_diff = check_torchscript_parity(network, frozen, input_shape, memory_format=memory_format)
+        if verbose:
+            print(f'fold {fold}: max abs difference between eager and TorchScript logits: {max_abs_diff:.3e}')
+        if max_abs_diff > parity_tolerance:
+            raise RuntimeError(f'TorchScript export of fold {fold} does not match the eager model. Max abs '
+                               f'difference of logits is {max_abs_diff}, tolerance is {parity_tolerance}')
+
+    torch.jit.save(frozen, output_file, _extra_files={TORCHSCRIPT_METADATA_FILE: json.dumps(metadata)})
+    if verbose:
+        print(f'saved {output_file}')
+    return output_file
+
+
+def load_torchscript_network(filename: str, device: torch.device = torch.device('cpu')):
+    """
+    Returns the frozen network (on device) and the metadata that was stored with it by export_fold_to_torchscript
+    """
+    assert isfile(filename), f'TorchScript artifact {filename} does not exist. Export it with ' \
+                             f'nnUNetv2_export_torchscript first'
+    extra_files = {TORCHSCRIPT_METADATA_FILE: ''}
+    network = torch.jit.load(filename, map_location=device, _extra_files=extra_files)
+    network.eval()
+    metadata = json.loads(extra_files[TORCHSCRIPT_METADATA_FILE])
+    if metadata.get('quantized_engine') is not None:
+        # int8 networks from nnUNetv2_quantize must run with the backend they were quantized for
+        torch.backends.quantized.engine = metadata['quantized_engine']
+    return network, metadata
+
+
+def export_torchscript_entry_point():
+    import argparse
+    parser = argparse.ArgumentParser(description='Exports the trained folds of a model as frozen TorchScript '
+                                                 'artifacts that can be used for inference with '
+                                                 'nnUNetv2_predict --torchscript. Each fold is checked against the '
+                                                 'eager model before it is saved.')
+    parser.add_argument('-d', type=str, required=True,
+                        help='Dataset name or id')
+    parser.add_argument('-c', type=str, required=True,
+                        help='nnU-Net configuration')
+    parser.add_argument('-p', type=str, required=False, default='nnUNetPlans',
+                        help='Plans identifier. Default: nnUNetPlans')
+    parser.add_argument('-tr', type=str, required=False, default='nnUNetTrainer',
+                        help='Trainer class. Default: nnUNetTrainer')
+    parser.add_argument('-f', nargs='+', type=str, required=False, default=(0, 1, 2, 3, 4),
+                        help='Folds to export. Default: (0, 1, 2, 3, 4)')
+    parser.add_argument('-chk', type=str, required=False, default='checkpoint_final.pth',
+                        help='Name of the checkpoint to export. Default: checkpoint_final.pth')
+    parser.add_argument('--channels_last', action='store_true', required=False, default=False,
+                        help='Export with channels last (3d) memory format. Often faster on CPU.')
+    parser.add_argument('-parity_tolerance', type=float, required=False, default=1e-3,
+                        help='Max allowed abs difference between eager and TorchScript logits. Default: 1e-3')
+    args = parser.parse_args()
+
+    model_folder = get_output_folder(args.d, args.tr, args.p, args.c)
+    for f in args.f:
+        export_fold_to_torchscript(model_folder, f if f == 'all' else int(f), args.chk, None, args.channels_last,
+                                   args.parity_tolerance)
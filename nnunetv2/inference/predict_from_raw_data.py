@@ -1,9 +1,10 @@
 import inspect
+import itertools
 import multiprocessing
 import os
 import traceback
 from copy import deepcopy
-from time import sleep
+from time import sleep, time
 from typing import Tuple, Union, List, Optional
 
 import numpy as np
@@ -22,28 +23,62 @@ from nnunetv2.configuration import default_num_processes
 from nnunetv2.inference.data_iterators import PreprocessAdapterFromNpy, preprocessing_iterator_fromfiles, \
     preprocessing_iterator_fromnpy
 from nnunetv2.inference.export_prediction import export_prediction_from_logits, \
-    convert_predicted_logits_to_segmentation_with_correct_shape
-from nnunetv2.inference.sliding_window_prediction import compute_gaussian, \
-    compute_steps_for_sliding_window
+    convert_predicted_logits_to_segmentation_with_correct_shape, export_segmentation, \
+    revert_cropping_and_transpose_segmentation, get_class_chunk_size
+from nnunetv2.inference.export_torchscript import get_torchscript_filename, load_torchscript_network, \
+    get_memory_format
+from nnunetv2.inference.preprocessing_cache import PreprocessingCache
+from nnunetv2.inference.quantization import get_calibration_tiles, quantize_network_static
+from nnunetv2.inference.shared_memory import get_shared_memory_folder, array_to_shared_file, open_shared_file, \
+    release_shared_file
+from nnunetv2.inference.tile_parallel import TileWorkerPool
+from nnunetv2.inference.sliding_window_prediction import compute_gaussian, compute_sliding_window_normalization_map, \
+    compute_steps_for_sliding_window, create_memmap_array
+from nnunetv2.inference.work_queue import FileLockWorkQueue, start_heartbeat_thread
+from nnunetv2.preprocessing.preprocessors.default_preprocessor import resize_foreground_mask
 from nnunetv2.utilities.file_path_utilities import get_output_folder, check_workers_alive_and_busy
 from nnunetv2.utilities.find_class_by_name import recursive_find_python_class
-from nnunetv2.utilities.helpers import empty_cache, dummy_context
+from nnunetv2.utilities.helpers import empty_cache, dummy_context, cpu_supports_bf16
 from nnunetv2.utilities.json_export import recursive_fix_for_json_export
 from nnunetv2.utilities.label_handling.label_handling import determine_num_input_channels
 from nnunetv2.utilities.plans_handling.plans_handler import PlansManager, ConfigurationManager
+from nnunetv2.utilities.profiling import enable_profiling, profile_span, record_span, record_value, \
+    set_profiled_case, write_profiling_report
 from nnunetv2.utilities.utils import create_lists_from_splitted_dataset_folder
 
 
 class nnUNetPredictor(object):
     def __init__(self,
-                 tile_step_size: float = 0.5,
+                 tile_step_size: Union[float, Tuple[float, ...]] = 0.5,
                  use_gaussian: bool = True,
                  use_mirroring: bool = True,
                  perform_everything_on_gpu: bool = True,
                  device: torch.device = torch.device('cuda'),
                  verbose: bool = False,
                  verbose_preprocessing: bool = False,
-                 allow_tqdm: bool = True):
+                 allow_tqdm: bool = True,
+                 tile_batch_size: int = 1,
+                 tile_batch_memory_gb: Optional[float] = None,
+                 batched_mirroring: bool = False,
+                 mirror_axes: Optional[Tuple[int, ...]] = None,
+                 keep_folds_resident: bool = False,
+                 tile_skip_intensity_threshold: Optional[float] = None,
+                 logits_ram_budget_gb: Optional[float] = None,
+                 memmap_folder: Optional[str] = None,
+                 export_class_chunk_size: Optional[int] = None,
+                 use_inference_mode: bool = False,
+                 channels_last: bool = False,
+                 cpu_bf16_autocast: bool = False,
+                 use_shared_memory: bool = False,
+                 cascade_roi_margin: Optional[int] = None,
+                 preprocessing_cache_folder: Optional[str] = None,
+                 preprocessing_cache_size_gb: float = 50,
+                 num_tile_workers: int = 1,
+                 streaming_2d_num_slices: Optional[int] = None,
+                 tile_size: Optional[Tuple[int, ...]] = None,
+                 profile_folder: Optional[str] = None,
+                 profile_chrome_trace: bool = False,
+                 cross_case_batch_size: int = 1):
         self.verbose = verbose
         self.verbose_preprocessing = verbose_preprocessing
         self.allow_tqdm = allow_tqdm
@@ -51,9 +86,105 @@ class nnUNetPredictor(object):
         self.plans_manager, self.configuration_manager, self.list_of_parameters, self.network, self.dataset_json, \
         self.trainer_name, self.allowed_mirroring_axes, self.label_manager = None, None, None, None, None, None, None, None
 
-        self.tile_step_size = tile_step_size
+        # float or one float per axis of the tile size
+        self.tile_step_size = tile_step_size if np.isscalar(tile_step_size) else tuple(tile_step_size)
+        # sliding window tile size. None means the patch size used for training. nnU-Net networks are fully
+        # convolutional, so larger tiles (with less overlap) can be used for inference. Often much faster on CPU. Must
+        # be divisible by the total downsampling of the network along each axis. See tile_size_tuning.py for picking
+        # a good value
+        self.tile_size = tuple(tile_size) if tile_size is not None else None
+        # number of sliding window tiles that are stacked into one batch and pushed through the network together.
+        # Larger values make better use of CPU cores and the torch threadpool for small patch sizes
+        assert tile_batch_size >= 1, 'tile_batch_size must be at least 1'
+        self.tile_batch_size = tile_batch_size
+        # if set, the number of tiles per batch is chosen automatically such that the activations of one batch fit in
+        # this budget (overrides tile_batch_size). Mostly useful for 2d configurations where hundreds of slices can be
+        # stacked into one batch. The activation memory per tile is measured once with a probe forward pass
+        self.tile_batch_memory_gb = tile_batch_memory_gb
+        self._activation_bytes_per_tile = {}
         self.use_gaussian = use_gaussian
         self.use_mirroring = use_mirroring
+        # if True, all mirrored variants of a tile are stacked into one batch and predicted in a single forward pass
+        self.batched_mirroring = batched_mirroring
+        # optional subset of the mirror axes that were allowed during training. Use this to reduce the cost of test
+        # time augmentation. None means all allowed axes are used
+        self.mirror_axes = tuple(mirror_axes) if mirror_axes is not None else None
+        # if True, one network instance per fold is kept on the device and all folds are run on the same tile. The
+        # state_dict is no longer reloaded for each case and the tiles are only extracted once instead of once per fold
+        self.keep_folds_resident = keep_folds_resident
+        self._resident_networks = None
+        # tiles that do not contain a single voxel above this intensity (in the units of the raw input image, for
+        # example HU for CT) are not predicted. Background logits are written there instead. Useful for CT where
+        # air/table make up a large part of the image and crop_to_nonzero doesn't help. The mask is computed from the
+        # raw intensities during preprocessing (see DefaultPreprocessor.foreground_mask_threshold). Number of skipped
+        # tiles and of all tiles per case of the last prediction:
+        self.tile_skip_intensity_threshold = tile_skip_intensity_threshold
+        self.num_skipped_tiles = []
+        self.num_tiles = []
+        # if the logits accumulator of a case does not fit in this budget (and we are accumulating on the CPU), it is
+        # stored as a np.memmap in memmap_folder (default: system temp dir) instead of RAM. The result is then
+        # handed to the export as a file and never fully loaded into the memory of the main process
+        self.logits_ram_budget_gb = logits_ram_budget_gb
+        self.memmap_folder = memmap_folder
+        # if not None, segmentation export resamples this many classes at a time and keeps a running argmax instead of
+        # resampling all logits at once. Has no effect if probabilities are requested
+        self.export_class_chunk_size = export_class_chunk_size
+        # inference only optimizations. torch.inference_mode instead of torch.no_grad skips version counter and view
+        # tracking. Logits returned in this mode are inference tensors and cannot be used in autograd later on
+        self.use_inference_mode = use_inference_mode
+        # network weights and tiles are converted to channels last (3d) memory format. Often faster on CPU
+        self.channels_last = channels_last
+        # autocast to bfloat16 if the device is a CPU with native bf16 support. Ignored on all other CPUs because
+        # emulated bf16 is much slower than float32
+        if cpu_bf16_autocast and device.type == 'cpu' and not cpu_supports_bf16():
+            print('cpu_bf16_autocast=True but this CPU has no native bf16 support. Setting this to False')
+            cpu_bf16_autocast = False
+        self.cpu_bf16_autocast = cpu_bf16_autocast
+        # if True, preprocessed images and logits are handed to/from the background workers as files in shared memory
+        # (/dev/shm) instead of being pickled. See shared_memory.py
+        self.shared_memory_folder = get_shared_memory_folder() if use_shared_memory else None
+        if use_shared_memory and self.shared_memory_folder is None:
+            print('use_shared_memory=True but /dev/shm is not available. Falling back to the system temp dir')
+        # cascade only. If not None, the full resolution sliding window is restricted to the bounding box of the
+        # foreground of the previous stage segmentation, enlarged by this many voxels (full resolution grid) on each
+        # side. Everything outside of it is background in the low resolution segmentation and is filled with
+        # background logits without running the network. Can save most of the compute for small structures
+        self.cascade_roi_margin = cascade_roi_margin
+        # if set, preprocessed inputs are cached on disk and reused by subsequent runs on the same images with the
+        # same preprocessing (other checkpoints, folds or configurations that share the preprocessing). Least recently
+        # used entries are removed once the cache exceeds preprocessing_cache_size_gb. See PreprocessingCache
+        self.preprocessing_cache = PreprocessingCache(preprocessing_cache_folder, preprocessing_cache_size_gb) if \
+            preprocessing_cache_folder is not None else None
+        # CPU only. If > 1, the sliding window tiles of a case are distributed across this many worker processes, each
+        # with its own copy of the network and a share of the intra-op threads. They accumulate into shared memory
+        # logits. Reduces the latency for single cases on many-core machines. See tile_parallel.py
+        assert num_tile_workers >= 1, 'num_tile_workers must be at least 1'
+        self.num_tile_workers = num_tile_workers
+        # started on first use and kept alive across cases, see close_tile_workers
+        self._tile_worker_pool = None
+        # index (in list_of_parameters) of the weights currently loaded into self.network. Tells the tile workers which
+        # weights to use
+        self._loaded_fold = None
+        # 2d configurations on 3d images only. If not None, this many slices are predicted at a time and immediately
+        # resampled and converted to a segmentation. The logits of the entire volume are never held in memory, so
+        # memory no longer grows with num_classes x volume size. Not used if probabilities are requested. See
+        # predict_segmentation_2d_streaming
+        self.streaming_2d_num_slices = streaming_2d_num_slices
+        # if set, the time spent in each stage of the pipeline (read, crop, normalize, resample, tile forward,
+        # accumulate, export resampling, write and the waits in between) is recorded for every case and summarized in
+        # profile_folder/profile_report.json at the end of predict_from_data_iterator. Optionally also as a Chrome
+        # trace (profile_trace.json). See nnunetv2/utilities/profiling.py
+        self.profile_folder = profile_folder
+        self.profile_chrome_trace = profile_chrome_trace
+        if profile_folder is not None:
+            enable_profiling(profile_folder)
+        # throughput mode for datasets with many small images (typically 2d) where a single case has fewer tiles than
+        # a batch. predict_from_data_iterator collects this many queued cases and packs their tiles into shared
+        # batches, the results are routed back to the accumulators of their cases. Per case overhead (logging, export
+        # round trips, sliding window setup) is paid once per group. Combine with tile_batch_size or
+        # tile_batch_memory_gb, otherwise there is nothing to pack
+        assert cross_case_batch_size >= 1, 'cross_case_batch_size must be at least 1'
+        self.cross_case_batch_size = cross_case_batch_size
         if device.type == 'cuda':
             # device = torch.device(type='cuda', index=0)  # set the desired GPU with CUDA_VISIBLE_DEVICES!
             # why would I ever want to do that. Stupid dobby. This kills DDP inference...
@@ -108,11 +239,96 @@ class nnUNetPredictor(object):
         self.trainer_name = trainer_name
         self.allowed_mirroring_axes = inference_allowed_mirroring_axes
         self.label_manager = plans_manager.get_label_manager(dataset_json)
+        self._resident_networks = None
+        self._loaded_fold = None
+        self.close_tile_workers()
         if ('nnUNet_compile' in os.environ.keys()) and (os.environ['nnUNet_compile'].lower() in ('true', '1', 't')) \
                 and not isinstance(self.network, OptimizedModule):
             print('compiling network')
             self.network = torch.compile(self.network)
 
+    def initialize_from_torchscript_model_folder(self, model_training_output_dir: str,
+                                                 use_folds: Union[Tuple[Union[int, str]], None],
+                                                 checkpoint_name: str = 'checkpoint_final.pth',
+                                                 quantized: bool = False):
+        """
+        Same as initialize_from_trained_model_folder but loads the frozen TorchScript artifacts written by
+        nnUNetv2_export_torchscript (see export_torchscript.py) instead of rebuilding the network architecture from the
+        trainer class. Frozen networks cannot load a state_dict, so each fold stays resident on self.device
+
+        quantized=True loads the int8 artifacts written by nnUNetv2_quantize --save_torchscript (CPU only)
+        """
+        if quantized:
+            assert self.device.type == 'cpu', 'quantized networks can only be run on the CPU'
+        torchscript_name = get_torchscript_filename(checkpoint_name, quantized)
+        if use_folds is None:
+            use_folds = nnUNetPredictor.auto_detect_available_folds(model_training_output_dir, torchscript_name)
+
+        dataset_json = load_json(join(model_training_output_dir, 'dataset.json'))
+        plans = load_json(join(model_training_output_dir, 'plans.json'))
+        plans_manager = PlansManager(plans)
+
+        if isinstance(use_folds, str):
+            use_folds = [use_folds]
+
+        networks = []
+        for i, f in enumerate(use_folds):
+            f = int(f) if f != 'all' else f
+            network, metadata = load_torchscript_network(join(model_training_output_dir, f'fold_{f}', torchscript_name),
+                                                         self.device)
+            if i == 0:
+                trainer_name = metadata['trainer_name']
+                configuration_name = metadata['configuration']
+                inference_allowed_mirroring_axes = metadata['inference_allowed_mirroring_axes']
+                if inference_allowed_mirroring_axes is not None:
+                    inference_allowed_mirroring_axes = tuple(inference_allowed_mirroring_axes)
+            if metadata['channels_last'] and not self.channels_last:
+                print('TorchScript artifact was exported with channels_last=True, enabling channels_last')
+                self.channels_last = True
+            networks.append(network)
+
+        self.plans_manager = plans_manager
+        self.configuration_manager = plans_manager.get_configuration(configuration_name)
+        # no parameters to load, the networks are used as they are (see _internal_use_resident_networks)
+        self.list_of_parameters = None
+        self.network = networks[0]
+        self.dataset_json = dataset_json
+        self.trainer_name = trainer_name
+        self.allowed_mirroring_axes = inference_allowed_mirroring_axes
+        self.label_manager = plans_manager.get_label_manager(dataset_json)
+        self._resident_networks = networks
+        self._loaded_fold = None
+        self.close_tile_workers()
+
+    def quantize_networks(self, calibration_data: Union[torch.Tensor, List[Union[np.ndarray, torch.Tensor]]],
+                          num_tiles_per_case: int = 4):
+        """
+        Replaces the network of each fold with an int8 version (post training static quantization, see
+        quantization.py). calibration_data is either a list of preprocessed cases (c, x, y, z) from which random tiles
+        are sampled or a tensor of tiles (n, c, *patch_size). A handful of training cases is enough.
+        Must be called after initialize_from_trained_model_folder. CPU only. The quantized networks stay resident
+        """
+        assert self.device.type == 'cpu', 'quantized networks can only be run on the CPU'
+        assert self.list_of_parameters is not None, 'quantize_networks needs the float weights of all folds. Call ' \
+                                                    'initialize_from_trained_model_folder first'
+        if not isinstance(calibration_data, torch.Tensor):
+            calibration_data = get_calibration_tiles(calibration_data, self.configuration_manager.patch_size,
+                                                     num_tiles_per_case)
+        base_network = self.network._orig_mod if isinstance(self.network, OptimizedModule) else self.network
+        networks = []
+        for params in self.list_of_parameters:
+            network = deepcopy(base_network)
+            network.load_state_dict(params)
+            networks.append(quantize_network_static(network, calibration_data))
+        if self.cpu_bf16_autocast:
+            print('bf16 autocast is not used with quantized networks. Setting cpu_bf16_autocast to False')
+            self.cpu_bf16_autocast = False
+        self.list_of_parameters = None
+        self.network = networks[0]
+        self._resident_networks = networks
+        self._loaded_fold = None
+        self.close_tile_workers()
+
     def manual_initialization(self, network: nn.Module, plans_manager: PlansManager,
                               configuration_manager: ConfigurationManager, parameters: Optional[List[dict]],
                               dataset_json: dict, trainer_name: str,
@@ -128,6 +344,9 @@ class nnUNetPredictor(object):
         self.trainer_name = trainer_name
         self.allowed_mirroring_axes = inference_allowed_mirroring_axes
         self.label_manager = plans_manager.get_label_manager(dataset_json)
+        self._resident_networks = None
+        self._loaded_fold = None
+        self.close_tile_workers()
         allow_compile = True
         allow_compile = allow_compile and ('nnUNet_compile' in os.environ.keys()) and (os.environ['nnUNet_compile'].lower() in ('true', '1', 't'))
         allow_compile = allow_compile and not isinstance(self.network, OptimizedModule)
@@ -196,10 +415,14 @@ class nnUNetPredictor(object):
                            num_processes_segmentation_export: int = default_num_processes,
                            folder_with_segs_from_prev_stage: str = None,
                            num_parts: int = 1,
-                           part_id: int = 0):
+                           part_id: int = 0,
+                           work_queue_folder: str = None):
         """
         This is nnU-Net's default function for making predictions. It works best for batch predictions
         (predicting many images at once).
+
+        If work_queue_folder is given, cases are distributed dynamically among all workers (processes or hosts) that
+        use the same work_queue_folder and output folder. See FileLockWorkQueue. Can't be combined with num_parts > 1
         """
         if isinstance(output_folder_or_list_of_truncated_output_files, str):
             output_folder = output_folder_or_list_of_truncated_output_files
@@ -241,12 +464,28 @@ class nnUNetPredictor(object):
         if len(list_of_lists_or_source_folder) == 0:
             return
 
-        data_iterator = self._internal_get_data_iterator_from_lists_of_filenames(list_of_lists_or_source_folder,
-                                                                                 seg_from_prev_stage_files,
-                                                                                 output_filename_truncated,
-                                                                                 num_processes_preprocessing)
-
-        return self.predict_from_data_iterator(data_iterator, save_probabilities, num_processes_segmentation_export)
+        if work_queue_folder is None:
+            data_iterator = self._internal_get_data_iterator_from_lists_of_filenames(list_of_lists_or_source_folder,
+                                                                                     seg_from_prev_stage_files,
+                                                                                     output_filename_truncated,
+                                                                                     num_processes_preprocessing)
+            return self.predict_from_data_iterator(data_iterator, save_probabilities,
+                                                   num_processes_segmentation_export)
+
+        assert num_parts == 1, 'work_queue_folder replaces num_parts/part_id, do not use both'
+        assert output_filename_truncated is not None, 'work_queue_folder requires output files'
+        work_queue = FileLockWorkQueue(work_queue_folder, [os.path.basename(i) for i in output_filename_truncated])
+        stop_heartbeat = start_heartbeat_thread(work_queue)
+        try:
+            data_iterator = preprocessing_iterator_fromfiles(
+                list_of_lists_or_source_folder, seg_from_prev_stage_files, output_filename_truncated,
+                self.plans_manager, self.dataset_json, self.configuration_manager, num_processes_preprocessing,
+                self.device.type == 'cuda', self.verbose_preprocessing, self.shared_memory_folder, work_queue,
+                self.preprocessing_cache, self.tile_skip_intensity_threshold)
+            return self.predict_from_data_iterator(data_iterator, save_probabilities,
+                                                   num_processes_segmentation_export, work_queue)
+        finally:
+            stop_heartbeat.set()
 
     def _internal_get_data_iterator_from_lists_of_filenames(self,
                                                             input_list_of_lists: List[List[str]],
@@ -256,7 +495,9 @@ class nnUNetPredictor(object):
         return preprocessing_iterator_fromfiles(input_list_of_lists, seg_from_prev_stage_files,
                                                 output_filenames_truncated, self.plans_manager, self.dataset_json,
                                                 self.configuration_manager, num_processes, self.device.type == 'cuda',
-                                                self.verbose_preprocessing)
+                                                self.verbose_preprocessing, self.shared_memory_folder,
+                                                preprocessing_cache=self.preprocessing_cache,
+                                                foreground_mask_threshold=self.tile_skip_intensity_threshold)
         # preprocessor = self.configuration_manager.preprocessor_class(verbose=self.verbose_preprocessing)
         # # hijack batchgenerators, yo
         # # we use the multiprocessing of the batchgenerators dataloader to handle all the background worker stuff. This
@@ -305,7 +546,10 @@ class nnUNetPredictor(object):
             self.configuration_manager,
             num_processes,
             self.device.type == 'cuda',
-            self.verbose_preprocessing
+            self.verbose_preprocessing,
+            self.shared_memory_folder,
+            self.preprocessing_cache,
+            self.tile_skip_intensity_threshold
         )
 
         return pp
@@ -331,83 +575,204 @@ class nnUNetPredictor(object):
     def predict_from_data_iterator(self,
                                    data_iterator,
                                    save_probabilities: bool = False,
-                                   num_processes_segmentation_export: int = default_num_processes):
+                                   num_processes_segmentation_export: int = default_num_processes,
+                                   work_queue: FileLockWorkQueue = None):
         """
         each element returned by data_iterator must be a dict with 'data', 'ofile' and 'data_properites' keys!
         If 'ofile' is None, the result will be returned instead of written to a file
+
+        If work_queue is given, cases are marked as done in there once their export has finished
+
+        If cross_case_batch_size > 1, that many consecutive cases are collected from data_iterator and predicted
+        together (see predict_logits_from_list_of_preprocessed_data). Their exports are sent to the export workers in a
+        single round trip
         """
         with multiprocessing.get_context("spawn").Pool(num_processes_segmentation_export) as export_pool:
             worker_list = [i for i in export_pool._pool]
             r = []
-            for preprocessed in data_iterator:
-                data = preprocessed['data']
-                if isinstance(data, str):
-                    delfile = data
-                    data = torch.from_numpy(np.load(data))
-                    os.remove(delfile)
-
+            group = []
+            data_iterator_it = iter(data_iterator)
+            while True:
+                # time the main process spends waiting for preprocessing
+                start = time()
+                try:
+                    preprocessed = next(data_iterator_it)
+                except StopIteration:
+                    break
+                end = time()
                 ofile = preprocessed['ofile']
-                if ofile is not None:
-                    print(f'\nPredicting {os.path.basename(ofile)}:')
-                else:
-                    print(f'\nPredicting image of shape {data.shape}:')
-
-                print(f'perform_everything_on_gpu: {self.perform_everything_on_gpu}')
+                set_profiled_case(os.path.basename(ofile) if ofile is not None else None)
+                record_span('wait_for_preprocessing', start, end)
 
-                properties = preprocessed['data_properites']
-
-                # let's not get into a runaway situation where the GPU predicts so fast that the disk has to b swamped with
-                # npy files
-                proceed = not check_workers_alive_and_busy(export_pool, worker_list, r, allowed_num_queued=2)
-                while not proceed:
-                    print('sleeping')
-                    sleep(0.1)
-                    proceed = not check_workers_alive_and_busy(export_pool, worker_list, r, allowed_num_queued=2)
-
-                prediction = self.predict_logits_from_preprocessed_data(data).cpu()
-
-                if ofile is not None:
-                    # this needs to go into background processes
-                    # export_prediction_from_logits(prediction, properties, configuration_manager, plans_manager,
-                    #                               dataset_json, ofile, save_probabilities)
-                    print('sending off prediction to background worker for resampling and export')
-                    r.append(
-                        export_pool.starmap_async(
-                            export_prediction_from_logits,
-                            ((prediction, properties, self.configuration_manager, self.plans_manager,
-                              self.dataset_json, ofile, save_probabilities),)
-                        )
-                    )
-                else:
-                    # convert_predicted_logits_to_segmentation_with_correct_shape(prediction, plans_manager,
-                    #                                                             configuration_manager, label_manager,
-                    #                                                             properties,
-                    #                                                             save_probabilities)
-                    print('sending off prediction to background worker for resampling')
-                    r.append(
-                        export_pool.starmap_async(
-                            convert_predicted_logits_to_segmentation_with_correct_shape, (
-                                (prediction, self.plans_manager,
-                                 self.configuration_manager, self.label_manager,
-                                 properties,
-                                 save_probabilities),)
-                        )
-                    )
-                if ofile is not None:
-                    print(f'done with {os.path.basename(ofile)}')
-                else:
-                    print(f'\nDone with image of shape {data.shape}:')
-            ret = [i.get()[0] for i in r]
+                data = preprocessed['data']
+                data_file = None
+                if isinstance(data, str):
+                    # memory mapped, not loaded. See shared_memory.py
+                    data_file = data
+                    data = torch.from_numpy(open_shared_file(data_file))
+                case = {'data': data, 'data_file': data_file, 'ofile': ofile,
+                        'properties': preprocessed['data_properites']}
+
+                # cases that are exported and cases whose results are returned are not mixed within a group
+                if len(group) > 0 and (group[0]['ofile'] is None) != (ofile is None):
+                    self._internal_predict_and_export_group(group, export_pool, worker_list, r, save_probabilities,
+                                                            work_queue)
+                    group = []
+
+                if self._internal_use_streaming_2d(data, case['properties'], save_probabilities):
+                    # streamed cases are never grouped. Finish the pending group first to retain the order of results
+                    if len(group) > 0:
+                        self._internal_predict_and_export_group(group, export_pool, worker_list, r,
+                                                                save_probabilities, work_queue)
+                        group = []
+                    self._internal_predict_and_export_streaming_2d(case, export_pool, worker_list, r, work_queue)
+                    continue
+
+                group.append(case)
+                if len(group) >= self.cross_case_batch_size:
+                    self._internal_predict_and_export_group(group, export_pool, worker_list, r, save_probabilities,
+                                                            work_queue)
+                    group = []
+            if len(group) > 0:
+                self._internal_predict_and_export_group(group, export_pool, worker_list, r, save_probabilities,
+                                                        work_queue)
+            set_profiled_case(None)
+            with profile_span('wait_for_export'):
+                ret = [j for i in r for j in i.get()]
 
         if isinstance(data_iterator, MultiThreadedAugmenter):
             data_iterator._finish()
 
+        if self.profile_folder is not None:
+            write_profiling_report(self.profile_folder, self.profile_chrome_trace)
+            print(f'Profiling report written to {join(self.profile_folder, "profile_report.json")}')
+
         # clear lru cache
         compute_gaussian.cache_clear()
+        compute_sliding_window_normalization_map.cache_clear()
         # clear device cache
         empty_cache(self.device)
         return ret
 
+    @staticmethod
+    def _internal_wait_for_export_workers(export_pool, worker_list: List, r: List) -> None:
+        # let's not get into a runaway situation where the GPU predicts so fast that the disk has to b swamped with
+        # npy files
+        with profile_span('wait_for_export'):
+            proceed = not check_workers_alive_and_busy(export_pool, worker_list, r, allowed_num_queued=2)
+            while not proceed:
+                print('sleeping')
+                sleep(0.1)
+                proceed = not check_workers_alive_and_busy(export_pool, worker_list, r, allowed_num_queued=2)
+
+    def _internal_predict_and_export_streaming_2d(self, case: dict, export_pool, worker_list: List, r: List,
+                                                  work_queue: FileLockWorkQueue = None) -> None:
+        ofile = case['ofile']
+        if ofile is not None:
+            print(f'\nPredicting {os.path.basename(ofile)}:')
+        else:
+            print(f'\nPredicting image of shape {case["data"].shape}:')
+        print(f'perform_everything_on_gpu: {self.perform_everything_on_gpu}')
+
+        self._internal_wait_for_export_workers(export_pool, worker_list, r)
+
+        segmentation = self.predict_segmentation_2d_streaming(case['data'], case['properties'])
+        self.report_skipped_tiles([os.path.basename(ofile) if ofile is not None else None])
+        if case['data_file'] is not None:
+            release_shared_file(case['data_file'])
+        if ofile is not None:
+            print('sending off segmentation to background worker for export')
+            r.append(
+                export_pool.starmap_async(
+                    export_segmentation,
+                    ((segmentation, case['properties'], self.plans_manager, self.dataset_json, ofile),),
+                    callback=None if work_queue is None else
+                    lambda _, c=os.path.basename(ofile): work_queue.mark_done(c)
+                )
+            )
+            print(f'done with {os.path.basename(ofile)}')
+        else:
+            r.append(
+                export_pool.starmap_async(
+                    revert_cropping_and_transpose_segmentation,
+                    ((segmentation, self.plans_manager, self.label_manager, case['properties']),)
+                )
+            )
+            print(f'\nDone with image of shape {case["data"].shape}:')
+
+    def _internal_predict_and_export_group(self, group: List[dict], export_pool, worker_list: List, r: List,
+                                           save_probabilities: bool, work_queue: FileLockWorkQueue = None) -> None:
+        """
+        group is a list of cases (dicts with data, data_file, ofile and properties) that either all have an ofile or
+        all have none. Appends one async result (with one entry per case) to r
+        """
+        names = [os.path.basename(c['ofile']) if c['ofile'] is not None else None for c in group]
+        if len(group) == 1:
+            print(f'\nPredicting {names[0]}:' if names[0] is not None else
+                  f'\nPredicting image of shape {group[0]["data"].shape}:')
+        else:
+            print(f'\nPredicting {len(group)} cases together: ' +
+                  ', '.join([n if n is not None else str(tuple(c['data'].shape)) for n, c in zip(names, group)]))
+        print(f'perform_everything_on_gpu: {self.perform_everything_on_gpu}')
+        # spans of the shared sliding window are attributed to the group
+        set_profiled_case('+'.join(names) if names[0] is not None else None)
+
+        self._internal_wait_for_export_workers(export_pool, worker_list, r)
+
+        predictions = self.predict_logits_from_list_of_preprocessed_data(
+            [c['data'] for c in group], [self.get_foreground_mask(c['data'], c['properties']) for c in group])
+        self.report_skipped_tiles(names)
+        class_chunk_sizes = [self.get_export_class_chunk_size(p, c['properties'])
+                             for p, c in zip(predictions, group)]
+        for c in group:
+            if c['data_file'] is not None:
+                release_shared_file(c['data_file'])
+        with profile_span('logits_handoff'):
+            for i in range(len(predictions)):
+                if isinstance(predictions[i], np.memmap):
+                    # hand over the file, not the array. The export worker will open and delete it
+                    predictions[i] = predictions[i].filename
+                elif self.shared_memory_folder is not None:
+                    predictions[i] = array_to_shared_file(predictions[i], self.shared_memory_folder)
+                else:
+                    predictions[i] = predictions[i].cpu()
+
+        if names[0] is not None:
+            # this needs to go into background processes
+            # export_prediction_from_logits(prediction, properties, configuration_manager, plans_manager,
+            #                               dataset_json, ofile, save_probabilities)
+            print('sending off prediction to background worker for resampling and export')
+            r.append(
+                export_pool.starmap_async(
+                    export_prediction_from_logits,
+                    [(prediction, c['properties'], self.configuration_manager, self.plans_manager,
+                      self.dataset_json, c['ofile'], save_probabilities, class_chunk_size)
+                     for prediction, c, class_chunk_size in zip(predictions, group, class_chunk_sizes)],
+                    callback=None if work_queue is None else
+                    lambda _, cases=tuple(names): [work_queue.mark_done(c) for c in cases]
+                )
+            )
+            for n in names:
+                print(f'done with {n}')
+        else:
+            # convert_predicted_logits_to_segmentation_with_correct_shape(prediction, plans_manager,
+            #                                                             configuration_manager, label_manager,
+            #                                                             properties,
+            #                                                             save_probabilities)
+            print('sending off prediction to background worker for resampling')
+            r.append(
+                export_pool.starmap_async(
+                    convert_predicted_logits_to_segmentation_with_correct_shape,
+                    [(prediction, self.plans_manager,
+                      self.configuration_manager, self.label_manager,
+                      c['properties'],
+                      save_probabilities, default_num_processes, class_chunk_size)
+                     for prediction, c, class_chunk_size in zip(predictions, group, class_chunk_sizes)]
+                )
+            )
+            for c in group:
+                print(f'\nDone with image of shape {c["data"].shape}:')
+
     def predict_single_npy_array(self, input_image: np.ndarray, image_properties: dict,
                                  segmentation_previous_stage: np.ndarray = None,
                                  output_file_truncated: str = None,
@@ -418,130 +783,401 @@ class nnUNetPredictor(object):
         ppa = PreprocessAdapterFromNpy([input_image], [segmentation_previous_stage], [image_properties],
                                        [output_file_truncated],
                                        self.plans_manager, self.dataset_json, self.configuration_manager,
-                                       num_threads_in_multithreaded=1, verbose=self.verbose)
+                                       num_threads_in_multithreaded=1, verbose=self.verbose,
+                                       preprocessing_cache=self.preprocessing_cache,
+                                       foreground_mask_threshold=self.tile_skip_intensity_threshold)
         if self.verbose:
             print('preprocessing')
         dct = next(ppa)
 
         if self.verbose:
             print('predicting')
-        predicted_logits = self.predict_logits_from_preprocessed_data(dct['data']).cpu()
+        name = os.path.basename(output_file_truncated) if output_file_truncated is not None else None
+        if self._internal_use_streaming_2d(dct['data'], dct['data_properites'], save_or_return_probabilities):
+            segmentation = self.predict_segmentation_2d_streaming(dct['data'], dct['data_properites'])
+            self.report_skipped_tiles([name])
+            if output_file_truncated is not None:
+                export_segmentation(segmentation, dct['data_properites'], self.plans_manager, self.dataset_json,
+                                    output_file_truncated)
+                return
+            return revert_cropping_and_transpose_segmentation(segmentation, self.plans_manager, self.label_manager,
+                                                              dct['data_properites'])
+        predicted_logits = self.predict_logits_from_preprocessed_data(
+            dct['data'], self.get_foreground_mask(dct['data'], dct['data_properites']))
+        self.report_skipped_tiles([name])
+        class_chunk_size = self.get_export_class_chunk_size(predicted_logits, dct['data_properites'])
+        if isinstance(predicted_logits, np.memmap):
+            # export will open and delete the file
+            predicted_logits = predicted_logits.filename
+        else:
+            predicted_logits = predicted_logits.cpu()
 
         if self.verbose:
             print('resampling to original shape')
         if output_file_truncated is not None:
             export_prediction_from_logits(predicted_logits, dct['data_properites'], self.configuration_manager,
                                           self.plans_manager, self.dataset_json, output_file_truncated,
-                                          save_or_return_probabilities)
+                                          save_or_return_probabilities, class_chunk_size)
         else:
             ret = convert_predicted_logits_to_segmentation_with_correct_shape(predicted_logits, self.plans_manager,
                                                                               self.configuration_manager,
                                                                               self.label_manager,
                                                                               dct['data_properites'],
                                                                               return_probabilities=
-                                                                              save_or_return_probabilities)
+                                                                              save_or_return_probabilities,
+                                                                              class_chunk_size=class_chunk_size)
             if save_or_return_probabilities:
                 return ret[0], ret[1]
             else:
                 return ret
 
-    def predict_logits_from_preprocessed_data(self, data: torch.Tensor) -> torch.Tensor:
+    def get_export_class_chunk_size(self, logits: Union[np.ndarray, torch.Tensor], properties: dict) \
+            -> Optional[int]:
+        """
+        Memory mapped logits (see logits_ram_budget_gb) are always exported class-chunked. Resampling all of them at
+        once would create full resolution float arrays for all classes in RAM. Without export_class_chunk_size the
+        chunk size is derived from logits_ram_budget_gb
+        """
+        if self.export_class_chunk_size is not None or not isinstance(logits, np.memmap):
+            return self.export_class_chunk_size
+        return get_class_chunk_size(properties['shape_after_cropping_and_before_resampling'],
+                                    self.logits_ram_budget_gb)
+
+    def report_skipped_tiles(self, names: List[Union[str, None]]) -> None:
+        """
+        prints the number of skipped tiles (see tile_skip_intensity_threshold) of each case of the last prediction and
+        adds it to the profiling report
+        """
+        if self.tile_skip_intensity_threshold is None:
+            return
+        for name, num_skipped_tiles, num_tiles in zip(names, self.num_skipped_tiles, self.num_tiles):
+            print(f'{name if name is not None else "Image"}: skipped {num_skipped_tiles} of {num_tiles} tiles '
+                  f'without foreground')
+            record_value('num_skipped_tiles', num_skipped_tiles, name)
+            record_value('num_tiles', num_tiles, name)
+
+    def _internal_use_streaming_2d(self, data: torch.Tensor, properties: dict, save_probabilities: bool) -> bool:
+        # the out of plane axis must not be resampled, otherwise we would need neighboring slices
+        return self.streaming_2d_num_slices is not None and not save_probabilities and \
+            len(self.configuration_manager.patch_size) == 2 and len(data.shape) == 4 and \
+            properties['shape_after_cropping_and_before_resampling'][0] == data.shape[1]
+
+    def predict_segmentation_2d_streaming(self, data: torch.Tensor, properties: dict) -> np.ndarray:
+        """
+        2d configurations on 3d images only. Predicts streaming_2d_num_slices slices at a time, resamples their logits
+        in plane to the shape after cropping and converts them to a segmentation right away. Peak memory is the logits
+        of one chunk of slices plus the (uint8) segmentation of the whole volume.
+
+        Returns the segmentation in the shape after cropping. Use revert_cropping_and_transpose_segmentation or
+        export_segmentation to get to the original image.
+
+        Resampling only happens in plane, so the result is the same as resampling the logits of the entire volume
+        (see convert_predicted_logits_to_segmentation_with_correct_shape).
+        """
+        target_shape = properties['shape_after_cropping_and_before_resampling']
+        assert target_shape[0] == data.shape[1], 'streaming requires the out of plane axis not to be resampled'
+        current_spacing = [properties['spacing'][0], *self.configuration_manager.spacing]
+        segmentation = np.zeros(target_shape,
+                                dtype=np.uint8 if len(self.label_manager.foreground_labels) < 255 else np.uint16)
+        foreground_mask = self.get_foreground_mask(data, properties)
+        num_skipped_tiles, num_tiles = 0, 0
+        for z in range(0, data.shape[1], self.streaming_2d_num_slices):
+            chunk = data[:, z:z + self.streaming_2d_num_slices]
+            logits = self.predict_logits_from_preprocessed_data(
+                chunk, foreground_mask[z:z + self.streaming_2d_num_slices] if foreground_mask is not None else None)
+            num_skipped_tiles += self.num_skipped_tiles[0]
+            num_tiles += self.num_tiles[0]
+            logits_file = logits.filename if isinstance(logits, np.memmap) else None
+            logits = self.configuration_manager.resampling_fn_probabilities(
+                logits, [chunk.shape[1], *target_shape[1:]], current_spacing, properties['spacing'])
+            chunk_segmentation = self.label_manager.convert_logits_to_segmentation(logits)
+            if isinstance(chunk_segmentation, torch.Tensor):
+                chunk_segmentation = chunk_segmentation.cpu().numpy()
+            segmentation[z:z + chunk.shape[1]] = chunk_segmentation
+            del logits
+            if logits_file is not None:
+                os.remove(logits_file)
+        self.num_skipped_tiles, self.num_tiles = [num_skipped_tiles], [num_tiles]
+        return segmentation
+
+    def get_foreground_mask(self, data: torch.Tensor, properties: dict) -> Union[torch.Tensor, None]:
+        """
+        Brings the (downsampled) foreground mask computed by the preprocessor (see
+        DefaultPreprocessor.foreground_mask_threshold) to the shape of the preprocessed data. A voxel is foreground if
+        any voxel of the mask it overlaps is. Returns None if tiles are not skipped or there is no mask in properties
+        """
+        if self.tile_skip_intensity_threshold is None or properties.get('foreground_mask') is None:
+            return None
+        assert properties['foreground_mask'].ndim == len(data.shape) - 1, 'foreground mask does not match the data'
+        return torch.from_numpy(resize_foreground_mask(properties['foreground_mask'], data.shape[1:]))
+
+    def predict_logits_from_preprocessed_data(self, data: torch.Tensor,
+                                              foreground_mask: Union[torch.Tensor, None] = None) \
+            -> Union[np.ndarray, torch.Tensor]:
         """
         IMPORTANT! IF YOU ARE RUNNING THE CASCADE, THE SEGMENTATION FROM THE PREVIOUS STAGE MUST ALREADY BE STACKED ON
         TOP OF THE IMAGE AS ONE-HOT REPRESENTATION! SEE PreprocessAdapter ON HOW THIS SHOULD BE DONE!
 
         RETURNED LOGITS HAVE THE SHAPE OF THE INPUT. THEY MUST BE CONVERTED BACK TO THE ORIGINAL IMAGE SIZE.
         SEE convert_predicted_logits_to_segmentation_with_correct_shape
+
+        If the logits exceed logits_ram_budget_gb, a np.memmap is returned instead of a torch.Tensor. Whoever
+        consumes it is responsible for deleting the file
+
+        foreground_mask (bool, shape of data without the channel axis, see get_foreground_mask) is optional. Tiles
+        that do not overlap it are not predicted. The number of skipped tiles is stored in self.num_skipped_tiles
+        """
+        return self.predict_logits_from_list_of_preprocessed_data([data], [foreground_mask])[0]
+
+    def predict_logits_from_list_of_preprocessed_data(self, list_of_data: List[torch.Tensor],
+                                                      foreground_masks: List[Union[torch.Tensor, None]] = None) \
+            -> List[Union[np.ndarray, torch.Tensor]]:
         """
+        Same as predict_logits_from_preprocessed_data but for several cases at once. The sliding window tiles of all
+        cases are packed into shared batches of tile_batch_size tiles, so many small cases keep the network just as
+        busy as one large case. All accumulators are held in memory at the same time!
+        """
+        if foreground_masks is None:
+            foreground_masks = [None] * len(list_of_data)
         # we have some code duplication here but this allows us to run with perform_everything_on_gpu=True as
         # default and not have the entire program crash in case of GPU out of memory. Neat. That should make
         # things a lot faster for some datasets.
         original_perform_everything_on_gpu = self.perform_everything_on_gpu
-        with torch.no_grad():
-            prediction = None
+        with self._internal_get_grad_context():
+            predictions = None
             if self.perform_everything_on_gpu:
                 try:
-                    for params in self.list_of_parameters:
-
-                        # messing with state dict names...
-                        if not isinstance(self.network, OptimizedModule):
-                            self.network.load_state_dict(params)
-                        else:
-                            self.network._orig_mod.load_state_dict(params)
-
-                        if prediction is None:
-                            prediction = self.predict_sliding_window_return_logits(data)
-                        else:
-                            prediction += self.predict_sliding_window_return_logits(data)
-
-                    if len(self.list_of_parameters) > 1:
-                        prediction /= len(self.list_of_parameters)
-
+                    predictions = self._internal_predict_sliding_window_all_folds(list_of_data, foreground_masks)
                 except RuntimeError:
                     print('Prediction with perform_everything_on_gpu=True failed due to insufficient GPU memory. '
                           'Falling back to perform_everything_on_gpu=False. Not a big deal, just slower...')
                     print('Error:')
                     traceback.print_exc()
-                    prediction = None
+                    predictions = None
                     self.perform_everything_on_gpu = False
 
-            if prediction is None:
-                for params in self.list_of_parameters:
-                    # messing with state dict names...
-                    if not isinstance(self.network, OptimizedModule):
-                        self.network.load_state_dict(params)
-                    else:
-                        self.network._orig_mod.load_state_dict(params)
-
-                    if prediction is None:
-                        prediction = self.predict_sliding_window_return_logits(data)
-                    else:
-                        prediction += self.predict_sliding_window_return_logits(data)
-                if len(self.list_of_parameters) > 1:
-                    prediction /= len(self.list_of_parameters)
+            if predictions is None:
+                predictions = self._internal_predict_sliding_window_all_folds(list_of_data, foreground_masks)
 
             print('Prediction done, transferring to CPU if needed')
-            prediction = prediction.to('cpu')
+            predictions = [i.to('cpu') if isinstance(i, torch.Tensor) else i for i in predictions]
             self.perform_everything_on_gpu = original_perform_everything_on_gpu
+        return predictions
+
+    def _internal_predict_sliding_window_all_folds(self, list_of_data: List[torch.Tensor],
+                                                   foreground_masks: List[Union[torch.Tensor, None]]) \
+            -> List[Union[np.ndarray, torch.Tensor]]:
+        if self._internal_use_resident_networks():
+            # all folds are evaluated on each tile within a single sliding window pass
+            return self.predict_sliding_window_return_logits_multiple(list_of_data, foreground_masks)
+
+        predictions = None
+        for fold, params in enumerate(self.list_of_parameters):
+            # messing with state dict names...
+            if not isinstance(self.network, OptimizedModule):
+                self.network.load_state_dict(params)
+            else:
+                self.network._orig_mod.load_state_dict(params)
+            self._loaded_fold = fold
+
+            if predictions is None:
+                predictions = self.predict_sliding_window_return_logits_multiple(list_of_data, foreground_masks)
+            else:
+                predictions_here = self.predict_sliding_window_return_logits_multiple(list_of_data,
+                                                                                      foreground_masks)
+                for i in range(len(predictions)):
+                    predictions[i] += predictions_here[i]
+                filenames = [i.filename for i in predictions_here if isinstance(i, np.memmap)]
+                del predictions_here
+                for f in filenames:
+                    os.remove(f)
+
+        if len(self.list_of_parameters) > 1:
+            for prediction in predictions:
+                prediction /= len(self.list_of_parameters)
+        return predictions
+
+    def _internal_use_resident_networks(self) -> bool:
+        if self.list_of_parameters is None:
+            # frozen networks from initialize_from_torchscript_model_folder
+            return self._resident_networks is not None
+        return self.keep_folds_resident and len(self.list_of_parameters) > 1
+
+    def _internal_get_resident_networks(self) -> List[nn.Module]:
+        """
+        One network instance per fold, weights are loaded once and stay on self.device
+        """
+        if self._resident_networks is None:
+            base_network = self.network._orig_mod if isinstance(self.network, OptimizedModule) else self.network
+            networks = []
+            for params in self.list_of_parameters:
+                network = deepcopy(base_network)
+                network.load_state_dict(params)
+                network = network.to(self.device)
+                network.eval()
+                if self.channels_last:
+                    network = network.to(memory_format=get_memory_format(self.configuration_manager.patch_size))
+                if isinstance(self.network, OptimizedModule):
+                    network = torch.compile(network)
+                networks.append(network)
+            self._resident_networks = networks
+        return self._resident_networks
+
+    def _internal_predict_tiles(self, x: torch.Tensor) -> torch.Tensor:
+        if not self._internal_use_resident_networks():
+            return self._internal_maybe_mirror_and_predict(x)
+        networks = self._internal_get_resident_networks()
+        prediction = self._internal_maybe_mirror_and_predict(x, networks[0])
+        for network in networks[1:]:
+            prediction += self._internal_maybe_mirror_and_predict(x, network)
+        prediction /= len(networks)
         return prediction
 
+    def _internal_get_tile_batch_size(self, num_input_channels: int) -> int:
+        if self.tile_batch_memory_gb is None:
+            return self.tile_batch_size
+        bytes_per_tile = self._internal_get_activation_bytes_per_tile(num_input_channels)
+        if bytes_per_tile is None:
+            return self.tile_batch_size
+        mirror_axes = self._internal_get_mirror_axes()
+        if mirror_axes is not None and self.batched_mirroring:
+            bytes_per_tile *= 2 ** len(mirror_axes)
+        tile_batch_size = max(1, int(self.tile_batch_memory_gb * 1e9 // bytes_per_tile))
+        if self.verbose: print(f'activations need {bytes_per_tile / 1e6:.1f} MB per tile, tile_batch_memory_gb '
+                               f'{self.tile_batch_memory_gb} -> tile_batch_size {tile_batch_size}')
+        return tile_batch_size
+
+    def _internal_get_activation_bytes_per_tile(self, num_input_channels: int) -> Union[int, None]:
+        """
+        Sum of the output sizes of all leaf modules for a single tile. This is an upper bound of what the network needs
+        in inference because intermediate results are freed as soon as they are no longer needed. Measured once per
+        network with a forward pass. Returns None for networks that don't support forward hooks (TorchScript)
+        """
+        network = self._internal_get_resident_networks()[0] if self._internal_use_resident_networks() else \
+            self.network
+        key = (id(network), num_input_channels, self._internal_get_tile_size())
+        if key not in self._activation_bytes_per_tile.keys():
+            total_bytes = [0]
+
+            def hook(module, inp, out):
+                if isinstance(out, torch.Tensor):
+                    total_bytes[0] += out.numel() * out.element_size()
+
+            try:
+                handles = [m.register_forward_hook(hook) for m in network.modules() if len(list(m.children())) == 0]
+            except RuntimeError:
+                print('tile_batch_memory_gb is not supported for this network (no forward hooks). Using '
+                      'tile_batch_size instead')
+                self._activation_bytes_per_tile[key] = None
+                return None
+            x = torch.zeros((1, num_input_channels, *self._internal_get_tile_size()), device=self.device)
+            network(x)
+            for h in handles:
+                h.remove()
+            self._activation_bytes_per_tile[key] = max(total_bytes[0], 1)
+        return self._activation_bytes_per_tile[key]
+
+    def _internal_get_grad_context(self):
+        return torch.inference_mode() if self.use_inference_mode else torch.no_grad()
+
+    def _internal_get_autocast_context(self):
+        # Autocast is a little bitch.
+        # If the device_type is 'cpu' then it's slow as heck on some CPUs (no auto bfloat16 support detection)
+        # and needs to be disabled. It is only used if requested with cpu_bf16_autocast (and the CPU supports it, see
+        # __init__).
+        # If the device_type is 'mps' then it will complain that mps is not implemented, even if enabled=False
+        # is set. Whyyyyyyy. (this is why we don't make use of enabled=False)
+        if self.device.type == 'cuda':
+            return torch.autocast(self.device.type, enabled=True)
+        if self.device.type == 'cpu' and self.cpu_bf16_autocast:
+            return torch.autocast('cpu', dtype=torch.bfloat16)
+        return dummy_context()
+
+    def _internal_get_tile_size(self) -> Tuple[int, ...]:
+        if self.tile_size is None:
+            return tuple(self.configuration_manager.patch_size)
+        patch_size = self.configuration_manager.patch_size
+        assert len(self.tile_size) == len(patch_size), \
+            f'tile_size {self.tile_size} must have as many axes as the patch size {patch_size}'
+        # the input must survive all pooling operations without rounding
+        divisor = [int(i) for i in np.prod(self.configuration_manager.pool_op_kernel_sizes, axis=0)]
+        assert all([t % d == 0 for t, d in zip(self.tile_size, divisor)]), \
+            f'tile_size {self.tile_size} must be divisible by {tuple(divisor)} (total downsampling of the network)'
+        return self.tile_size
+
     def _internal_get_sliding_window_slicers(self, image_size: Tuple[int, ...]):
         slicers = []
-        if len(self.configuration_manager.patch_size) < len(image_size):
-            assert len(self.configuration_manager.patch_size) == len(
+        tile_size = self._internal_get_tile_size()
+        if len(tile_size) < len(image_size):
+            assert len(tile_size) == len(
                 image_size) - 1, 'if tile_size has less entries than image_size, ' \
                                  'len(tile_size) ' \
                                  'must be one shorter than len(image_size) ' \
                                  '(only dimension ' \
                                  'discrepancy of 1 allowed).'
-            steps = compute_steps_for_sliding_window(image_size[1:], self.configuration_manager.patch_size,
+            steps = compute_steps_for_sliding_window(image_size[1:], tile_size,
                                                      self.tile_step_size)
             if self.verbose: print(f'n_steps {image_size[0] * len(steps[0]) * len(steps[1])}, image size is'
-                                   f' {image_size}, tile_size {self.configuration_manager.patch_size}, '
+                                   f' {image_size}, tile_size {tile_size}, '
                                    f'tile_step_size {self.tile_step_size}\nsteps:\n{steps}')
             for d in range(image_size[0]):
                 for sx in steps[0]:
                     for sy in steps[1]:
                         slicers.append(
                             tuple([slice(None), d, *[slice(si, si + ti) for si, ti in
-                                                     zip((sx, sy), self.configuration_manager.patch_size)]]))
+                                                     zip((sx, sy), tile_size)]]))
         else:
-            steps = compute_steps_for_sliding_window(image_size, self.configuration_manager.patch_size,
+            steps = compute_steps_for_sliding_window(image_size, tile_size,
                                                      self.tile_step_size)
             if self.verbose: print(
-                f'n_steps {np.prod([len(i) for i in steps])}, image size is {image_size}, tile_size {self.configuration_manager.patch_size}, '
+                f'n_steps {np.prod([len(i) for i in steps])}, image size is {image_size}, tile_size {tile_size}, '
                 f'tile_step_size {self.tile_step_size}\nsteps:\n{steps}')
             for sx in steps[0]:
                 for sy in steps[1]:
                     for sz in steps[2]:
                         slicers.append(
                             tuple([slice(None), *[slice(si, si + ti) for si, ti in
-                                                  zip((sx, sy, sz), self.configuration_manager.patch_size)]]))
+                                                  zip((sx, sy, sz), tile_size)]]))
         return slicers
 
-    def _internal_maybe_mirror_and_predict(self, x: torch.Tensor) -> torch.Tensor:
-        mirror_axes = self.allowed_mirroring_axes if self.use_mirroring else None
-        prediction = self.network(x)
+    def _internal_get_mirror_axes(self) -> Union[Tuple[int, ...], None]:
+        if not self.use_mirroring or self.allowed_mirroring_axes is None:
+            return None
+        mirror_axes = tuple(self.allowed_mirroring_axes)
+        if self.mirror_axes is not None:
+            mirror_axes = tuple([i for i in mirror_axes if i in self.mirror_axes])
+        return mirror_axes if len(mirror_axes) > 0 else None
+
+    @staticmethod
+    def _internal_split_slicers_by_foreground(slicers: List[Tuple[slice, ...]], foreground_mask: torch.Tensor) \
+            -> Tuple[List[Tuple[slice, ...]], List[Tuple[slice, ...]]]:
+        keep, skip = [], []
+        for sl in slicers:
+            # first entry of the slicer is the color channel
+            if foreground_mask[sl[1:]].any():
+                keep.append(sl)
+            else:
+                skip.append(sl)
+        return keep, skip
+
+    def _internal_get_background_logits(self, tile_ndim: int, device: torch.device) -> torch.Tensor:
+        """
+        Logits that will be converted to background by label_manager.convert_logits_to_segmentation. For regions
+        (sigmoid) all channels are negative, for labels (softmax) the background channel wins by a large margin.
+        """
+        background_logits = torch.full((self.label_manager.num_segmentation_heads, *[1] * tile_ndim), -10,
+                                       dtype=torch.half, device=device)
+        if not self.label_manager.has_regions:
+            background_logits[0] = 10
+        return background_logits
+
+    def _internal_maybe_mirror_and_predict(self, x: torch.Tensor, network: nn.Module = None) -> torch.Tensor:
+        network = self.network if network is None else network
+        mirror_axes = self._internal_get_mirror_axes()
+        if mirror_axes is not None and self.batched_mirroring:
+            return self._internal_batched_mirror_and_predict(x, mirror_axes, network)
+
+        prediction = network(x)
 
         if mirror_axes is not None:
             # check for invalid numbers in mirror_axes
@@ -550,94 +1186,377 @@ class nnUNetPredictor(object):
 
             num_predictons = 2 ** len(mirror_axes)
             if 0 in mirror_axes:
-                prediction += torch.flip(self.network(torch.flip(x, (2,))), (2,))
+                prediction += torch.flip(network(torch.flip(x, (2,))), (2,))
             if 1 in mirror_axes:
-                prediction += torch.flip(self.network(torch.flip(x, (3,))), (3,))
+                prediction += torch.flip(network(torch.flip(x, (3,))), (3,))
             if 2 in mirror_axes:
-                prediction += torch.flip(self.network(torch.flip(x, (4,))), (4,))
+                prediction += torch.flip(network(torch.flip(x, (4,))), (4,))
             if 0 in mirror_axes and 1 in mirror_axes:
-                prediction += torch.flip(self.network(torch.flip(x, (2, 3))), (2, 3))
+                prediction += torch.flip(network(torch.flip(x, (2, 3))), (2, 3))
             if 0 in mirror_axes and 2 in mirror_axes:
-                prediction += torch.flip(self.network(torch.flip(x, (2, 4))), (2, 4))
+                prediction += torch.flip(network(torch.flip(x, (2, 4))), (2, 4))
             if 1 in mirror_axes and 2 in mirror_axes:
-                prediction += torch.flip(self.network(torch.flip(x, (3, 4))), (3, 4))
+                prediction += torch.flip(network(torch.flip(x, (3, 4))), (3, 4))
             if 0 in mirror_axes and 1 in mirror_axes and 2 in mirror_axes:
-                prediction += torch.flip(self.network(torch.flip(x, (2, 3, 4))), (2, 3, 4))
+                prediction += torch.flip(network(torch.flip(x, (2, 3, 4))), (2, 3, 4))
             prediction /= num_predictons
         return prediction
 
+    def _internal_batched_mirror_and_predict(self, x: torch.Tensor, mirror_axes: Tuple[int, ...],
+                                            network: nn.Module = None) -> torch.Tensor:
+        """
+        Same result as the sequential mirroring in _internal_maybe_mirror_and_predict but all flipped variants of x
+        are concatenated along the batch axis and predicted in one forward pass. Faster, but needs
+        2 ** len(mirror_axes) times the memory.
+        """
+        network = self.network if network is None else network
+        assert max(mirror_axes) <= len(x.shape) - 3, 'mirror_axes does not match the dimension of the input!'
+        # first dim of x is batch, second is color channel
+        flip_axes = [i + 2 for i in mirror_axes]
+        axes_combinations = [c for n in range(1, len(flip_axes) + 1) for c in itertools.combinations(flip_axes, n)]
+
+        b = x.shape[0]
+        prediction_all = network(torch.cat([x] + [torch.flip(x, c) for c in axes_combinations]))
+        prediction = prediction_all[:b]
+        for i, c in enumerate(axes_combinations):
+            prediction += torch.flip(prediction_all[(i + 1) * b:(i + 2) * b], c)
+        prediction /= (len(axes_combinations) + 1)
+        return prediction
+
     def predict_sliding_window_return_logits(self, input_image: torch.Tensor) \
             -> Union[np.ndarray, torch.Tensor]:
-        assert isinstance(input_image, torch.Tensor)
+        return self.predict_sliding_window_return_logits_multiple([input_image])[0]
+
+    def predict_sliding_window_return_logits_multiple(self, input_images: List[torch.Tensor],
+                                                      foreground_masks: List[Union[torch.Tensor, None]] = None) \
+            -> List[Union[np.ndarray, torch.Tensor]]:
+        assert all([isinstance(i, torch.Tensor) for i in input_images])
+        if foreground_masks is None:
+            foreground_masks = [None] * len(input_images)
+        if self.cascade_roi_margin is None or self.configuration_manager.previous_stage_name is None:
+            return self._internal_predict_sliding_window_multiple(input_images, foreground_masks)
+
+        rois = [self._internal_get_cascade_roi(i) for i in input_images]
+        to_predict = [i for i, roi in enumerate(rois) if roi is not None]
+        cropped_predictions = {}
+        num_skipped_tiles, num_tiles = [0] * len(input_images), [0] * len(input_images)
+        if len(to_predict) > 0:
+            cropped_predictions = dict(zip(to_predict, self._internal_predict_sliding_window_multiple(
+                [input_images[i][tuple([slice(None), *rois[i]])] for i in to_predict],
+                [foreground_masks[i][rois[i]] if foreground_masks[i] is not None else None for i in to_predict])))
+            for i, n_skipped, n in zip(to_predict, self.num_skipped_tiles, self.num_tiles):
+                num_skipped_tiles[i], num_tiles[i] = n_skipped, n
+        self.num_skipped_tiles, self.num_tiles = num_skipped_tiles, num_tiles
+        return [self._internal_paste_roi_logits(cropped_predictions.pop(i, None), rois[i], input_images[i].shape[1:])
+                for i in range(len(input_images))]
+
+    def _internal_get_cascade_roi(self, input_image: torch.Tensor) -> Union[Tuple[slice, ...], None]:
+        """
+        Bounding box of the foreground of the previous stage segmentation (one-hot encoded in the last channels of
+        input_image), enlarged by cascade_roi_margin and, where the image allows it, to at least the patch size.
+        Returns None if the previous stage did not find any foreground
+        """
+        num_prev_stage_channels = len(self.label_manager.foreground_labels)
+        foreground = (input_image[-num_prev_stage_channels:] > 0).any(0)
+        image_shape = foreground.shape
+        if not foreground.any():
+            print('Cascade ROI: previous stage segmentation is empty, nothing to predict')
+            return None
+
+        patch_size = [1] * (len(image_shape) - len(self._internal_get_tile_size())) + \
+                     list(self._internal_get_tile_size())
+        roi = []
+        for axis, (s, p) in enumerate(zip(image_shape, patch_size)):
+            # is there any foreground in each slice along this axis?
+            nonzero = torch.nonzero(foreground.movedim(axis, 0).flatten(1).any(1))[:, 0]
+            lb = max(0, int(nonzero[0]) - self.cascade_roi_margin)
+            ub = min(s, int(nonzero[-1]) + 1 + self.cascade_roi_margin)
+            if ub - lb < p:
+                # take some image context instead of padding with zeros
+                lb = max(0, min(lb - (p - (ub - lb)) // 2, s - p))
+                ub = min(s, lb + p)
+            roi.append(slice(lb, ub))
+        roi_fraction = np.prod([i.stop - i.start for i in roi]) / np.prod(image_shape)
+        print(f'Cascade ROI: predicting {roi_fraction * 100:.1f}% of the image')
+        return tuple(roi)
+
+    def _internal_paste_roi_logits(self, logits: Union[np.ndarray, torch.Tensor, None],
+                                   roi: Union[Tuple[slice, ...], None], image_shape: Tuple[int, ...]) \
+            -> Union[np.ndarray, torch.Tensor]:
+        """
+        Inserts the logits predicted for roi into background logits of image_shape. logits is None if there was
+        nothing to predict. If logits is a np.memmap, its file is removed
+        """
+        if roi is not None and all([sl.start == 0 and sl.stop == s for sl, s in zip(roi, image_shape)]):
+            return logits
+        if isinstance(logits, torch.Tensor):
+            results_device = logits.device
+        else:
+            results_device = self.device if self.perform_everything_on_gpu and logits is None else torch.device('cpu')
+        try:
+            predicted_logits, logits_memmap = self._internal_allocate_accumulators(image_shape, results_device)
+        except RuntimeError:
+            results_device = torch.device('cpu')
+            predicted_logits, logits_memmap = self._internal_allocate_accumulators(image_shape, results_device)
+        predicted_logits[:] = self._internal_get_background_logits(len(image_shape), results_device)
+
+        if logits is not None:
+            slicer = tuple([slice(None), *roi])
+            if isinstance(logits, np.memmap):
+                predicted_logits[slicer] = torch.from_numpy(logits)
+                filename = logits.filename
+                del logits
+                os.remove(filename)
+            else:
+                predicted_logits[slicer] = logits.to(results_device)
+                del logits
+        if logits_memmap is None:
+            return predicted_logits
+        logits_memmap.flush()
+        return logits_memmap
+
+    def _internal_predict_sliding_window_multiple(self, input_images: List[torch.Tensor],
+                                                  foreground_masks: List[Union[torch.Tensor, None]]) \
+            -> List[Union[np.ndarray, torch.Tensor]]:
+        memory_format = get_memory_format(self.configuration_manager.patch_size) if self.channels_last else \
+            torch.contiguous_format
         self.network = self.network.to(self.device)
+        if self.channels_last:
+            self.network = self.network.to(memory_format=memory_format)
         self.network.eval()
 
         empty_cache(self.device)
 
-        # Autocast is a little bitch.
-        # If the device_type is 'cpu' then it's slow as heck on some CPUs (no auto bfloat16 support detection)
-        # and needs to be disabled.
-        # If the device_type is 'mps' then it will complain that mps is not implemented, even if enabled=False
-        # is set. Whyyyyyyy. (this is why we don't make use of enabled=False)
-        # So autocast will only be active if we have a cuda device.
-        with torch.no_grad():
-            with torch.autocast(self.device.type, enabled=True) if self.device.type == 'cuda' else dummy_context():
-                assert len(input_image.shape) == 4, 'input_image must be a 4D np.ndarray or torch.Tensor (c, x, y, z)'
-
-                if self.verbose: print(f'Input shape: {input_image.shape}')
-                if self.verbose: print("step_size:", self.tile_step_size)
-                if self.verbose: print("mirror_axes:", self.allowed_mirroring_axes if self.use_mirroring else None)
-
-                # if input_image is smaller than tile_size we need to pad it to tile_size.
-                data, slicer_revert_padding = pad_nd_image(input_image, self.configuration_manager.patch_size,
-                                                           'constant', {'value': 0}, True,
-                                                           None)
-
-                slicers = self._internal_get_sliding_window_slicers(data.shape[1:])
-
-                # preallocate results and num_predictions
-                results_device = self.device if self.perform_everything_on_gpu else torch.device('cpu')
-                if self.verbose: print('preallocating arrays')
-                try:
-                    data = data.to(self.device)
-                    predicted_logits = torch.zeros((self.label_manager.num_segmentation_heads, *data.shape[1:]),
-                                                   dtype=torch.half,
-                                                   device=results_device)
-                    n_predictions = torch.zeros(data.shape[1:], dtype=torch.half,
-                                                device=results_device)
-                    if self.use_gaussian:
-                        gaussian = compute_gaussian(tuple(self.configuration_manager.patch_size), sigma_scale=1. / 8,
-                                                    value_scaling_factor=1000,
-                                                    device=results_device)
-                except RuntimeError:
-                    # sometimes the stuff is too large for GPUs. In that case fall back to CPU
-                    results_device = torch.device('cpu')
-                    data = data.to(results_device)
-                    predicted_logits = torch.zeros((self.label_manager.num_segmentation_heads, *data.shape[1:]),
-                                                   dtype=torch.half,
-                                                   device=results_device)
-                    n_predictions = torch.zeros(data.shape[1:], dtype=torch.half,
-                                                device=results_device)
-                    if self.use_gaussian:
-                        gaussian = compute_gaussian(tuple(self.configuration_manager.patch_size), sigma_scale=1. / 8,
-                                                    value_scaling_factor=1000,
-                                                    device=results_device)
-                finally:
-                    empty_cache(self.device)
-
-                if self.verbose: print('running prediction')
-                for sl in tqdm(slicers, disable=not self.allow_tqdm):
-                    workon = data[sl][None]
-                    workon = workon.to(self.device, non_blocking=False)
-
-                    prediction = self._internal_maybe_mirror_and_predict(workon)[0].to(results_device)
-
-                    predicted_logits[sl] += (prediction * gaussian if self.use_gaussian else prediction)
-                    n_predictions[sl[1:]] += (gaussian if self.use_gaussian else 1)
-
-                predicted_logits /= n_predictions
+        # see _internal_get_autocast_context for why autocast is not always used
+        with self._internal_get_grad_context():
+            with self._internal_get_autocast_context():
+                cases = [self._internal_prepare_sliding_window_case(i, m) for i, m in zip(input_images,
+                                                                                          foreground_masks)]
+                self.num_skipped_tiles = [c['num_skipped_tiles'] for c in cases]
+                self.num_tiles = [len(c['slicers']) + c['num_skipped_tiles'] for c in cases]
+
+                # tiles of all cases go into the same queue so that batches can span case boundaries
+                tiles = [(case, sl) for case in cases for sl in case['slicers']]
+                tile_batch_size = self._internal_get_tile_batch_size(cases[0]['data'].shape[0]) if len(tiles) > 0 \
+                    else self.tile_batch_size
+                if self.verbose: print(f'running prediction with tile_batch_size {tile_batch_size}')
+                if self._internal_use_tile_workers(cases, len(tiles)):
+                    if self.verbose: print(f'distributing {len(tiles)} tiles across {self.num_tile_workers} workers')
+                    use_resident_networks = self._internal_use_resident_networks()
+                    if use_resident_networks:
+                        # build them before the workers are started so that they get copies of them
+                        self._internal_get_resident_networks()
+                    self._internal_get_tile_worker_pool().predict_tiles(
+                        tiles, tile_batch_size, None if use_resident_networks else self._loaded_fold, memory_format)
+                else:
+                    with tqdm(total=len(tiles), disable=not self.allow_tqdm) as pbar:
+                        for i in range(0, len(tiles), tile_batch_size):
+                            batch_tiles = tiles[i:i + tile_batch_size]
+                            self._internal_predict_and_accumulate(batch_tiles, memory_format)
+                            pbar.update(len(batch_tiles))
+                del tiles
+
+                predictions = [self._internal_finalize_sliding_window_case(case) for case in cases]
+                del cases
         empty_cache(self.device)
-        return predicted_logits[tuple([slice(None), *slicer_revert_padding[1:]])]
+        return predictions
+
+    def _internal_predict_and_accumulate(self, batch_tiles: List[Tuple[dict, Tuple[slice, ...]]],
+                                         memory_format: torch.memory_format = torch.contiguous_format,
+                                         lock=None) -> None:
+        """
+        predicts one batch of tiles and adds the results to the accumulators of their cases. lock is held while
+        accumulating (tile workers, see tile_parallel.py)
+        """
+        with profile_span('tile_forward', device=self.device):
+            workon = torch.stack([case['data'][sl].to(self.device) for case, sl in batch_tiles])
+            if self.channels_last:
+                workon = workon.contiguous(memory_format=memory_format)
+
+            prediction = self._internal_predict_tiles(workon)
+
+        with profile_span('accumulate', device=self.device), (lock if lock is not None else dummy_context()):
+            for (case, sl), pred in zip(batch_tiles, prediction):
+                pred = pred.to(case['results_device'])
+                if case['normalization_map'] is None:
+                    # tiles do not overlap, see _internal_prepare_sliding_window_case
+                    case['predicted_logits'][sl] = pred
+                    continue
+                case['predicted_logits'][sl] += (pred * case['gaussian'] if self.use_gaussian else pred)
+
+    def _internal_get_tile_worker_pool(self) -> TileWorkerPool:
+        if self._tile_worker_pool is not None and self._tile_worker_pool.num_workers != self.num_tile_workers:
+            self.close_tile_workers()
+        if self._tile_worker_pool is None:
+            if self.verbose: print(f'starting {self.num_tile_workers} tile workers')
+            self._tile_worker_pool = TileWorkerPool(self, self.num_tile_workers)
+        return self._tile_worker_pool
+
+    def close_tile_workers(self) -> None:
+        """
+        Stops the tile worker processes (see num_tile_workers). They are started again when needed. Happens
+        automatically when the predictor is initialized with other networks
+        """
+        if self._tile_worker_pool is not None:
+            self._tile_worker_pool.close()
+            self._tile_worker_pool = None
+
+    def __getstate__(self):
+        # processes cannot be pickled. Copies of the predictor (in the tile workers) don't need them
+        state = self.__dict__.copy()
+        state['_tile_worker_pool'] = None
+        return state
+
+    def _internal_use_tile_workers(self, cases: List[dict], num_tiles: int) -> bool:
+        if self.num_tile_workers == 1 or num_tiles < 2:
+            return False
+        if self.device.type != 'cpu':
+            print('num_tile_workers is only supported for CPU inference, ignoring it')
+            return False
+        if any([case['logits_memmap'] is not None for case in cases]):
+            print('num_tile_workers cannot be combined with memory mapped logits, predicting in a single process')
+            return False
+        networks = [self.network] + (self._resident_networks if self._resident_networks is not None else [])
+        if any([isinstance(n, (OptimizedModule, torch.jit.ScriptModule)) for n in networks]):
+            # these cannot be sent to other processes
+            print('num_tile_workers does not support compiled or TorchScript networks, predicting in a single process')
+            return False
+        return True
+
+    def _internal_prepare_sliding_window_case(self, input_image: torch.Tensor,
+                                              foreground_mask: Union[torch.Tensor, None] = None) -> dict:
+        """
+        pads the image, computes the slicers and preallocates the accumulators for one case. Tiles that do not
+        overlap foreground_mask (see get_foreground_mask) are filled with background logits right away
+        """
+        assert len(input_image.shape) == 4, 'input_image must be a 4D np.ndarray or torch.Tensor (c, x, y, z)'
+
+        if self.verbose: print(f'Input shape: {input_image.shape}')
+        if self.verbose: print("step_size:", self.tile_step_size)
+        if self.verbose: print("mirror_axes:", self._internal_get_mirror_axes())
+
+        # if input_image is smaller than tile_size we need to pad it to tile_size.
+        data, slicer_revert_padding = pad_nd_image(input_image, self._internal_get_tile_size(),
+                                                   'constant', {'value': 0}, True,
+                                                   None)
+
+        slicers = self._internal_get_sliding_window_slicers(data.shape[1:])
+        # If the (padded) image is exactly one tile large in the tiled axes, each voxel is predicted exactly once. That
+        # is always the case for 2d configurations where the patch size covers the entire slice. Then there is
+        # nothing to weight or average and we skip the gaussian and the normalization altogether
+        patch_size = self._internal_get_tile_size()
+        tiles_overlap = tuple(data.shape[-len(patch_size):]) != patch_size
+        if self.verbose and not tiles_overlap: print('tiles do not overlap, skipping gaussian and normalization')
+
+        # preallocate results. The normalization map (sum of the tile weights per voxel) only depends on the shape and
+        # is cached across cases and folds
+        results_device = self.device if self.perform_everything_on_gpu else torch.device('cpu')
+        gaussian = None
+        normalization_map = None
+        if self.verbose: print('preallocating arrays')
+        try:
+            data = data.to(self.device)
+            predicted_logits, logits_memmap = self._internal_allocate_accumulators(data.shape[1:], results_device)
+            if tiles_overlap:
+                gaussian, normalization_map = self._internal_get_tile_weights(data.shape[1:], results_device)
+        except RuntimeError:
+            # sometimes the stuff is too large for GPUs. In that case fall back to CPU
+            results_device = torch.device('cpu')
+            data = data.to(results_device)
+            predicted_logits, logits_memmap = self._internal_allocate_accumulators(data.shape[1:], results_device)
+            if tiles_overlap:
+                gaussian, normalization_map = self._internal_get_tile_weights(data.shape[1:], results_device)
+        finally:
+            empty_cache(self.device)
+
+        num_skipped_tiles = 0
+        if foreground_mask is not None:
+            # padded regions are never foreground
+            padded_foreground_mask = torch.zeros(data.shape[1:], dtype=torch.bool)
+            padded_foreground_mask[tuple(slicer_revert_padding[1:])] = foreground_mask
+            slicers, skipped_slicers = self._internal_split_slicers_by_foreground(slicers, padded_foreground_mask)
+            del padded_foreground_mask
+            background_logits = self._internal_get_background_logits(
+                len(self.configuration_manager.patch_size), results_device)
+            for sl in skipped_slicers:
+                if normalization_map is None:
+                    predicted_logits[sl] = background_logits
+                    continue
+                predicted_logits[sl] += (background_logits * gaussian if self.use_gaussian else
+                                         background_logits)
+            num_skipped_tiles = len(skipped_slicers)
+
+        return {'data': data, 'slicers': slicers, 'slicer_revert_padding': slicer_revert_padding,
+                'results_device': results_device, 'predicted_logits': predicted_logits,
+                'normalization_map': normalization_map, 'logits_memmap': logits_memmap, 'gaussian': gaussian,
+                'num_skipped_tiles': num_skipped_tiles}
+
+    def _internal_get_tile_weights(self, image_shape: Tuple[int, ...], results_device: torch.device) \
+            -> Tuple[Union[torch.Tensor, None], torch.Tensor]:
+        """
+        returns the gaussian (None if not use_gaussian) and the normalization map for the tiled axes of image_shape.
+        For 2d configurations on 3d images the map covers one slice and is broadcast along the first axis
+        """
+        patch_size = self._internal_get_tile_size()
+        gaussian = compute_gaussian(patch_size, sigma_scale=1. / 8, value_scaling_factor=1000,
+                                    device=results_device) if self.use_gaussian else None
+        normalization_map = compute_sliding_window_normalization_map(
+            tuple(image_shape[-len(patch_size):]), patch_size, self.tile_step_size, self.use_gaussian, results_device)
+        return gaussian, normalization_map
+
+    def _internal_finalize_sliding_window_case(self, case: dict) -> Union[np.ndarray, torch.Tensor]:
+        predicted_logits, normalization_map, logits_memmap = \
+            case['predicted_logits'], case['normalization_map'], case['logits_memmap']
+        slicer_revert_padding = case['slicer_revert_padding']
+        case.clear()
+        if logits_memmap is None:
+            if normalization_map is not None:
+                predicted_logits /= normalization_map
+            return predicted_logits[tuple([slice(None), *slicer_revert_padding[1:]])]
+
+        if normalization_map is not None:
+            # one channel at a time so that we don't page in the entire memmap at once
+            for c in range(predicted_logits.shape[0]):
+                predicted_logits[c] /= normalization_map
+        del predicted_logits
+        return self._internal_finalize_memmap_logits(logits_memmap, slicer_revert_padding)
+
+    def _internal_allocate_accumulators(self, image_shape: Tuple[int, ...], results_device: torch.device) \
+            -> Tuple[torch.Tensor, Union[np.memmap, None]]:
+        """
+        returns predicted_logits and, if they are backed by a file, the np.memmap behind them
+        """
+        logits_shape = (self.label_manager.num_segmentation_heads, *image_shape)
+        # half precision -> 2 bytes per voxel
+        required_gb = 2 * np.prod(logits_shape, dtype=np.int64) / 1e9
+        if results_device.type == 'cpu' and self.logits_ram_budget_gb is not None and \
+                required_gb > self.logits_ram_budget_gb:
+            print(f'logits accumulator requires {required_gb:.2f} GB, which exceeds logits_ram_budget_gb '
+                  f'({self.logits_ram_budget_gb} GB). Using a memory mapped file instead')
+            logits_memmap = create_memmap_array(logits_shape, np.float16, self.memmap_folder)
+            # the torch tensor shares memory with the memmap
+            return torch.from_numpy(logits_memmap), logits_memmap
+
+        return torch.zeros(logits_shape, dtype=torch.half, device=results_device), None
+
+    def _internal_finalize_memmap_logits(self, logits_memmap: np.memmap, slicer_revert_padding: Tuple[slice, ...]) \
+            -> np.memmap:
+        """
+        removes the padding. If there is padding the cropped logits are copied into a new file (channel by channel)
+        """
+        slicer = tuple([slice(None), *slicer_revert_padding[1:]])
+        cropped_shape = logits_memmap[slicer].shape
+        if cropped_shape == logits_memmap.shape:
+            logits_memmap.flush()
+            return logits_memmap
+        cropped = create_memmap_array(cropped_shape, logits_memmap.dtype, self.memmap_folder)
+        for c in range(cropped_shape[0]):
+            cropped[c] = logits_memmap[c][slicer[1:]]
+        cropped.flush()
+        filename = logits_memmap.filename
+        del logits_memmap
+        os.remove(filename)
+        return cropped
 
 
 def predict_entry_point_modelfolder():
@@ -658,12 +1577,99 @@ def predict_entry_point_modelfolder():
     parser.add_argument('-f', nargs='+', type=str, required=False, default=(0, 1, 2, 3, 4),
                         help='Specify the folds of the trained model that should be used for prediction. '
                              'Default: (0, 1, 2, 3, 4)')
-    parser.add_argument('-step_size', type=float, required=False, default=0.5,
+    parser.add_argument('-step_size', nargs='+', type=float, required=False, default=[0.5],
                         help='Step size for sliding window prediction. The larger it is the faster but less accurate '
-                             'the prediction. Default: 0.5. Cannot be larger than 1. We recommend the default.')
+                             'the prediction. Default: 0.5. Cannot be larger than 1. We recommend the default. Can '
+                             'also be given per axis, for example 0.5 0.75 0.75.')
+    parser.add_argument('-tile_size', nargs='+', type=int, required=False, default=None,
+                        help='Sliding window tile size, for example 160 224 224. Must be divisible by the total '
+                             'downsampling of the network. Larger tiles than the training patch size are often faster '
+                             'on CPU. Use nnUNetv2_tune_tile_size to find a good value. Default: None (patch size)')
+    parser.add_argument('-tile_batch_size', type=int, required=False, default=1,
+                        help='Number of sliding window tiles that are predicted together in one forward pass. Values '
+                             '> 1 can speed up inference considerably on CPU and for small patch sizes at the cost '
+                             'of more memory. Default: 1')
+    parser.add_argument('-tile_batch_memory', type=float, required=False, default=None,
+                        help='Memory budget (in GB) for the activations of one batch of tiles. If set, the number of '
+                             'tiles per batch is chosen automatically and -tile_batch_size is ignored. Recommended '
+                             'for 2d configurations, where many slices can be predicted at once. Default: None')
     parser.add_argument('--disable_tta', action='store_true', required=False, default=False,
                         help='Set this flag to disable test time data augmentation in the form of mirroring. Faster, '
                              'but less accurate inference. Not recommended.')
+    parser.add_argument('--batched_tta', action='store_true', required=False, default=False,
+                        help='Set this flag to predict all mirrored variants of a tile in one batch instead of one '
+                             'after the other. Faster, but requires more memory.')
+    parser.add_argument('-mirror_axes', nargs='+', type=int, required=False, default=None,
+                        help='Restrict test time mirroring to these axes (must be a subset of the axes allowed '
+                             'during training, for example 0 1 2 for 3d). Default: all allowed axes')
+    parser.add_argument('--resident_folds', action='store_true', required=False, default=False,
+                        help='Set this flag to keep one network per fold in memory and run all folds on each tile in '
+                             'one sliding window pass instead of reloading the weights and repeating the sliding '
+                             'window for each fold. Faster, requires a bit more (GPU) memory.')
+    parser.add_argument('-tile_skip_threshold', type=float, required=False, default=None,
+                        help='Sliding window tiles in which no voxel of the first input channel exceeds this '
+                             'intensity (raw image units, e.g. HU for CT) are not predicted and set to background. '
+                             'For CT, -500 skips tiles that only contain air. Default: None (predict all tiles)')
+    parser.add_argument('-cascade_roi_margin', type=int, required=False, default=None,
+                        help='Cascade only (use together with -prev_stage_predictions). Only predict the bounding '
+                             'box of the foreground of the previous stage segmentation, enlarged by this many voxels '
+                             'on each side. Everything outside is set to background. Recommended: 16 or more. '
+                             'Default: None (predict the entire image)')
+    parser.add_argument('-logits_ram_budget', type=float, required=False, default=None,
+                        help='RAM budget (in GB) for the logits of a single case when they are accumulated on the '
+                             'CPU. Larger logits are stored in a memory mapped file instead (see -memmap_folder). '
+                             'Default: None (always keep logits in RAM)')
+    parser.add_argument('-memmap_folder', type=str, required=False, default=None,
+                        help='Folder for memory mapped logits. Should be on a fast local disk. Default: system temp '
+                             'dir')
+    parser.add_argument('-export_class_chunk_size', type=int, required=False, default=None,
+                        help='Resample only this many classes at a time during segmentation export and build the '
+                             'segmentation from a running argmax. Reduces the RAM of export workers for models with '
+                             'many classes. Ignored with --save_probabilities. Default: None (all classes at once)')
+    parser.add_argument('-cross_case_batch_size', type=int, required=False, default=1,
+                        help='Throughput mode for datasets with many small (2d) images. Collect this many cases and '
+                             'pack their sliding window tiles into shared batches (see -tile_batch_size / '
+                             '-tile_batch_memory). Default: 1 (one case at a time)')
+    parser.add_argument('-profile_folder', type=str, required=False, default=None,
+                        help='If set, the time spent in each stage (reading, preprocessing, tile forward passes, '
+                             'accumulation, export resampling, writing and the waits in between) is recorded per case '
+                             'and written to profile_folder/profile_report.json. Default: None (no profiling)')
+    parser.add_argument('--chrome_trace', action='store_true', required=False, default=False,
+                        help='Only with -profile_folder. Also write profile_trace.json which can be opened in '
+                             'chrome://tracing or https://ui.perfetto.dev')
+    parser.add_argument('-streaming_2d_slices', type=int, required=False, default=None,
+                        help='2d configurations on 3d images only. Predict, resample and convert this many slices at '
+                             'a time instead of holding the logits of the entire volume in memory. Ignored with '
+                             '--save_probabilities. Default: None (predict the entire volume at once)')
+    parser.add_argument('-num_tile_workers', type=int, required=False, default=1,
+                        help='CPU only. Distribute the sliding window tiles of each case across this many processes '
+                             '(each with its own copy of the network and a share of the CPU threads). Reduces the '
+                             'latency per case on many-core machines. Default: 1')
+    parser.add_argument('-preprocessing_cache_folder', type=str, required=False, default=None,
+                        help='Cache preprocessed inputs in this folder and reuse them when the same images are '
+                             'predicted again with the same preprocessing (for example with other folds, checkpoints '
+                             'or configurations). Default: None (no cache)')
+    parser.add_argument('-preprocessing_cache_size', type=float, required=False, default=50,
+                        help='Max size of the preprocessing cache in GB. Least recently used entries are removed '
+                             'first. Default: 50')
+    parser.add_argument('--shared_memory', action='store_true', required=False, default=False,
+                        help='Hand preprocessed images and predicted logits to/from the background workers through '
+                             'shared memory (/dev/shm) instead of pickling them. Saves time and RAM for large cases. '
+                             'In docker, make sure /dev/shm is large enough (--shm-size or --ipc=host).')
+    parser.add_argument('--torchscript', action='store_true', required=False, default=False,
+                        help='Use the frozen TorchScript artifacts created with nnUNetv2_export_torchscript instead of '
+                             'the checkpoints (-chk is the checkpoint they were exported from).')
+    parser.add_argument('--int8', action='store_true', required=False, default=False,
+                        help='Use the int8 TorchScript artifacts created with nnUNetv2_quantize --save_torchscript. '
+                             'CPU only.')
+    parser.add_argument('--inference_mode', action='store_true', required=False, default=False,
+                        help='Run the network in torch.inference_mode instead of torch.no_grad. Slightly faster.')
+    parser.add_argument('--channels_last', action='store_true', required=False, default=False,
+                        help='Use channels last (3d) memory format for the network and the tiles. Often faster on '
+                             'CPU.')
+    parser.add_argument('--cpu_bf16', action='store_true', required=False, default=False,
+                        help='Use bfloat16 autocast when predicting on the CPU. Only has an effect on CPUs with native '
+                             'bf16 support (AVX512-BF16, AMX). Faster, but logits can deviate slightly.')
     parser.add_argument('--verbose', action='store_true', help="Set this if you like being talked to. You will have "
                                                                "to be a good listener/reader.")
     parser.add_argument('--save_probabilities', action='store_true',
@@ -681,6 +1687,11 @@ def predict_entry_point_modelfolder():
                              'out-of-RAM issues. Default: 3')
     parser.add_argument('-prev_stage_predictions', type=str, required=False, default=None,
                         help='Folder containing the predictions of the previous stage. Required for cascaded models.')
+    parser.add_argument('-work_queue_folder', type=str, required=False, default=None,
+                        help='Distribute cases dynamically among all nnUNetv2_predict calls (processes or hosts) '
+                             'that use the same work queue folder (for example on NFS). Each call claims the next '
+                             'unprocessed case when it is ready for it and cases of crashed calls are re-queued. '
+                             'Default: None')
     parser.add_argument('-device', type=str, default='cuda', required=False,
                         help="Use this to set the device the inference should run with. Available options are 'cuda' "
                              "(GPU), 'cpu' (CPU) and 'mps' (Apple M1/M2). Do NOT use this to set which GPU ID! "
@@ -714,19 +1725,44 @@ def predict_entry_point_modelfolder():
     else:
         device = torch.device('mps')
 
-    predictor = nnUNetPredictor(tile_step_size=args.step_size,
+    predictor = nnUNetPredictor(tile_step_size=args.step_size[0] if len(args.step_size) == 1 else args.step_size,
                                 use_gaussian=True,
                                 use_mirroring=not args.disable_tta,
                                 perform_everything_on_gpu=True,
                                 device=device,
-                                verbose=args.verbose)
-    predictor.initialize_from_trained_model_folder(args.m, args.f, args.chk)
+                                verbose=args.verbose,
+                                tile_batch_size=args.tile_batch_size,
+                                tile_batch_memory_gb=args.tile_batch_memory,
+                                batched_mirroring=args.batched_tta,
+                                mirror_axes=args.mirror_axes,
+                                keep_folds_resident=args.resident_folds,
+                                tile_skip_intensity_threshold=args.tile_skip_threshold,
+                                logits_ram_budget_gb=args.logits_ram_budget,
+                                memmap_folder=args.memmap_folder,
+                                export_class_chunk_size=args.export_class_chunk_size,
+                                use_inference_mode=args.inference_mode,
+                                channels_last=args.channels_last,
+                                cpu_bf16_autocast=args.cpu_bf16,
+                                use_shared_memory=args.shared_memory,
+                                cascade_roi_margin=args.cascade_roi_margin,
+                                preprocessing_cache_folder=args.preprocessing_cache_folder,
+                                preprocessing_cache_size_gb=args.preprocessing_cache_size,
+                                num_tile_workers=args.num_tile_workers,
+                                streaming_2d_num_slices=args.streaming_2d_slices,
+                                tile_size=args.tile_size,
+                                profile_folder=args.profile_folder,
+                                profile_chrome_trace=args.chrome_trace,
+                                cross_case_batch_size=args.cross_case_batch_size)
+    if args.torchscript or args.int8:
+        predictor.initialize_from_torchscript_model_folder(args.m, args.f, args.chk, quantized=args.int8)
+    else:
+        predictor.initialize_from_trained_model_folder(args.m, args.f, args.chk)
     predictor.predict_from_files(args.i, args.o, save_probabilities=args.save_probabilities,
                                  overwrite=not args.continue_prediction,
                                  num_processes_preprocessing=args.npp,
                                  num_processes_segmentation_export=args.nps,
                                  folder_with_segs_from_prev_stage=args.prev_stage_predictions,
-                                 num_parts=1, part_id=0)
+                                 num_parts=1, part_id=0, work_queue_folder=args.work_queue_folder)
 
 
 def predict_entry_point():
@@ -754,12 +1790,99 @@ def predict_entry_point():
     parser.add_argument('-f', nargs='+', type=str, required=False, default=(0, 1, 2, 3, 4),
                         help='Specify the folds of the trained model that should be used for prediction. '
                              'Default: (0, 1, 2, 3, 4)')
-    parser.add_argument('-step_size', type=float, required=False, default=0.5,
+    parser.add_argument('-step_size', nargs='+', type=float, required=False, default=[0.5],
                         help='Step size for sliding window prediction. The larger it is the faster but less accurate '
-                             'the prediction. Default: 0.5. Cannot be larger than 1. We recommend the default.')
+                             'the prediction. Default: 0.5. Cannot be larger than 1. We recommend the default. Can '
+                             'also be given per axis, for example 0.5 0.75 0.75.')
+    parser.add_argument('-tile_size', nargs='+', type=int, required=False, default=None,
+                        help='Sliding window tile size, for example 160 224 224. Must be divisible by the total '
+                             'downsampling of the network. Larger tiles than the training patch size are often faster '
+                             'on CPU. Use nnUNetv2_tune_tile_size to find a good value. Default: None (patch size)')
+    parser.add_argument('-tile_batch_size', type=int, required=False, default=1,
+                        help='Number of sliding window tiles that are predicted together in one forward pass. Values '
+                             '> 1 can speed up inference considerably on CPU and for small patch sizes at the cost '
+                             'of more memory. Default: 1')
+    parser.add_argument('-tile_batch_memory', type=float, required=False, default=None,
+                        help='Memory budget (in GB) for the activations of one batch of tiles. If set, the number of '
+                             'tiles per batch is chosen automatically and -tile_batch_size is ignored. Recommended '
+                             'for 2d configurations, where many slices can be predicted at once. Default: None')
     parser.add_argument('--disable_tta', action='store_true', required=False, default=False,
                         help='Set this flag to disable test time data augmentation in the form of mirroring. Faster, '
                              'but less accurate inference. Not recommended.')
+    parser.add_argument('--batched_tta', action='store_true', required=False, default=False,
+                        help='Set this flag to predict all mirrored variants of a tile in one batch instead of one '
+                             'after the other. Faster, but requires more memory.')
+    parser.add_argument('-mirror_axes', nargs='+', type=int, required=False, default=None,
+                        help='Restrict test time mirroring to these axes (must be a subset of the axes allowed '
+                             'during training, for example 0 1 2 for 3d). Default: all allowed axes')
+    parser.add_argument('--resident_folds', action='store_true', required=False, default=False,
+                        help='Set this flag to keep one network per fold in memory and run all folds on each tile in '
+                             'one sliding window pass instead of reloading the weights and repeating the sliding '
+                             'window for each fold. Faster, requires a bit more (GPU) memory.')
+    parser.add_argument('-tile_skip_threshold', type=float, required=False, default=None,
+                        help='Sliding window tiles in which no voxel of the first input channel exceeds this '
+                             'intensity (raw image units, e.g. HU for CT) are not predicted and set to background. '
+                             'For CT, -500 skips tiles that only contain air. Default: None (predict all tiles)')
+    parser.add_argument('-cascade_roi_margin', type=int, required=False, default=None,
+                        help='Cascade only (use together with -prev_stage_predictions). Only predict the bounding '
+                             'box of the foreground of the previous stage segmentation, enlarged by this many voxels '
+                             'on each side. Everything outside is set to background. Recommended: 16 or more. '
+                             'Default: None (predict the entire image)')
+    parser.add_argument('-logits_ram_budget', type=float, required=False, default=None,
+                        help='RAM budget (in GB) for the logits of a single case when they are accumulated on the '
+                             'CPU. Larger logits are stored in a memory mapped file instead (see -memmap_folder). '
+                             'Default: None (always keep logits in RAM)')
+    parser.add_argument('-memmap_folder', type=str, required=False, default=None,
+                        help='Folder for memory mapped logits. Should be on a fast local disk. Default: system temp '
+                             'dir')
+    parser.add_argument('-export_class_chunk_size', type=int, required=False, default=None,
+                        help='Resample only this many classes at a time during segmentation export and build the '
+                             'segmentation from a running argmax. Reduces the RAM of export workers for models with '
+                             'many classes. Ignored with --save_probabilities. Default: None (all classes at once)')
+    parser.add_argument('-cross_case_batch_size', type=int, required=False, default=1,
+                        help='Throughput mode for datasets with many small (2d) images. Collect this many cases and '
+                             'pack their sliding window tiles into shared batches (see -tile_batch_size / '
+                             '-tile_batch_memory). Default: 1 (one case at a time)')
+    parser.add_argument('-profile_folder', type=str, required=False, default=None,
+                        help='If set, the time spent in each stage (reading, preprocessing, tile forward passes, '
+                             'accumulation, export resampling, writing and the waits in between) is recorded per case '
+                             'and written to profile_folder/profile_report.json. Default: None (no profiling)')
+    parser.add_argument('--chrome_trace', action='store_true', required=False, default=False,
+                        help='Only with -profile_folder. Also write profile_trace.json which can be opened in '
+                             'chrome://tracing or https://ui.perfetto.dev')
+    parser.add_argument('-streaming_2d_slices', type=int, required=False, default=None,
+                        help='2d configurations on 3d images only. Predict, resample and convert this many slices at '
+                             'a time instead of holding the logits of the entire volume in memory. Ignored with '
+                             '--save_probabilities. Default: None (predict the entire volume at once)')
+    parser.add_argument('-num_tile_workers', type=int, required=False, default=1,
+                        help='CPU only. Distribute the sliding window tiles of each case across this many processes '
+                             '(each with its own copy of the network and a share of the CPU threads). Reduces the '
+                             'latency per case on many-core machines. Default: 1')
+    parser.add_argument('-preprocessing_cache_folder', type=str, required=False, default=None,
+                        help='Cache preprocessed inputs in this folder and reuse them when the same images are '
+                             'predicted again with the same preprocessing (for example with other folds, checkpoints '
+                             'or configurations). Default: None (no cache)')
+    parser.add_argument('-preprocessing_cache_size', type=float, required=False, default=50,
+                        help='Max size of the preprocessing cache in GB. Least recently used entries are removed '
+                             'first. Default: 50')
+    parser.add_argument('--shared_memory', action='store_true', required=False, default=False,
+                        help='Hand preprocessed images and predicted logits to/from the background workers through '
+                             'shared memory (/dev/shm) instead of pickling them. Saves time and RAM for large cases. '
+                             'In docker, make sure /dev/shm is large enough (--shm-size or --ipc=host).')
+    parser.add_argument('--torchscript', action='store_true', required=False, default=False,
+                        help='Use the frozen TorchScript artifacts created with nnUNetv2_export_torchscript instead of '
+                             'the checkpoints (-chk is the checkpoint they were exported from).')
+    parser.add_argument('--int8', action='store_true', required=False, default=False,
+                        help='Use the int8 TorchScript artifacts created with nnUNetv2_quantize --save_torchscript. '
+                             'CPU only.')
+    parser.add_argument('--inference_mode', action='store_true', required=False, default=False,
+                        help='Run the network in torch.inference_mode instead of torch.no_grad. Slightly faster.')
+    parser.add_argument('--channels_last', action='store_true', required=False, default=False,
+                        help='Use channels last (3d) memory format for the network and the tiles. Often faster on '
+                             'CPU.')
+    parser.add_argument('--cpu_bf16', action='store_true', required=False, default=False,
+                        help='Use bfloat16 autocast when predicting on the CPU. Only has an effect on CPUs with native '
+                             'bf16 support (AVX512-BF16, AMX). Faster, but logits can deviate slightly.')
     parser.add_argument('--verbose', action='store_true', help="Set this if you like being talked to. You will have "
                                                                "to be a good listener/reader.")
     parser.add_argument('--save_probabilities', action='store_true',
@@ -777,6 +1900,11 @@ def predict_entry_point():
                              'out-of-RAM issues. Default: 3')
     parser.add_argument('-prev_stage_predictions', type=str, required=False, default=None,
                         help='Folder containing the predictions of the previous stage. Required for cascaded models.')
+    parser.add_argument('-work_queue_folder', type=str, required=False, default=None,
+                        help='Distribute cases dynamically among all nnUNetv2_predict calls (processes or hosts) '
+                             'that use the same work queue folder (for example on NFS). Each call claims the next '
+                             'unprocessed case when it is ready for it and cases of crashed calls are re-queued. '
+                             'Replaces -num_parts/-part_id. Default: None')
     parser.add_argument('-num_parts', type=int, required=False, default=1,
                         help='Number of separate nnUNetv2_predict call that you will be making. Default: 1 (= this one '
                              'call predicts everything)')
@@ -823,25 +1951,52 @@ def predict_entry_point():
     else:
         device = torch.device('mps')
 
-    predictor = nnUNetPredictor(tile_step_size=args.step_size,
+    predictor = nnUNetPredictor(tile_step_size=args.step_size[0] if len(args.step_size) == 1 else args.step_size,
                                 use_gaussian=True,
                                 use_mirroring=not args.disable_tta,
                                 perform_everything_on_gpu=True,
                                 device=device,
                                 verbose=args.verbose,
-                                verbose_preprocessing=False)
-    predictor.initialize_from_trained_model_folder(
-        model_folder,
-        args.f,
-        checkpoint_name=args.chk
-    )
+                                verbose_preprocessing=False,
+                                tile_batch_size=args.tile_batch_size,
+                                tile_batch_memory_gb=args.tile_batch_memory,
+                                batched_mirroring=args.batched_tta,
+                                mirror_axes=args.mirror_axes,
+                                keep_folds_resident=args.resident_folds,
+                                tile_skip_intensity_threshold=args.tile_skip_threshold,
+                                logits_ram_budget_gb=args.logits_ram_budget,
+                                memmap_folder=args.memmap_folder,
+                                export_class_chunk_size=args.export_class_chunk_size,
+                                use_inference_mode=args.inference_mode,
+                                channels_last=args.channels_last,
+                                cpu_bf16_autocast=args.cpu_bf16,
+                                use_shared_memory=args.shared_memory,
+                                cascade_roi_margin=args.cascade_roi_margin,
+                                preprocessing_cache_folder=args.preprocessing_cache_folder,
+                                preprocessing_cache_size_gb=args.preprocessing_cache_size,
+                                num_tile_workers=args.num_tile_workers,
+                                streaming_2d_num_slices=args.streaming_2d_slices,
+                                tile_size=args.tile_size,
+                                profile_folder=args.profile_folder,
+                                profile_chrome_trace=args.chrome_trace,
+                                cross_case_batch_size=args.cross_case_batch_size)
+    if args.torchscript or args.int8:
+        predictor.initialize_from_torchscript_model_folder(model_folder, args.f, checkpoint_name=args.chk,
+                                                           quantized=args.int8)
+    else:
+        predictor.initialize_from_trained_model_folder(
+            model_folder,
+            args.f,
+            checkpoint_name=args.chk
+        )
     predictor.predict_from_files(args.i, args.o, save_probabilities=args.save_probabilities,
                                  overwrite=not args.continue_prediction,
                                  num_processes_preprocessing=args.npp,
                                  num_processes_segmentation_export=args.nps,
                                  folder_with_segs_from_prev_stage=args.prev_stage_predictions,
                                  num_parts=args.num_parts,
-                                 part_id=args.part_id)
+                                 part_id=args.part_id,
+                                 work_queue_folder=args.work_queue_folder)
     # r = predict_from_raw_data(args.i,
     #                           args.o,
     #                           model_folder,
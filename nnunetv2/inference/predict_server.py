@@ -0,0 +1,335 @@
+import json
+import multiprocessing
+import os
+import queue
+import threading
+import traceback
+from concurrent.futures import Future, ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from time import time
+from typing import List, Union
+
+import numpy as np
+import torch
+
+from nnunetv2.inference.export_prediction import export_prediction_from_logits
+from nnunetv2.inference.predict_from_raw_data import nnUNetPredictor
+from nnunetv2.utilities.label_handling.label_handling import convert_labelmap_to_one_hot
+
+
+class nnUNetPredictionServer(object):
+    def __init__(self, predictor: nnUNetPredictor,
+                 num_threads_preprocessing: int = 2,
+                 num_processes_segmentation_export: int = 2,
+                 max_batch_size: int = 4,
+                 num_latencies_kept: int = 1000):
+        """
+        Keeps an initialized nnUNetPredictor (and a pool of export workers) alive so that individual requests do not
+        pay for imports, network instantiation, checkpoint loading and process spawning.
+
+        Requests are preprocessed in background threads as soon as they are submitted. The prediction thread takes
+        all requests whose preprocessing is done (up to max_batch_size) and predicts them together. Their sliding
+        window tiles are packed into shared batches (see nnUNetPredictor.tile_batch_size), so concurrent requests
+        share forward passes. Export is done by background processes.
+        """
+        assert predictor.plans_manager is not None, 'predictor must be initialized'
+        self.predictor = predictor
+        self.max_batch_size = max_batch_size
+        self.num_latencies_kept = num_latencies_kept
+
+        self._preprocessing_pool = ThreadPoolExecutor(num_threads_preprocessing)
+        self._export_pool = multiprocessing.get_context('spawn').Pool(num_processes_segmentation_export)
+        self._pending = queue.Queue()
+        # job taken from _pending whose preprocessing was not done yet, goes first into the next batch
+        self._deferred_job = None
+        self._stop_event = threading.Event()
+        self._lock = threading.Lock()
+
+        self._num_submitted = 0
+        self._num_completed = 0
+        self._num_failed = 0
+        self._num_exporting = 0
+        self._latencies = []
+        self._prediction_batch_sizes = []
+
+        self._prediction_thread = threading.Thread(target=self._prediction_loop, daemon=True)
+        self._prediction_thread.start()
+
+    def submit(self, input_files: List[str], output_file_truncated: str,
+               segmentation_previous_stage: Union[str, None] = None,
+               save_probabilities: bool = False) -> Future:
+        """
+        Returns a Future that resolves to a dict with 'output_file_truncated' and 'latency' (seconds) once the
+        segmentation has been written
+        """
+        job = {'input_files': input_files, 'output_file_truncated': output_file_truncated,
+               'segmentation_previous_stage': segmentation_previous_stage, 'save_probabilities': save_probabilities,
+               'submitted': time(), 'future': Future()}
+        job['preprocessed'] = self._preprocessing_pool.submit(self._preprocess, job)
+        with self._lock:
+            self._num_submitted += 1
+        self._pending.put(job)
+        return job['future']
+
+    def _preprocess(self, job: dict) -> dict:
+        predictor = self.predictor
+        preprocessor = predictor.configuration_manager.preprocessor_class(
+            verbose=predictor.verbose_preprocessing,
+            foreground_mask_threshold=predictor.tile_skip_intensity_threshold)
+        data, seg, properties = preprocessor.run_case(job['input_files'], job['segmentation_previous_stage'],
+                                                      predictor.plans_manager, predictor.configuration_manager,
+                                                      predictor.dataset_json)
+        if job['segmentation_previous_stage'] is not None:
+            seg_onehot = convert_labelmap_to_one_hot(seg[0], predictor.label_manager.foreground_labels, data.dtype)
+            data = np.vstack((data, seg_onehot))
+        return {'data': torch.from_numpy(data).contiguous().float(), 'data_properites': properties}
+
+    def _get_next_batch(self) -> List[dict]:
+        if self._deferred_job is not None:
+            batch = [self._deferred_job]
+            self._deferred_job = None
+        else:
+            try:
+                batch = [self._pending.get(timeout=0.1)]
+            except queue.Empty:
+                return []
+        # wait for the first one, then add everything that is ready to go. We don't wait for the others to not
+        # increase the latency of the first request
+        batch[0]['preprocessed'].exception()
+        while len(batch) < self.max_batch_size:
+            try:
+                job = self._pending.get_nowait()
+            except queue.Empty:
+                break
+            if not job['preprocessed'].done():
+                # keep the order of the requests: it starts the next batch
+                self._deferred_job = job
+                break
+            batch.append(job)
+        return batch
+
+    def _fail(self, job: dict, e: BaseException):
+        with self._lock:
+            self._num_failed += 1
+        job['future'].set_exception(e)
+
+    def _prediction_loop(self):
+        while not self._stop_event.is_set():
+            batch = self._get_next_batch()
+            if len(batch) == 0:
+                continue
+            ready = []
+            for job in batch:
+                # blocks if the job is still being preprocessed
+                if job['preprocessed'].exception() is not None:
+                    self._fail(job, job['preprocessed'].exception())
+                else:
+                    ready.append(job)
+            if len(ready) == 0:
+                continue
+
+            with self._lock:
+                self._prediction_batch_sizes.append(len(ready))
+                self._prediction_batch_sizes = self._prediction_batch_sizes[-self.num_latencies_kept:]
+            try:
+                preprocessed = [job['preprocessed'].result() for job in ready]
+                predictions = self.predictor.predict_logits_from_list_of_preprocessed_data(
+                    [p['data'] for p in preprocessed],
+                    [self.predictor.get_foreground_mask(p['data'], p['data_properites']) for p in preprocessed])
+                self.predictor.report_skipped_tiles(
+                    [os.path.basename(job['output_file_truncated']) for job in ready])
+            except Exception as e:
+                traceback.print_exc()
+                for job in ready:
+                    self._fail(job, e)
+                continue
+
+            for job, prediction in zip(ready, predictions):
+                properties = job['preprocessed'].result()['data_properites']
+                class_chunk_size = self.predictor.get_export_class_chunk_size(prediction, properties)
+                # memory mapped logits are handed over as file, see nnUNetPredictor.logits_ram_budget_gb
+                prediction = prediction.filename if isinstance(prediction, np.memmap) else prediction
+                with self._lock:
+                    self._num_exporting += 1
+                self._export_pool.apply_async(
+                    export_prediction_from_logits,
+                    (prediction, properties,
+                     self.predictor.configuration_manager, self.predictor.plans_manager, self.predictor.dataset_json,
+                     job['output_file_truncated'], job['save_probabilities'], class_chunk_size),
+                    callback=lambda _, j=job: self._export_done(j),
+                    error_callback=lambda e, j=job: self._export_failed(j, e)
+                )
+                # the preprocessed data is no longer needed, don't keep it around until the export is done
+                job['preprocessed'] = None
+
+    def _export_done(self, job: dict):
+        latency = time() - job['submitted']
+        with self._lock:
+            self._num_exporting -= 1
+            self._num_completed += 1
+            self._latencies.append(latency)
+            self._latencies = self._latencies[-self.num_latencies_kept:]
+        job['future'].set_result({'output_file_truncated': job['output_file_truncated'], 'latency': latency})
+
+    def _export_failed(self, job: dict, e: BaseException):
+        with self._lock:
+            self._num_exporting -= 1
+        self._fail(job, e)
+
+    def metrics(self) -> dict:
+        with self._lock:
+            latencies = np.array(self._latencies)
+            return {
+                'queue_depth': self._pending.qsize() + (0 if self._deferred_job is None else 1),
+                'num_submitted': self._num_submitted,
+                'num_completed': self._num_completed,
+                'num_failed': self._num_failed,
+                'num_exporting': self._num_exporting,
+                'latency_mean': float(np.mean(latencies)) if len(latencies) > 0 else None,
+                'latency_p50': float(np.percentile(latencies, 50)) if len(latencies) > 0 else None,
+                'latency_p95': float(np.percentile(latencies, 95)) if len(latencies) > 0 else None,
+                'latency_max': float(np.max(latencies)) if len(latencies) > 0 else None,
+                'mean_prediction_batch_size': float(np.mean(self._prediction_batch_sizes)) if
+                len(self._prediction_batch_sizes) > 0 else None,
+            }
+
+    def shutdown(self):
+        self._stop_event.set()
+        self._prediction_thread.join()
+        # jobs that never made it into a batch. Fail them, otherwise whoever waits for their future waits forever
+        unfinished = [self._deferred_job] if self._deferred_job is not None else []
+        self._deferred_job = None
+        while True:
+            try:
+                unfinished.append(self._pending.get_nowait())
+            except queue.Empty:
+                break
+        for job in unfinished:
+            self._fail(job, RuntimeError('server shutting down'))
+        self._preprocessing_pool.shutdown()
+        self._export_pool.close()
+        self._export_pool.join()
+        self.predictor.close_tile_workers()
+
+    def serve_forever(self, host: str = '127.0.0.1', port: int = 8642):
+        """
+        POST /predict with a json body {"input_files": [...], "output_file_truncated": "...",
+        "segmentation_previous_stage": null, "save_probabilities": false}. Returns once the segmentation is written.
+        GET /metrics returns queue depth, latency statistics etc. GET /health returns {"status": "ok"}
+        """
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def _send_json(self, code: int, content: dict):
+                body = json.dumps(content).encode()
+                self.send_response(code)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_GET(self):
+                if self.path == '/metrics':
+                    self._send_json(200, server.metrics())
+                elif self.path == '/health':
+                    self._send_json(200, {'status': 'ok'})
+                else:
+                    self._send_json(404, {'error': f'unknown path {self.path}'})
+
+            def do_POST(self):
+                if self.path != '/predict':
+                    self._send_json(404, {'error': f'unknown path {self.path}'})
+                    return
+                try:
+                    request = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+                    future = server.submit(request['input_files'], request['output_file_truncated'],
+                                           request.get('segmentation_previous_stage'),
+                                           request.get('save_probabilities', False))
+                except (KeyError, ValueError) as e:
+                    self._send_json(400, {'error': f'invalid request: {e}'})
+                    return
+                try:
+                    self._send_json(200, future.result())
+                except Exception as e:
+                    self._send_json(500, {'error': repr(e)})
+
+        httpd = ThreadingHTTPServer((host, port), Handler)
+        print(f'nnU-Net prediction server listening on http://{host}:{port}')
+        try:
+            httpd.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            httpd.server_close()
+            self.shutdown()
+
+
+def predict_server_entry_point():
+    import argparse
+    from nnunetv2.utilities.file_path_utilities import get_output_folder
+    parser = argparse.ArgumentParser(description='Starts a local nnU-Net prediction server that keeps the model '
+                                                 'loaded. Submit cases with POST /predict, look at GET /metrics for '
+                                                 'queue depth and latencies.')
+    parser.add_argument('-d', type=str, required=True,
+                        help='Dataset with which you would like to predict. You can specify either dataset name or id')
+    parser.add_argument('-p', type=str, required=False, default='nnUNetPlans',
+                        help='Plans identifier. Default: nnUNetPlans')
+    parser.add_argument('-tr', type=str, required=False, default='nnUNetTrainer',
+                        help='What nnU-Net trainer class was used for training? Default: nnUNetTrainer')
+    parser.add_argument('-c', type=str, required=True,
+                        help='nnU-Net configuration that should be used for prediction.')
+    parser.add_argument('-f', nargs='+', type=str, required=False, default=(0, 1, 2, 3, 4),
+                        help='Specify the folds of the trained model that should be used for prediction. '
+                             'Default: (0, 1, 2, 3, 4)')
+    parser.add_argument('-chk', type=str, required=False, default='checkpoint_final.pth',
+                        help='Name of the checkpoint you want to use. Default: checkpoint_final.pth')
+    parser.add_argument('-step_size', type=float, required=False, default=0.5,
+                        help='Step size for sliding window prediction. Default: 0.5')
+    parser.add_argument('--disable_tta', action='store_true', required=False, default=False,
+                        help='Set this flag to disable test time data augmentation in the form of mirroring.')
+    parser.add_argument('-tile_batch_size', type=int, required=False, default=4,
+                        help='Number of sliding window tiles (possibly from different requests) that are predicted '
+                             'together. Default: 4')
+    parser.add_argument('-max_batch_size', type=int, required=False, default=4,
+                        help='Maximum number of requests that are predicted together. Default: 4')
+    parser.add_argument('-npp', type=int, required=False, default=2,
+                        help='Number of threads used for preprocessing. Default: 2')
+    parser.add_argument('-nps', type=int, required=False, default=2,
+                        help='Number of processes used for segmentation export. Default: 2')
+    parser.add_argument('-host', type=str, required=False, default='127.0.0.1',
+                        help='Host to listen on. Default: 127.0.0.1 (local only)')
+    parser.add_argument('-port', type=int, required=False, default=8642,
+                        help='Port to listen on. Default: 8642')
+    parser.add_argument('-device', type=str, default='cuda', required=False,
+                        help="Use this to set the device the inference should run with. Available options are 'cuda' "
+                             "(GPU), 'cpu' (CPU) and 'mps' (Apple M1/M2).")
+    args = parser.parse_args()
+    args.f = [i if i == 'all' else int(i) for i in args.f]
+
+    assert args.device in ['cpu', 'cuda', 'mps'], f'-device must be either cpu, mps or cuda. Got: {args.device}.'
+    if args.device == 'cpu':
+        torch.set_num_threads(multiprocessing.cpu_count())
+        device = torch.device('cpu')
+    elif args.device == 'cuda':
+        torch.set_num_threads(1)
+        torch.set_num_interop_threads(1)
+        device = torch.device('cuda')
+    else:
+        device = torch.device('mps')
+
+    predictor = nnUNetPredictor(tile_step_size=args.step_size,
+                                use_gaussian=True,
+                                use_mirroring=not args.disable_tta,
+                                perform_everything_on_gpu=True,
+                                device=device,
+                                allow_tqdm=False,
+                                tile_batch_size=args.tile_batch_size,
+                                keep_folds_resident=True)
+    predictor.initialize_from_trained_model_folder(get_output_folder(args.d, args.tr, args.p, args.c), args.f,
+                                                   checkpoint_name=args.chk)
+    server = nnUNetPredictionServer(predictor, args.npp, args.nps, args.max_batch_size)
+    server.serve_forever(args.host, args.port)
+
+
+if __name__ == '__main__':
+    predict_server_entry_point()
@@ -0,0 +1,158 @@
+import hashlib
+import json
+import os
+import uuid
+from typing import Union, List, Tuple
+
+import numpy as np
+from batchgenerators.utilities.file_and_folder_operations import join, isfile, maybe_mkdir_p, load_pickle, \
+    save_pickle
+
+from nnunetv2.preprocessing.preprocessors.default_preprocessor import DefaultPreprocessor, get_preprocessing_settings
+from nnunetv2.utilities.file_hashing import update_hash_with_file
+from nnunetv2.utilities.plans_handling.plans_handler import PlansManager, ConfigurationManager
+from nnunetv2.utilities.profiling import profile_span
+
+
+class PreprocessingCache(object):
+    def __init__(self, cache_folder: str, max_size_gb: float = 50):
+        """
+        On disk cache of preprocessed inference inputs (data, seg and properties as returned by
+        DefaultPreprocessor.run_case). Useful when several configurations or checkpoints are run on the same test set.
+
+        Entries are content addressed: the key is a hash of the input files (or arrays) and of all plans,
+        configuration and dataset.json fields that influence preprocessing. Changing any of them or the images
+        results in a new key, stale entries are never returned. If the cache grows beyond max_size_gb, the least
+        recently used entries are removed.
+
+        The cache can be shared by several processes. Entries are written to a temporary file and renamed, so readers
+        never see partially written entries.
+        """
+        self.cache_folder = cache_folder
+        self.max_size_gb = max_size_gb
+        maybe_mkdir_p(cache_folder)
+
+    @staticmethod
+    def _hash_preprocessing_settings(plans_manager: PlansManager, configuration_manager: ConfigurationManager,
+                                     dataset_json: dict, hasher,
+                                     foreground_mask_threshold: Union[float, None] = None) -> None:
+        settings = get_preprocessing_settings(plans_manager, configuration_manager, dataset_json)
+        if foreground_mask_threshold is not None:
+            # the foreground mask is stored in the properties, see DefaultPreprocessor.foreground_mask_threshold
+            settings['foreground_mask_threshold'] = foreground_mask_threshold
+        hasher.update(json.dumps(settings, sort_keys=True, default=str).encode())
+
+    def get_key_fromfiles(self, files: List[str], seg_from_prev_stage_file: Union[str, None],
+                          plans_manager: PlansManager, configuration_manager: ConfigurationManager,
+                          dataset_json: dict, foreground_mask_threshold: Union[float, None] = None) -> str:
+        hasher = hashlib.sha256()
+        for f in files + ([seg_from_prev_stage_file] if seg_from_prev_stage_file is not None else []):
+            update_hash_with_file(f, hasher)
+            hasher.update(b'|')
+        self._hash_preprocessing_settings(plans_manager, configuration_manager, dataset_json, hasher,
+                                          foreground_mask_threshold)
+        return hasher.hexdigest()
+
+    def get_key_fromnpy(self, image: np.ndarray, seg_from_prev_stage: Union[np.ndarray, None], properties: dict,
+                        plans_manager: PlansManager, configuration_manager: ConfigurationManager,
+                        dataset_json: dict, foreground_mask_threshold: Union[float, None] = None) -> str:
+        hasher = hashlib.sha256()
+        for a in [image] + ([seg_from_prev_stage] if seg_from_prev_stage is not None else []):
+            a = np.ascontiguousarray(a)
+            hasher.update(f'{a.dtype}{a.shape}'.encode())
+            hasher.update(memoryview(a.reshape(-1).view(np.uint8)))
+        hasher.update(json.dumps(properties, sort_keys=True, default=str).encode())
+        self._hash_preprocessing_settings(plans_manager, configuration_manager, dataset_json, hasher,
+                                          foreground_mask_threshold)
+        return hasher.hexdigest()
+
+    def _data_file(self, key: str) -> str:
+        return join(self.cache_folder, key + '.npz')
+
+    def _properties_file(self, key: str) -> str:
+        return join(self.cache_folder, key + '.pkl')
+
+    def load(self, key: str) -> Union[Tuple[np.ndarray, np.ndarray, dict], None]:
+        data_file = self._data_file(key)
+        try:
+            properties = load_pickle(self._properties_file(key))
+            with np.load(data_file) as npz:
+                data, seg = npz['data'], npz['seg']
+            # mark as recently used
+            os.utime(data_file, None)
+        except (FileNotFoundError, EOFError):
+            # not cached or evicted by another process while we were reading it
+            return None
+        return data, seg, properties
+
+    def store(self, key: str, data: np.ndarray, seg: np.ndarray, properties: dict) -> None:
+        # the data file is written last and marks the entry as complete
+        tmp_suffix = f'.tmp_{uuid.uuid4().hex[:8]}'
+        save_pickle(properties, self._properties_file(key) + tmp_suffix)
+        os.replace(self._properties_file(key) + tmp_suffix, self._properties_file(key))
+        with open(self._data_file(key) + tmp_suffix, 'wb') as f:
+            np.savez(f, data=data, seg=seg)
+        os.replace(self._data_file(key) + tmp_suffix, self._data_file(key))
+        self.evict()
+
+    def evict(self) -> None:
+        """
+        removes the least recently used entries until the cache fits in max_size_gb
+        """
+        entries = []
+        for f in os.listdir(self.cache_folder):
+            if not f.endswith('.npz'):
+                continue
+            key = f[:-4]
+            try:
+                size = os.path.getsize(self._data_file(key))
+                size += os.path.getsize(self._properties_file(key)) if isfile(self._properties_file(key)) else 0
+                entries.append((os.path.getmtime(self._data_file(key)), size, key))
+            except FileNotFoundError:
+                continue
+        total_size = sum([i[1] for i in entries])
+        for _, size, key in sorted(entries):
+            if total_size <= self.max_size_gb * 1e9:
+                break
+            for f in (self._data_file(key), self._properties_file(key)):
+                try:
+                    os.remove(f)
+                except FileNotFoundError:
+                    pass
+            total_size -= size
+
+    def run_case(self, preprocessor: DefaultPreprocessor, files: List[str],
+                 seg_from_prev_stage_file: Union[str, None], plans_manager: PlansManager,
+                 configuration_manager: ConfigurationManager, dataset_json: dict) \
+            -> Tuple[np.ndarray, np.ndarray, dict]:
+        """
+        drop in replacement for preprocessor.run_case
+        """
+        with profile_span('preprocessing_cache_lookup'):
+            key = self.get_key_fromfiles(files, seg_from_prev_stage_file, plans_manager, configuration_manager,
+                                         dataset_json, preprocessor.foreground_mask_threshold)
+            cached = self.load(key)
+        if cached is not None:
+            return cached
+        data, seg, properties = preprocessor.run_case(files, seg_from_prev_stage_file, plans_manager,
+                                                      configuration_manager, dataset_json)
+        self.store(key, data, seg, properties)
+        return data, seg, properties
+
+    def run_case_npy(self, preprocessor: DefaultPreprocessor, image: np.ndarray,
+                     seg_from_prev_stage: Union[np.ndarray, None], properties: dict, plans_manager: PlansManager,
+                     configuration_manager: ConfigurationManager, dataset_json: dict) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        drop in replacement for preprocessor.run_case_npy. Just like the original, properties is updated in place
+        """
+        with profile_span('preprocessing_cache_lookup'):
+            key = self.get_key_fromnpy(image, seg_from_prev_stage, properties, plans_manager, configuration_manager,
+                                       dataset_json, preprocessor.foreground_mask_threshold)
+            cached = self.load(key)
+        if cached is not None:
+            properties.update(cached[2])
+            return cached[0], cached[1]
+        data, seg = preprocessor.run_case_npy(image, seg_from_prev_stage, properties, plans_manager,
+                                              configuration_manager, dataset_json)
+        self.store(key, data, seg, properties)
+        return data, seg
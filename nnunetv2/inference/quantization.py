@@ -0,0 +1,244 @@
+import json
+import warnings
+from time import time
+from typing import List, Union, Tuple
+
+import numpy as np
+import torch
+from acvl_utils.cropping_and_padding.padding import pad_nd_image
+from batchgenerators.utilities.file_and_folder_operations import load_json, join, isfile, maybe_mkdir_p, save_json
+from dynamic_network_architectures.architectures.unet import PlainConvUNet, ResidualEncoderUNet
+from torch import nn
+
+from nnunetv2.configuration import default_num_processes
+from nnunetv2.evaluation.evaluate_predictions import compute_metrics_on_folder2, load_summary_json
+from nnunetv2.inference.export_prediction import export_prediction_from_logits
+from nnunetv2.inference.export_torchscript import TORCHSCRIPT_METADATA_FILE, check_torchscript_parity, \
+    get_torchscript_filename, load_eager_network_from_checkpoint
+from nnunetv2.training.dataloading.nnunet_dataset import nnUNetDataset
+
+SUPPORTED_NETWORK_CLASSES = (PlainConvUNet, ResidualEncoderUNet)
+
+
+def get_quantization_backend() -> str:
+    supported = torch.backends.quantized.supported_engines
+    for backend in ('x86', 'fbgemm', 'qnnpack'):
+        if backend in supported:
+            return backend
+    raise RuntimeError(f'No supported quantization backend found. Available: {supported}')
+
+
+def get_calibration_tiles(list_of_data: List[Union[np.ndarray, torch.Tensor]],
+                          patch_size: Union[Tuple[int, ...], List[int]],
+                          num_tiles_per_case: int = 4, seed: int = 1234) -> torch.Tensor:
+    """
+    Samples num_tiles_per_case random tiles of patch_size from each preprocessed case (c, x, y, z). For 2d patch sizes
+    the tiles are random slices along the first spatial axis. Returns a tensor of shape (n, c, *patch_size)
+    """
+    rs = np.random.RandomState(seed)
+    tile_size = [1] * (3 - len(patch_size)) + list(patch_size)
+    tiles = []
+    for data in list_of_data:
+        if isinstance(data, np.ndarray):
+            data = torch.from_numpy(np.asarray(data))
+        data, _ = pad_nd_image(data, patch_size, 'constant', {'value': 0}, True, None)
+        for _ in range(num_tiles_per_case):
+            lb = [rs.randint(0, s - t + 1) for s, t in zip(data.shape[1:], tile_size)]
+            tile = data[tuple([slice(None), *[slice(l, l + t) for l, t in zip(lb, tile_size)]])]
+            tiles.append(tile.reshape(data.shape[0], *patch_size))
+    return torch.stack(tiles).float()
+
+
+def quantize_network_static(network: nn.Module, calibration_tiles: torch.Tensor) -> nn.Module:
+    """
+    Post training static int8 quantization (FX graph mode). Activation ranges are calibrated by running the network
+    on calibration_tiles (n, c, *patch_size). Weights are quantized per channel. The returned network runs on the CPU
+    only and takes/returns float tensors
+    """
+    from torch.ao.quantization import get_default_qconfig_mapping
+    from torch.ao.quantization.quantize_fx import prepare_fx, convert_fx
+
+    if not isinstance(network, SUPPORTED_NETWORK_CLASSES):
+        raise NotImplementedError(f'int8 quantization is only supported for '
+                                  f'{[i.__name__ for i in SUPPORTED_NETWORK_CLASSES]}, got '
+                                  f'{network.__class__.__name__}')
+    backend = get_quantization_backend()
+    torch.backends.quantized.engine = backend
+    network = network.cpu().eval()
+    with warnings.catch_warnings():
+        # torch.ao.quantization deprecation warnings
+        warnings.simplefilter("ignore")
+        with torch.no_grad():
+            prepared = prepare_fx(network, get_default_qconfig_mapping(backend), (calibration_tiles[:1],))
+            for tile in calibration_tiles:
+                prepared(tile[None])
+            quantized = convert_fx(prepared)
+    return quantized
+
+
+def save_quantized_network_as_torchscript(quantized_network: nn.Module, metadata: dict, output_file: str) -> str:
+    """
+    metadata must contain what export_torchscript.load_eager_network_from_checkpoint returns. The artifact can be
+    loaded with nnUNetPredictor.initialize_from_torchscript_model_folder(..., quantized=True)
+    """
+    input_shape = (1, metadata['num_input_channels'], *metadata['patch_size'])
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        with torch.inference_mode():
+            traced = torch.jit.trace(quantized_network, torch.randn(input_shape), check_trace=False)
+        frozen = torch.jit.freeze(traced)
+        max_abs_diff = check_torchscript_parity(quantized_network, frozen, input_shape)
+    if max_abs_diff > 1e-3:
+        raise RuntimeError(f'TorchScript export of the quantized network does not match. Max abs difference of '
+                           f'logits is {max_abs_diff}')
+    metadata = {**metadata, 'channels_last': False, 'quantized_engine': torch.backends.quantized.engine}
+    torch.jit.save(frozen, output_file, _extra_files={TORCHSCRIPT_METADATA_FILE: json.dumps(metadata)})
+    return output_file
+
+
+def _predict_and_export_cases(predictor, dataset: nnUNetDataset, keys: List[str], output_folder: str) -> float:
+    """
+    returns the mean prediction time per case (export excluded)
+    """
+    maybe_mkdir_p(output_folder)
+    times = []
+    for k in keys:
+        data, _, properties = dataset.load_case(k)
+        with warnings.catch_warnings():
+            # ignore 'The given NumPy array is not writable' warning
+            warnings.simplefilter("ignore")
+            data = torch.from_numpy(data[:])
+        start = time()
+        prediction = predictor.predict_logits_from_preprocessed_data(data)
+        times.append(time() - start)
+        export_prediction_from_logits(prediction, properties, predictor.configuration_manager,
+                                      predictor.plans_manager, predictor.dataset_json, join(output_folder, k))
+    return float(np.mean(times))
+
+
+def validate_quantized_model(model_training_output_dir: str, fold: Union[int, str],
+                             preprocessed_dataset_folder_base: str,
+                             checkpoint_name: str = 'checkpoint_final.pth',
+                             num_calibration_cases: int = 5,
+                             num_tiles_per_case: int = 4,
+                             output_folder: str = None,
+                             save_torchscript: bool = False,
+                             num_processes: int = default_num_processes,
+                             use_mirroring: bool = True) -> dict:
+    """
+    Quantizes a fold (calibrated on num_calibration_cases preprocessed training cases of that fold), predicts the
+    validation cases with the float and the int8 model and compares their Dice with compute_metrics_on_folder.
+    The report is saved as quantization_report.json in output_folder
+    (default: model_training_output_dir/fold_X/quantization_validation).
+
+    If save_torchscript is True, the quantized network is saved next to the checkpoint so that it can be used with
+    nnUNetv2_predict --int8
+    """
+    # deferred import, predict_from_raw_data imports this module
+    from nnunetv2.inference.predict_from_raw_data import nnUNetPredictor
+
+    fold = int(fold) if fold != 'all' else fold
+    if output_folder is None:
+        output_folder = join(model_training_output_dir, f'fold_{fold}', 'quantization_validation')
+    maybe_mkdir_p(output_folder)
+
+    predictors = {}
+    for name in ('float', 'int8'):
+        predictors[name] = nnUNetPredictor(use_mirroring=use_mirroring, perform_everything_on_gpu=False,
+                                           device=torch.device('cpu'), allow_tqdm=False)
+        predictors[name].initialize_from_trained_model_folder(model_training_output_dir, (fold,), checkpoint_name)
+    configuration_manager = predictors['float'].configuration_manager
+    if configuration_manager.previous_stage_name is not None:
+        raise NotImplementedError('Quantization validation is not implemented for cascaded configurations')
+
+    preprocessed_folder = join(preprocessed_dataset_folder_base, configuration_manager.data_identifier)
+    dataset = nnUNetDataset(preprocessed_folder, num_images_properties_loading_threshold=0)
+    splits_file = join(preprocessed_dataset_folder_base, 'splits_final.json')
+    if fold != 'all' and isfile(splits_file):
+        tr_keys, val_keys = load_json(splits_file)[fold]['train'], load_json(splits_file)[fold]['val']
+    else:
+        print('WARNING: no splits_final.json found (or fold is all). Calibration and validation cases overlap')
+        tr_keys = val_keys = list(dataset.keys())
+    calibration_keys = tr_keys[:num_calibration_cases]
+
+    calibration_tiles = get_calibration_tiles([dataset.load_case(k)[0][:] for k in calibration_keys],
+                                              configuration_manager.patch_size, num_tiles_per_case)
+    predictors['int8'].quantize_networks(calibration_tiles)
+    if save_torchscript:
+        _, metadata = load_eager_network_from_checkpoint(model_training_output_dir, fold, checkpoint_name)
+        metadata['checkpoint_name'] = checkpoint_name
+        artifact = save_quantized_network_as_torchscript(
+            predictors['int8'].network, metadata,
+            join(model_training_output_dir, f'fold_{fold}', get_torchscript_filename(checkpoint_name, quantized=True)))
+        print(f'saved {artifact}')
+
+    report = {'fold': fold, 'calibration_cases': calibration_keys, 'num_tiles_per_case': num_tiles_per_case,
+              'quantization_backend': torch.backends.quantized.engine, 'validation_cases': val_keys}
+    summaries = {}
+    for name, predictor in predictors.items():
+        print(f'predicting {len(val_keys)} validation cases with the {name} model')
+        pred_folder = join(output_folder, name)
+        report[f'mean_prediction_time_per_case_{name}'] = _predict_and_export_cases(predictor, dataset, val_keys,
+                                                                                    pred_folder)
+        compute_metrics_on_folder2(join(preprocessed_dataset_folder_base, 'gt_segmentations'), pred_folder,
+                                   join(model_training_output_dir, 'dataset.json'),
+                                   join(model_training_output_dir, 'plans.json'),
+                                   join(pred_folder, 'summary.json'), num_processes, chill=True)
+        summaries[name] = load_summary_json(join(pred_folder, 'summary.json'))
+
+    report['Dice'] = {}
+    for k in summaries['float']['mean'].keys():
+        dice_float = summaries['float']['mean'][k]['Dice']
+        dice_int8 = summaries['int8']['mean'][k]['Dice']
+        report['Dice'][str(k)] = {'float': dice_float, 'int8': dice_int8, 'difference': dice_int8 - dice_float}
+    report['foreground_mean_Dice'] = {'float': summaries['float']['foreground_mean']['Dice'],
+                                      'int8': summaries['int8']['foreground_mean']['Dice']}
+    report['foreground_mean_Dice']['difference'] = report['foreground_mean_Dice']['int8'] - \
+                                                   report['foreground_mean_Dice']['float']
+    save_json(report, join(output_folder, 'quantization_report.json'), sort_keys=False)
+    print(f"foreground mean Dice float: {report['foreground_mean_Dice']['float']:.4f}, "
+          f"int8: {report['foreground_mean_Dice']['int8']:.4f}")
+    return report
+
+
+def quantize_entry_point():
+    import argparse
+    from nnunetv2.paths import nnUNet_preprocessed
+    from nnunetv2.utilities.dataset_name_id_conversion import maybe_convert_to_dataset_name
+    from nnunetv2.utilities.file_path_utilities import get_output_folder
+    parser = argparse.ArgumentParser(description='Quantizes a trained fold to int8 (post training static '
+                                                 'quantization, CPU only), calibrated on preprocessed training cases. '
+                                                 'Predicts the validation cases of the fold with the float and the '
+                                                 'int8 model and writes a report comparing their Dice.')
+    parser.add_argument('-d', type=str, required=True,
+                        help='Dataset name or id')
+    parser.add_argument('-c', type=str, required=True,
+                        help='nnU-Net configuration')
+    parser.add_argument('-f', type=str, required=True,
+                        help='Fold')
+    parser.add_argument('-p', type=str, required=False, default='nnUNetPlans',
+                        help='Plans identifier. Default: nnUNetPlans')
+    parser.add_argument('-tr', type=str, required=False, default='nnUNetTrainer',
+                        help='Trainer class. Default: nnUNetTrainer')
+    parser.add_argument('-chk', type=str, required=False, default='checkpoint_final.pth',
+                        help='Name of the checkpoint. Default: checkpoint_final.pth')
+    parser.add_argument('-num_calibration_cases', type=int, required=False, default=5,
+                        help='Number of training cases used for calibration. Default: 5')
+    parser.add_argument('-tiles_per_case', type=int, required=False, default=4,
+                        help='Number of random tiles per calibration case. Default: 4')
+    parser.add_argument('-o', type=str, required=False, default=None,
+                        help='Output folder for predictions and report. Default: fold_X/quantization_validation')
+    parser.add_argument('--save_torchscript', action='store_true', required=False, default=False,
+                        help='Save the int8 network as TorchScript artifact so that it can be used with '
+                             'nnUNetv2_predict --int8')
+    parser.add_argument('--disable_tta', action='store_true', required=False, default=False,
+                        help='Disable mirroring for the validation predictions')
+    parser.add_argument('-np', type=int, required=False, default=default_num_processes,
+                        help=f'Number of processes used for computing the metrics. Default: {default_num_processes}')
+    args = parser.parse_args()
+
+    torch.set_num_threads(torch.multiprocessing.cpu_count())
+    model_folder = get_output_folder(args.d, args.tr, args.p, args.c)
+    validate_quantized_model(model_folder, args.f, join(nnUNet_preprocessed, maybe_convert_to_dataset_name(args.d)),
+                             args.chk, args.num_calibration_cases, args.tiles_per_case, args.o, args.save_torchscript,
+                             args.np, not args.disable_tta)
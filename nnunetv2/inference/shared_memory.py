@@ -0,0 +1,57 @@
+"""
+Zero copy handoff of large arrays between processes. The producer writes the array into a .npy file in shared memory
+(/dev/shm, which lives in RAM) and only sends the filename through the queue/pipe. The consumer memory maps the file
+instead of unpickling a copy.
+
+Cleanup is reference counted by the OS: on posix systems open_shared_file removes the filename right after mapping it.
+The memory is released as soon as the last mapping (the array and all tensors sharing its memory) is gone, even if the
+consumer crashes. On other systems an open file cannot be removed, so the consumer must call release_shared_file when
+it is done (this is a no-op on posix).
+
+Careful with docker: /dev/shm is only 64 MB by default there. Use --shm-size or --ipc=host
+"""
+
+import os
+from typing import Union
+
+import numpy as np
+import torch
+from batchgenerators.utilities.file_and_folder_operations import isdir, isfile
+
+from nnunetv2.inference.sliding_window_prediction import create_memmap_array
+
+
+def get_shared_memory_folder() -> Union[str, None]:
+    """
+    /dev/shm if available, else None (= system temp dir, which is usually on disk but still avoids pickling)
+    """
+    if isdir('/dev/shm') and os.access('/dev/shm', os.W_OK):
+        return '/dev/shm'
+    return None
+
+
+def array_to_shared_file(array: Union[np.ndarray, torch.Tensor], folder: str = None) -> str:
+    if isinstance(array, torch.Tensor):
+        array = array.cpu().numpy()
+    shared = create_memmap_array(array.shape, array.dtype, folder, prefix='nnunet_shm_')
+    shared[:] = array
+    shared.flush()
+    filename = shared.filename
+    del shared
+    return filename
+
+
+def open_shared_file(filename: str) -> np.memmap:
+    """
+    copy on write mapping, so the result is writable (torch.from_numpy doesn't complain) but the file is never
+    modified
+    """
+    array = np.load(filename, mmap_mode='c')
+    if os.name == 'posix':
+        os.remove(filename)
+    return array
+
+
+def release_shared_file(filename: str) -> None:
+    if isfile(filename):
+        os.remove(filename)
@@ -1,3 +1,5 @@
+import os
+import tempfile
 from functools import lru_cache
 
 import numpy as np
@@ -29,14 +31,19 @@ def compute_gaussian(tile_size: Union[Tuple[int, ...], List[int]], sigma_scale:
     return gaussian_importance_map
 
 
-def compute_steps_for_sliding_window(image_size: Tuple[int, ...], tile_size: Tuple[int, ...], tile_step_size: float) -> \
-        List[List[int]]:
+def compute_steps_for_sliding_window(image_size: Tuple[int, ...], tile_size: Tuple[int, ...],
+                                     tile_step_size: Union[float, Tuple[float, ...]]) -> List[List[int]]:
+    """
+    tile_step_size can be given per axis
+    """
     assert [i >= j for i, j in zip(image_size, tile_size)], "image size must be as large or larger than patch_size"
-    assert 0 < tile_step_size <= 1, 'step_size must be larger than 0 and smaller or equal to 1'
+    tile_step_sizes = [tile_step_size] * len(tile_size) if np.isscalar(tile_step_size) else list(tile_step_size)
+    assert len(tile_step_sizes) == len(tile_size), 'need one step size per axis of tile_size'
+    assert all([0 < i <= 1 for i in tile_step_sizes]), 'step_size must be larger than 0 and smaller or equal to 1'
 
     # our step width is patch_size*step_size at most, but can be narrower. For example if we have image size of
     # 110, patch size of 64 and step_size of 0.5, then we want to make 3 steps starting at coordinate 0, 23, 46
-    target_step_sizes_in_voxels = [i * tile_step_size for i in tile_size]
+    target_step_sizes_in_voxels = [i * j for i, j in zip(tile_size, tile_step_sizes)]
 
     num_steps = [int(np.ceil((i - k) / j)) + 1 for i, j, k in zip(image_size, target_step_sizes_in_voxels, tile_size)]
 
@@ -56,6 +63,49 @@ def compute_steps_for_sliding_window(image_size: Tuple[int, ...], tile_size: Tup
     return steps
 
 
+@lru_cache(maxsize=2)
+def compute_sliding_window_normalization_map(image_size: Tuple[int, ...], tile_size: Tuple[int, ...],
+                                             tile_step_size: Union[float, Tuple[float, ...]], use_gaussian: bool = True,
+                                             device=torch.device('cuda', 0)) -> torch.Tensor:
+    """
+    Sum of the weights (gaussian or 1) of all sliding window tiles covering each voxel of an image of image_size
+    (tiled axes only). The overlap-added logits are divided by this. It only depends on the arguments, so it is
+    computed once and reused for all cases and folds of the same shape.
+
+    The tile grid is separable, so the overlap-add is done one axis at a time: the weights are swept along axis 0,
+    the result along axis 1 and so on. This needs sum(len(steps)) instead of prod(len(steps)) additions.
+    """
+    steps = compute_steps_for_sliding_window(image_size, tile_size, tile_step_size)
+    if use_gaussian:
+        # same call (and thus same cached weights) as in nnUNetPredictor
+        weights = compute_gaussian(tuple(tile_size), sigma_scale=1. / 8, value_scaling_factor=1000,
+                                   device=device).float()
+    else:
+        weights = torch.ones(tile_size, device=device)
+    for axis, steps_here in enumerate(steps):
+        shape = list(weights.shape)
+        shape[axis] = image_size[axis]
+        summed = torch.zeros(shape, device=device)
+        for step in steps_here:
+            slicer = [slice(None)] * len(shape)
+            slicer[axis] = slice(step, step + tile_size[axis])
+            summed[tuple(slicer)] += weights
+        weights = summed
+    return weights.half()
+
+
+def create_memmap_array(shape: Tuple[int, ...], dtype=np.float16, folder: str = None,
+                        prefix: str = 'nnunet_logits_') -> np.memmap:
+    """
+    Creates a zero initialized, disk backed array (npy format, so it can later be opened with
+    np.load(filename, mmap_mode='r')). The file lives in folder (default: system temp dir) and must be removed by
+    whoever consumes it (after all references to the memmap are gone)
+    """
+    fd, filename = tempfile.mkstemp(suffix='.npy', prefix=prefix, dir=folder)
+    os.close(fd)
+    return np.lib.format.open_memmap(filename, mode='w+', dtype=dtype, shape=tuple(shape))
+
+
 if __name__ == '__main__':
     a = torch.rand((4, 2, 32, 23))
     a_npy = a.numpy()
@@ -0,0 +1,132 @@
+"""
+Tile parallel CPU inference for a single case. The sliding window tiles are split into contiguous blocks and each block
+is predicted by its own worker process. For small 3d convolutions, N processes with few threads each scale much better
+than one process with many intra-op threads.
+
+The workers are started once (TileWorkerPool, created lazily by nnUNetPredictor) and each keeps its own copy of the
+predictor and its networks. Per case they only receive their tile ranges and the input, gaussian and accumulators of
+the case. These are moved to shared memory first, so only handles go through the queues (torch.multiprocessing shares
+the storages instead of pickling them) and the workers write directly into the logits of the main process. Adding a
+tile to the accumulators is cheap compared to the forward pass and is serialized with a lock because tiles of different
+workers overlap.
+
+Workers are started with spawn, so scripts that use this must be protected with if __name__ == '__main__'.
+"""
+
+import queue
+import traceback
+from typing import List, Tuple, Union
+
+import numpy as np
+import torch
+from torch.multiprocessing import get_context
+
+from nnunetv2.utilities.profiling import flush_spans
+
+# case entries needed by nnUNetPredictor._internal_predict_and_accumulate
+_SHARED_CASE_KEYS = ('data', 'predicted_logits', 'gaussian')
+
+
+def _tile_worker_loop(predictor, task_queue, done_queue, lock, num_threads: int) -> None:
+    torch.set_num_threads(num_threads)
+    loaded_fold = None
+    while True:
+        task = task_queue.get()
+        if task is None:
+            return
+        cases, tiles, fold, tile_batch_size, memory_format = task
+        try:
+            if fold is not None and fold != loaded_fold:
+                predictor.network.load_state_dict(predictor.list_of_parameters[fold])
+                loaded_fold = fold
+            tiles = [(cases[c], sl) for c, sl in tiles]
+            with predictor._internal_get_grad_context():
+                with predictor._internal_get_autocast_context():
+                    for i in range(0, len(tiles), tile_batch_size):
+                        predictor._internal_predict_and_accumulate(tiles[i:i + tile_batch_size], memory_format, lock)
+            done_queue.put(None)
+        except Exception as e:
+            traceback.print_exc()
+            done_queue.put(repr(e))
+        finally:
+            # release the shared memory of this case
+            del cases, tiles
+            flush_spans()
+
+
+class TileWorkerPool(object):
+    def __init__(self, predictor, num_workers: int):
+        """
+        predictor is the nnUNetPredictor whose sliding window is parallelized. Each worker gets a copy of it (with
+        the networks and the weights of all folds) once, at startup. Settings of the predictor that are changed
+        afterwards are not seen by the workers. The available intra-op threads are divided among the workers
+        """
+        self.num_workers = num_workers
+        context = get_context('spawn')
+        self._lock = context.Lock()
+        self._done_queue = context.Queue()
+        self._task_queues = []
+        self._processes = []
+        num_threads = max(1, torch.get_num_threads() // num_workers)
+        for _ in range(num_workers):
+            task_queue = context.Queue()
+            pr = context.Process(target=_tile_worker_loop,
+                                 args=(predictor, task_queue, self._done_queue, self._lock, num_threads),
+                                 daemon=True)
+            pr.start()
+            self._task_queues.append(task_queue)
+            self._processes.append(pr)
+
+    def predict_tiles(self, tiles: List[Tuple[dict, Tuple[slice, ...]]], tile_batch_size: int,
+                      fold: Union[int, None], memory_format: torch.memory_format = torch.contiguous_format) -> None:
+        """
+        The case dicts in tiles must not be backed by memory mapped files. fold is the index (in
+        predictor.list_of_parameters) of the weights the workers must load first, None to use the networks as they are
+        (resident networks)
+        """
+        cases = list({id(case): case for case, _ in tiles}.values())
+        case_index = {id(case): i for i, case in enumerate(cases)}
+        shared_cases = []
+        for case in cases:
+            for k in _SHARED_CASE_KEYS:
+                if isinstance(case[k], torch.Tensor):
+                    case[k].share_memory_()
+            shared_case = {k: case[k] for k in _SHARED_CASE_KEYS}
+            shared_case['results_device'] = case['results_device']
+            # the workers only need to know whether tiles overlap, don't send the (full size) normalization map
+            shared_case['normalization_map'] = None if case['normalization_map'] is None else True
+            shared_cases.append(shared_case)
+
+        num_blocks = min(self.num_workers, len(tiles))
+        for task_queue, block in zip(self._task_queues, np.array_split(np.arange(len(tiles)), num_blocks)):
+            task_queue.put((shared_cases, [(case_index[id(tiles[i][0])], tiles[i][1]) for i in block], fold,
+                            tile_batch_size, memory_format))
+
+        errors = []
+        num_done = 0
+        while num_done < num_blocks:
+            try:
+                error = self._done_queue.get(timeout=1)
+            except queue.Empty:
+                if not all([p.is_alive() for p in self._processes]):
+                    self.close()
+                    raise RuntimeError('Tile workers died. Look for the error message further up! If there is none '
+                                       'then your RAM was full and the worker was killed by the OS. Use fewer tile '
+                                       'workers in that case!')
+                continue
+            num_done += 1
+            if error is not None:
+                errors.append(error)
+        if len(errors) > 0:
+            raise RuntimeError(f'Tile workers failed: {errors}. Look for the error message further up!')
+
+    def close(self) -> None:
+        for task_queue, p in zip(self._task_queues, self._processes):
+            if p.is_alive():
+                task_queue.put(None)
+        for p in self._processes:
+            p.join(timeout=10)
+            if p.is_alive():
+                p.terminate()
+        self._processes = []
+        self._task_queues = []
@@ -0,0 +1,149 @@
+from time import time
+from typing import Union, List, Tuple
+
+import numpy as np
+import torch
+
+from nnunetv2.inference.predict_from_raw_data import nnUNetPredictor
+from nnunetv2.utilities.label_handling.label_handling import convert_labelmap_to_one_hot
+
+
+def get_candidate_tile_sizes(predictor: nnUNetPredictor, image_shape: Tuple[int, ...],
+                             factors: Tuple[float, ...] = (1, 1.5, 2)) -> List[Tuple[int, ...]]:
+    """
+    Multiples of the patch size, rounded up to the next valid tile size (divisible by the total downsampling of the
+    network) and capped at the (equally rounded) image size so that no compute is wasted on padding
+    """
+    patch_size = predictor.configuration_manager.patch_size
+    divisor = np.prod(predictor.configuration_manager.pool_op_kernel_sizes, axis=0)
+    image_shape = image_shape[-len(patch_size):]
+    candidates = []
+    for f in factors:
+        tile_size = []
+        for p, d, s in zip(patch_size, divisor, image_shape):
+            max_size = max(p, int(np.ceil(s / d) * d))
+            tile_size.append(int(min(np.ceil(p * f / d) * d, max_size)))
+        if tuple(tile_size) not in candidates:
+            candidates.append(tuple(tile_size))
+    return candidates
+
+
+def compute_mean_dice(segmentation: np.ndarray, reference: np.ndarray) -> float:
+    """
+    mean Dice over all foreground labels that are present in either segmentation. 1 if there are none
+    """
+    labels = [i for i in np.union1d(np.unique(segmentation), np.unique(reference)) if i != 0]
+    if len(labels) == 0:
+        return 1.
+    dices = []
+    for l in labels:
+        a, b = segmentation == l, reference == l
+        dices.append(2 * np.sum(a & b) / (np.sum(a) + np.sum(b)))
+    return float(np.mean(dices))
+
+
+def _predict_segmentation(predictor: nnUNetPredictor, data: torch.Tensor) -> Tuple[np.ndarray, float]:
+    start = time()
+    logits = predictor.predict_logits_from_preprocessed_data(data)
+    elapsed = time() - start
+    segmentation = predictor.label_manager.convert_logits_to_segmentation(
+        torch.from_numpy(np.asarray(logits)) if isinstance(logits, np.ndarray) else logits)
+    if isinstance(segmentation, torch.Tensor):
+        segmentation = segmentation.cpu().numpy()
+    return segmentation, elapsed
+
+
+def tune_tile_size(predictor: nnUNetPredictor, data: torch.Tensor,
+                   candidate_tile_sizes: Union[List[Tuple[int, ...]], None] = None,
+                   candidate_step_sizes: Tuple[float, ...] = (0.5, 0.75),
+                   dice_tolerance: float = 0.01, verbose: bool = True) -> Tuple[Tuple[int, ...], float, List[dict]]:
+    """
+    Predicts one preprocessed case (data, as returned by the preprocessor) with every combination of candidate tile
+    size and step size and picks the fastest one whose segmentation deviates from the default (patch size and the
+    predictor's tile_step_size) by no more than dice_tolerance (1 - mean Dice). The result is set in predictor and
+    returned together with the measurements of all candidates.
+
+    The first prediction (the reference) also serves as warmup. Use a representative case, the timings of very small
+    cases are dominated by overhead.
+    """
+    if candidate_tile_sizes is None:
+        candidate_tile_sizes = get_candidate_tile_sizes(predictor, data.shape[1:])
+    default_tile_size = tuple(predictor.configuration_manager.patch_size)
+    default_step_size = predictor.tile_step_size
+
+    predictor.tile_size, predictor.tile_step_size = None, default_step_size
+    reference, _ = _predict_segmentation(predictor, data)
+    results = []
+    candidates = [(default_tile_size, default_step_size)] + \
+                 [(t, s) for t in candidate_tile_sizes for s in candidate_step_sizes
+                  if (tuple(t), s) != (default_tile_size, default_step_size)]
+    for tile_size, step_size in candidates:
+        predictor.tile_size, predictor.tile_step_size = tuple(tile_size), step_size
+        segmentation, elapsed = _predict_segmentation(predictor, data)
+        dice = compute_mean_dice(segmentation, reference)
+        results.append({'tile_size': tuple(tile_size), 'step_size': step_size, 'time': elapsed, 'dice': dice})
+        if verbose:
+            print(f'tile_size {tuple(tile_size)}, step_size {step_size}: {elapsed:.2f} s, Dice vs default {dice:.4f}')
+
+    valid = [r for r in results if 1 - r['dice'] <= dice_tolerance]
+    best = min(valid, key=lambda r: r['time'])
+    predictor.tile_size, predictor.tile_step_size = best['tile_size'], best['step_size']
+    if verbose:
+        print(f'fastest within Dice tolerance {dice_tolerance}: tile_size {best["tile_size"]}, step_size '
+              f'{best["step_size"]} ({results[0]["time"] / best["time"]:.2f}x faster than the default)')
+    return best['tile_size'], best['step_size'], results
+
+
+def tune_tile_size_entry_point():
+    import argparse
+    from nnunetv2.utilities.file_path_utilities import get_output_folder
+    parser = argparse.ArgumentParser(description='Benchmarks a few sliding window tile sizes and step sizes on one case '
+                                                 'and reports the fastest one that does not change the segmentation '
+                                                 'by more than the Dice tolerance. Use the result with '
+                                                 'nnUNetv2_predict -tile_size ... -step_size ...')
+    parser.add_argument('-i', nargs='+', type=str, required=True,
+                        help='Image files of one case (all channels, in the order of dataset.json)')
+    parser.add_argument('-d', type=str, required=True,
+                        help='Dataset name or id')
+    parser.add_argument('-c', type=str, required=True,
+                        help='nnU-Net configuration')
+    parser.add_argument('-p', type=str, required=False, default='nnUNetPlans',
+                        help='Plans identifier. Default: nnUNetPlans')
+    parser.add_argument('-tr', type=str, required=False, default='nnUNetTrainer',
+                        help='Trainer class. Default: nnUNetTrainer')
+    parser.add_argument('-f', nargs='+', type=str, required=False, default=(0,),
+                        help='Folds to use. Timings scale with the number of folds, so one is enough. Default: 0')
+    parser.add_argument('-chk', type=str, required=False, default='checkpoint_final.pth',
+                        help='Name of the checkpoint. Default: checkpoint_final.pth')
+    parser.add_argument('-prev_stage_seg', type=str, required=False, default=None,
+                        help='Cascade only: segmentation of this case from the previous stage')
+    parser.add_argument('-tile_sizes', nargs='+', type=str, required=False, default=None,
+                        help='Candidate tile sizes as comma separated values, for example 128,128,128 160,192,192. '
+                             'Default: 1x, 1.5x and 2x the patch size')
+    parser.add_argument('-step_sizes', nargs='+', type=float, required=False, default=(0.5, 0.75),
+                        help='Candidate step sizes. Default: 0.5 0.75')
+    parser.add_argument('-dice_tolerance', type=float, required=False, default=0.01,
+                        help='Max allowed 1 - mean Dice compared to the default settings. Default: 0.01')
+    parser.add_argument('-tile_batch_size', type=int, required=False, default=1,
+                        help='Tile batch size used for all candidates. Default: 1')
+    parser.add_argument('-device', type=str, default='cpu', required=False,
+                        help="'cuda', 'cpu' or 'mps'. Default: cpu")
+    parser.add_argument('--disable_tta', action='store_true', required=False, default=False,
+                        help='Disable test time augmentation (mirroring)')
+    args = parser.parse_args()
+
+    predictor = nnUNetPredictor(use_mirroring=not args.disable_tta, device=torch.device(args.device),
+                                tile_batch_size=args.tile_batch_size, allow_tqdm=False)
+    predictor.initialize_from_trained_model_folder(get_output_folder(args.d, args.tr, args.p, args.c),
+                                                   [i if i == 'all' else int(i) for i in args.f], args.chk)
+    preprocessor = predictor.configuration_manager.preprocessor_class()
+    data, seg, _ = preprocessor.run_case(args.i, args.prev_stage_seg, predictor.plans_manager,
+                                         predictor.configuration_manager, predictor.dataset_json)
+    if args.prev_stage_seg is not None:
+        seg_onehot = convert_labelmap_to_one_hot(seg[0], predictor.label_manager.foreground_labels, data.dtype)
+        data = np.vstack((data, seg_onehot))
+    candidate_tile_sizes = [tuple([int(j) for j in i.split(',')]) for i in args.tile_sizes] \
+        if args.tile_sizes is not None else None
+    tile_size, step_size, _ = tune_tile_size(predictor, torch.from_numpy(data).float(), candidate_tile_sizes,
+                                             tuple(args.step_sizes), args.dice_tolerance)
+    print(f'\nnnUNetv2_predict ... -tile_size {" ".join([str(i) for i in tile_size])} -step_size {step_size}')
@@ -0,0 +1,141 @@
+import os
+import socket
+import threading
+import uuid
+from time import time
+from typing import List, Union
+
+from batchgenerators.utilities.file_and_folder_operations import join, isfile, maybe_mkdir_p
+
+
+class FileLockWorkQueue(object):
+    def __init__(self, queue_folder: str, case_identifiers: List[str], stale_timeout: float = 600,
+                 worker_token: str = None):
+        """
+        Dynamic work queue for any number of nnUNetv2_predict workers (processes or hosts) that share queue_folder
+        (for example on NFS). Instead of a static split (num_parts/part_id), each worker claims the next unprocessed
+        case when it is ready for it, so one large case does not leave the others idle.
+
+        - a case is claimed by atomically creating queue_folder/CASE.lock (O_CREAT | O_EXCL). The lock contains the
+        token of the worker that claimed it
+        - each worker touches queue_folder/workers/TOKEN.alive regularly (see start_heartbeat_thread)
+        - a case is finished once queue_folder/CASE.done exists
+        - claims of workers whose heartbeat is older than stale_timeout seconds are considered crashed and are
+        re-queued. The heartbeat is compared against the local clock, so the clocks of the hosts must be in sync
+        (with a tolerance well below stale_timeout)
+
+        This object is sent to the preprocessing workers, so it must remain picklable (no threads, no open files).
+        """
+        self.queue_folder = queue_folder
+        self.case_identifiers = list(case_identifiers)
+        self.stale_timeout = stale_timeout
+        self.worker_token = worker_token if worker_token is not None else \
+            f'{socket.gethostname()}_{os.getpid()}_{uuid.uuid4().hex[:8]}'
+        maybe_mkdir_p(join(queue_folder, 'workers'))
+
+    def _lock_file(self, case_identifier: str) -> str:
+        return join(self.queue_folder, case_identifier + '.lock')
+
+    def _done_file(self, case_identifier: str) -> str:
+        return join(self.queue_folder, case_identifier + '.done')
+
+    def _alive_file(self, worker_token: str) -> str:
+        return join(self.queue_folder, 'workers', worker_token + '.alive')
+
+    def heartbeat(self) -> None:
+        alive_file = self._alive_file(self.worker_token)
+        with open(alive_file, 'a'):
+            pass
+        os.utime(alive_file, None)
+
+    def _try_create_lock(self, case_identifier: str) -> bool:
+        try:
+            fd = os.open(self._lock_file(case_identifier), os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            return False
+        with os.fdopen(fd, 'w') as f:
+            f.write(self.worker_token)
+        return True
+
+    def _get_owner_if_stale(self, case_identifier: str) -> Union[str, None]:
+        """
+        returns the token of the worker that holds the lock of case_identifier if that worker has stopped sending
+        heartbeats, None otherwise
+        """
+        lock_file = self._lock_file(case_identifier)
+        try:
+            with open(lock_file, 'r') as f:
+                owner = f.read().strip()
+            lock_age = time() - os.path.getmtime(lock_file)
+        except FileNotFoundError:
+            # lock was just released or re-queued by someone else
+            return None
+        if owner == self.worker_token:
+            return None
+        try:
+            # an empty lock means the owner died between creating the lock and writing its token
+            heartbeat_age = time() - os.path.getmtime(self._alive_file(owner)) if owner != '' else lock_age
+        except FileNotFoundError:
+            heartbeat_age = lock_age
+        return owner if heartbeat_age > self.stale_timeout else None
+
+    def _try_steal_lock(self, case_identifier: str, stale_owner: str) -> bool:
+        """
+        renaming is atomic, so only one worker can move the stale lock out of the way
+        """
+        lock_file = self._lock_file(case_identifier)
+        stale_file = lock_file + f'.stale_{self.worker_token}'
+        try:
+            os.rename(lock_file, stale_file)
+        except FileNotFoundError:
+            return False
+        with open(stale_file, 'r') as f:
+            owner = f.read().strip()
+        if owner != stale_owner:
+            # someone else re-queued and claimed it in the meantime and we just moved their fresh lock. Put it back
+            if not isfile(lock_file):
+                os.rename(stale_file, lock_file)
+            else:
+                os.remove(stale_file)
+            return False
+        os.remove(stale_file)
+        print(f'Re-queued {case_identifier}, the worker that claimed it ({stale_owner}) stopped responding')
+        return self._try_create_lock(case_identifier)
+
+    def claim_next(self) -> Union[int, None]:
+        """
+        returns the index (in case_identifiers) of the claimed case or None if there is nothing left to claim
+        """
+        for i, c in enumerate(self.case_identifiers):
+            if isfile(self._done_file(c)):
+                continue
+            if self._try_create_lock(c):
+                return i
+            stale_owner = self._get_owner_if_stale(c)
+            if stale_owner is not None and self._try_steal_lock(c, stale_owner):
+                return i
+        return None
+
+    def mark_done(self, case_identifier: str) -> None:
+        with open(self._done_file(case_identifier), 'w') as f:
+            f.write(self.worker_token)
+        try:
+            os.remove(self._lock_file(case_identifier))
+        except FileNotFoundError:
+            pass
+
+
+def start_heartbeat_thread(work_queue: FileLockWorkQueue, interval: float = 30) -> threading.Event:
+    """
+    Touches the alive file of work_queue every interval seconds until the returned event is set
+    """
+    assert interval < work_queue.stale_timeout, 'heartbeat interval must be shorter than stale_timeout'
+    stop_event = threading.Event()
+    work_queue.heartbeat()
+
+    def _run():
+        while not stop_event.wait(interval):
+            work_queue.heartbeat()
+
+    threading.Thread(target=_run, daemon=True).start()
+    return stop_event
@@ -11,7 +11,9 @@
 #    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 #    See the License for the specific language governing permissions and
 #    limitations under the License.
+import json
 import multiprocessing
+import os
 import shutil
 from time import sleep
 from typing import Union, Tuple
@@ -22,17 +24,63 @@ from batchgenerators.utilities.file_and_folder_operations import *
 from nnunetv2.paths import nnUNet_preprocessed, nnUNet_raw
 from nnunetv2.preprocessing.cropping.cropping import crop_to_nonzero
 from nnunetv2.preprocessing.resampling.default_resampling import compute_new_shape
+from nnunetv2.training.dataloading.chunked_storage import save_case_chunked, get_data_and_seg_file
+from nnunetv2.training.dataloading.utils import get_case_identifiers
 from nnunetv2.utilities.dataset_name_id_conversion import maybe_convert_to_dataset_name
+from nnunetv2.utilities.file_hashing import get_file_record, records_match
 from nnunetv2.utilities.find_class_by_name import recursive_find_python_class
 from nnunetv2.utilities.plans_handling.plans_handler import PlansManager, ConfigurationManager
+from nnunetv2.utilities.profiling import profile_span
 from nnunetv2.utilities.utils import get_identifiers_from_splitted_dataset_folder, \
     create_lists_from_splitted_dataset_folder
 from tqdm import tqdm
 
+# everything in the plans, configuration and dataset.json that influences the output of the preprocessor.
+# Architecture, patch size, batch size etc. do not matter
+PREPROCESSING_CONFIGURATION_KEYS = ('preprocessor_name', 'spacing', 'normalization_schemes', 'use_mask_for_norm',
+                                    'resampling_fn_data', 'resampling_fn_data_kwargs', 'resampling_fn_seg',
+                                    'resampling_fn_seg_kwargs')
+PREPROCESSING_PLANS_KEYS = ('transpose_forward', 'foreground_intensity_properties_per_channel', 'image_reader_writer')
+PREPROCESSING_DATASET_JSON_KEYS = ('labels', 'regions_class_order', 'channel_names', 'modality', 'file_ending',
+                                   'overwrite_image_reader_writer')
+# downsampling of the foreground mask (see DefaultPreprocessor.foreground_mask_threshold) along each axis
+FOREGROUND_MASK_DOWNSAMPLING = 4
+# written to the output directory by DefaultPreprocessor.run(incremental=True)
+PREPROCESSING_MANIFEST_FILE = 'preprocessing_manifest.json'
+
+
+def get_preprocessing_settings(plans_manager: PlansManager, configuration_manager: ConfigurationManager,
+                               dataset_json: dict) -> dict:
+    return {
+        'configuration': {k: configuration_manager.configuration.get(k) for k in PREPROCESSING_CONFIGURATION_KEYS},
+        'plans': {k: plans_manager.plans.get(k) for k in PREPROCESSING_PLANS_KEYS},
+        'dataset_json': {k: dataset_json.get(k) for k in PREPROCESSING_DATASET_JSON_KEYS},
+    }
+
+
+def resize_foreground_mask(mask: np.ndarray, new_shape: Tuple[int, ...]) -> np.ndarray:
+    """
+    Voxel i of the result is True if any voxel of mask it overlaps is. Along each axis, voxel i of the result overlaps
+    the voxels floor(i * s / n) to ceil((i + 1) * s / n) - 1 of mask (s and n are the old and new size). Going back and
+    forth never loses foreground, no matter the shapes
+    """
+    for axis, n in enumerate(new_shape):
+        s = mask.shape[axis]
+        if s == n or s == 0:
+            continue
+        first = (np.arange(n) * s) // n
+        last = (np.arange(1, n + 1) * s + n - 1) // n - 1
+        mask = np.logical_or(np.logical_or.reduceat(mask, first, axis=axis), np.take(mask, last, axis=axis))
+    return mask
+
 
 class DefaultPreprocessor(object):
-    def __init__(self, verbose: bool = True):
+    def __init__(self, verbose: bool = True, foreground_mask_threshold: Union[float, None] = None):
         self.verbose = verbose
+        # inference only. If not None, run_case_npy stores a downsampled mask of the voxels of the first channel
+        # whose raw intensity (before normalization) is above this threshold in properties['foreground_mask']. The
+        # predictor skips sliding window tiles that do not overlap it (nnUNetPredictor.tile_skip_intensity_threshold)
+        self.foreground_mask_threshold = foreground_mask_threshold
         """
         Everything we need is in the plans. Those are given when run() is called
         """
@@ -57,7 +105,8 @@ class DefaultPreprocessor(object):
         shape_before_cropping = data.shape[1:]
         properties['shape_before_cropping'] = shape_before_cropping
         # this command will generate a segmentation. This is important because of the nonzero mask which we may need
-        data, seg, bbox = crop_to_nonzero(data, seg)
+        with profile_span('crop'):
+            data, seg, bbox = crop_to_nonzero(data, seg)
         properties['bbox_used_for_cropping'] = bbox
         # print(data.shape, seg.shape)
         properties['shape_after_cropping_and_before_resampling'] = data.shape[1:]
@@ -71,17 +120,26 @@ class DefaultPreprocessor(object):
             target_spacing = [original_spacing[0]] + target_spacing
         new_shape = compute_new_shape(data.shape[1:], original_spacing, target_spacing)
 
+        if self.foreground_mask_threshold is not None:
+            # 2d configurations predict single slices, so the mask must not be downsampled along the first axis
+            mask_shape = [s if len(configuration_manager.patch_size) == 2 and axis == 0 else
+                          int(np.ceil(s / FOREGROUND_MASK_DOWNSAMPLING)) for axis, s in enumerate(data.shape[1:])]
+            properties['foreground_mask'] = resize_foreground_mask(data[0] > self.foreground_mask_threshold,
+                                                                   mask_shape)
+
         # normalize
         # normalization MUST happen before resampling or we get huge problems with resampled nonzero masks no
         # longer fitting the images perfectly!
-        data = self._normalize(data, seg, configuration_manager,
-                               plans_manager.foreground_intensity_properties_per_channel)
+        with profile_span('normalize'):
+            data = self._normalize(data, seg, configuration_manager,
+                                   plans_manager.foreground_intensity_properties_per_channel)
 
         # print('current shape', data.shape[1:], 'current_spacing', original_spacing,
         #       '\ntarget shape', new_shape, 'target_spacing', target_spacing)
         old_shape = data.shape[1:]
-        data = configuration_manager.resampling_fn_data(data, new_shape, original_spacing, target_spacing)
-        seg = configuration_manager.resampling_fn_seg(seg, new_shape, original_spacing, target_spacing)
+        with profile_span('resample'):
+            data = configuration_manager.resampling_fn_data(data, new_shape, original_spacing, target_spacing)
+            seg = configuration_manager.resampling_fn_seg(seg, new_shape, original_spacing, target_spacing)
         if self.verbose:
             print(f'old shape: {old_shape}, new_shape: {new_shape}, old_spacing: {original_spacing}, '
                   f'new_spacing: {target_spacing}, fn_data: {configuration_manager.resampling_fn_data}')
@@ -127,13 +185,14 @@ class DefaultPreprocessor(object):
         rw = plans_manager.image_reader_writer_class()
 
         # load image(s)
-        data, data_properites = rw.read_images(image_files)
+        with profile_span('read'):
+            data, data_properites = rw.read_images(image_files)
 
-        # if possible, load seg
-        if seg_file is not None:
-            seg, _ = rw.read_seg(seg_file)
-        else:
-            seg = None
+            # if possible, load seg
+            if seg_file is not None:
+                seg, _ = rw.read_seg(seg_file)
+            else:
+                seg = None
 
         data, seg = self.run_case_npy(data, seg, data_properites, plans_manager, configuration_manager,
                                       dataset_json)
@@ -141,10 +200,17 @@ class DefaultPreprocessor(object):
 
     def run_case_save(self, output_filename_truncated: str, image_files: List[str], seg_file: str,
                       plans_manager: PlansManager, configuration_manager: ConfigurationManager,
-                      dataset_json: Union[dict, str]):
+                      dataset_json: Union[dict, str], chunked_storage: bool = False):
+        """
+        chunked_storage: save data and seg as chunked blosc2 arrays (.b2nd, see chunked_storage.py) instead of npz.
+        Patches can be read from these without unpacking the dataset first
+        """
         data, seg, properties = self.run_case(image_files, seg_file, plans_manager, configuration_manager, dataset_json)
         # print('dtypes', data.dtype, seg.dtype)
-        np.savez_compressed(output_filename_truncated + '.npz', data=data, seg=seg)
+        if chunked_storage:
+            save_case_chunked(data, seg, output_filename_truncated, configuration_manager.patch_size)
+        else:
+            np.savez_compressed(output_filename_truncated + '.npz', data=data, seg=seg)
         write_pickle(properties, output_filename_truncated + '.pkl')
 
     @staticmethod
@@ -191,9 +257,17 @@ class DefaultPreprocessor(object):
         return data
 
     def run(self, dataset_name_or_id: Union[int, str], configuration_name: str, plans_identifier: str,
-            num_processes: int):
+            num_processes: int, chunked_storage: bool = False, incremental: bool = False):
         """
         data identifier = configuration name in plans. EZ.
+
+        chunked_storage: see run_case_save
+
+        incremental: instead of deleting the output directory and preprocessing everything, only preprocess cases that
+        are new, whose input files have changed or whose outputs are missing, and delete the outputs of cases that are
+        no longer in the dataset. The input files (hashes) and the preprocessing relevant fields of plans and
+        dataset.json are recorded in PREPROCESSING_MANIFEST_FILE in the output directory. If these fields have
+        changed, all cases are preprocessed again
         """
         dataset_name = maybe_convert_to_dataset_name(dataset_name_or_id)
 
@@ -218,7 +292,7 @@ class DefaultPreprocessor(object):
                                                                dataset_json['file_ending'])
         output_directory = join(nnUNet_preprocessed, dataset_name, configuration_manager.data_identifier)
 
-        if isdir(output_directory):
+        if isdir(output_directory) and not incremental:
             shutil.rmtree(output_directory)
 
         maybe_mkdir_p(output_directory)
@@ -232,27 +306,110 @@ class DefaultPreprocessor(object):
         # list of segmentation filenames
         seg_fnames = [join(nnUNet_raw, dataset_name, 'labelsTr', i + file_ending) for i in identifiers]
 
+        if incremental:
+            settings = get_preprocessing_settings(plans_manager, configuration_manager, dataset_json)
+            settings['chunked_storage'] = chunked_storage
+            todo, manifest, input_records = self._prepare_incremental_run(
+                output_directory, join(nnUNet_raw, dataset_name), identifiers,
+                [i + [j] for i, j in zip(image_fnames, seg_fnames)], settings)
+            print(f'Incremental preprocessing: {len(todo)} of {len(identifiers)} cases need to be preprocessed')
+        else:
+            todo = list(range(len(identifiers)))
+
         # multiprocessing magic.
-        r = []
-        with multiprocessing.get_context("spawn").Pool(num_processes) as p:
-            for outfile, infiles, segfiles in zip(output_filenames_truncated, image_fnames, seg_fnames):
-                r.append(p.starmap_async(self.run_case_save,
-                                         ((outfile, infiles, segfiles, plans_manager, configuration_manager,
-                                           dataset_json),)))
-            remaining = list(range(len(output_filenames_truncated)))
-            # p is pretty nifti. If we kill workers they just respawn but don't do any work.
-            # So we need to store the original pool of workers.
-            workers = [j for j in p._pool]
-            with tqdm(desc=None, total=len(output_filenames_truncated), disable=self.verbose) as pbar:
-                while len(remaining) > 0:
-                    all_alive = all([j.is_alive() for j in workers])
-                    if not all_alive:
-                        raise RuntimeError('Some background worker is 6 feet under. Yuck.')
-                    done = [i for i in remaining if r[i].ready()]
-                    for _ in done:
-                        pbar.update()
-                    remaining = [i for i in remaining if i not in done]
-                    sleep(0.1)
+        r = {}
+        try:
+            with multiprocessing.get_context("spawn").Pool(num_processes) as p:
+                for i in todo:
+                    r[i] = p.starmap_async(self.run_case_save,
+                                           ((output_filenames_truncated[i], image_fnames[i], seg_fnames[i],
+                                             plans_manager, configuration_manager, dataset_json, chunked_storage),))
+                remaining = list(todo)
+                # p is pretty nifti. If we kill workers they just respawn but don't do any work.
+                # So we need to store the original pool of workers.
+                workers = [j for j in p._pool]
+                with tqdm(desc=None, total=len(todo), disable=self.verbose) as pbar:
+                    while len(remaining) > 0:
+                        all_alive = all([j.is_alive() for j in workers])
+                        if not all_alive:
+                            raise RuntimeError('Some background worker is 6 feet under. Yuck.')
+                        done = [i for i in remaining if r[i].ready()]
+                        for i in done:
+                            pbar.update()
+                            if incremental and r[i].successful():
+                                manifest['cases'][identifiers[i]] = {'files': input_records[i]}
+                        remaining = [i for i in remaining if i not in done]
+                        sleep(0.1)
+        finally:
+            # also when interrupted, so that the cases that are done don't have to be preprocessed again
+            if incremental:
+                self._save_manifest(manifest, join(output_directory, PREPROCESSING_MANIFEST_FILE))
+
+    @staticmethod
+    def _get_output_files(output_filename_truncated: str) -> List[str]:
+        """
+        everything run_case_save (in either storage format) and unpack_dataset may have written for a case
+        """
+        return [output_filename_truncated + i for i in ('.npz', '.npy', '_seg.npy', '.pkl')] + \
+            list(get_data_and_seg_file(output_filename_truncated))
+
+    @staticmethod
+    def _save_manifest(manifest: dict, manifest_file: str) -> None:
+        # write and rename, an interrupted write must not leave a broken manifest behind
+        save_json(manifest, manifest_file + '.tmp', sort_keys=False)
+        os.replace(manifest_file + '.tmp', manifest_file)
+
+    def _prepare_incremental_run(self, output_directory: str, raw_dataset_folder: str, identifiers: List[str],
+                                 input_files: List[List[str]], settings: dict) \
+            -> Tuple[List[int], dict, List[dict]]:
+        """
+        Compares the input files of all cases and the preprocessing settings with the manifest of the last run.
+        Deletes the outputs of cases that need to be preprocessed (stale unpacked .npy files would otherwise survive)
+        and of cases that no longer exist. Returns the indices of the cases that need to be preprocessed, the new
+        manifest (containing only the up to date cases so far) and the file records of each case
+        """
+        manifest_file = join(output_directory, PREPROCESSING_MANIFEST_FILE)
+        # round trip through json so that tuples vs lists etc. don't make settings appear different
+        settings = json.loads(json.dumps(settings, default=str))
+        previous = load_json(manifest_file) if isfile(manifest_file) else None
+        if previous is not None and previous['settings'] != settings:
+            print('Incremental preprocessing: preprocessing settings changed since the last run, all cases will be '
+                  'preprocessed again')
+        previous_cases = previous['cases'] if previous is not None and previous['settings'] == settings else {}
+        manifest = {'settings': settings, 'cases': {}}
+
+        todo, input_records = [], []
+        for i, (identifier, files) in enumerate(zip(identifiers, input_files)):
+            previous_records = previous_cases[identifier]['files'] if identifier in previous_cases.keys() else {}
+            # relative paths, so that the raw data can be moved
+            records = {}
+            for f in files:
+                k = os.path.relpath(f, raw_dataset_folder)
+                records[k] = get_file_record(f, previous_records.get(k))
+            input_records.append(records)
+
+            output_filename_truncated = join(output_directory, identifier)
+            data_file = get_data_and_seg_file(output_filename_truncated)[0] if settings['chunked_storage'] else \
+                output_filename_truncated + '.npz'
+            up_to_date = set(records.keys()) == set(previous_records.keys()) and \
+                all([records_match(records[k], previous_records[k]) for k in records.keys()]) and \
+                isfile(data_file) and isfile(output_filename_truncated + '.pkl')
+            if up_to_date:
+                manifest['cases'][identifier] = {'files': records}
+            else:
+                todo.append(i)
+                for f in self._get_output_files(output_filename_truncated):
+                    if isfile(f):
+                        os.remove(f)
+
+        removed = (set(get_case_identifiers(output_directory)) | set(previous_cases.keys())) - set(identifiers)
+        if len(removed) > 0:
+            print(f'Incremental preprocessing: removing {len(removed)} cases that are no longer in the dataset')
+        for identifier in removed:
+            for f in self._get_output_files(join(output_directory, identifier)):
+                if isfile(f):
+                    os.remove(f)
+        return todo, manifest, input_records
 
     def modify_seg_fn(self, seg: np.ndarray, plans_manager: PlansManager, dataset_json: dict,
                       configuration_manager: ConfigurationManager) -> np.ndarray:
@@ -2,12 +2,12 @@ from collections import OrderedDict
 from typing import Union, Tuple, List
 
 import numpy as np
-import pandas as pd
 import torch
-from batchgenerators.augmentations.utils import resize_segmentation
 from scipy.ndimage.interpolation import map_coordinates
 from skimage.transform import resize
 from nnunetv2.configuration import ANISO_THRESHOLD
+from nnunetv2.preprocessing.resampling.segmentation_resampling import resize_segmentation_bbox, \
+    resize_segmentation_along_axis_bbox
 
 
 def get_do_separate_z(spacing: Union[Tuple[float, ...], List[float], np.ndarray], anisotropy_threshold=ANISO_THRESHOLD):
@@ -29,13 +29,11 @@ def compute_new_shape(old_shape: Union[Tuple[int, ...], List[int], np.ndarray],
     return new_shape
 
 
-def resample_data_or_seg_to_spacing(data: np.ndarray,
-                                    current_spacing: Union[Tuple[float, ...], List[float], np.ndarray],
-                                    new_spacing: Union[Tuple[float, ...], List[float], np.ndarray],
-                                    is_seg: bool = False,
-                                    order: int = 3, order_z: int = 0,
-                                    force_separate_z: Union[bool, None] = False,
-                                    separate_z_anisotropy_threshold: float = ANISO_THRESHOLD):
+def determine_do_sep_z_and_axis(force_separate_z: Union[bool, None],
+                                current_spacing: Union[Tuple[float, ...], List[float], np.ndarray],
+                                new_spacing: Union[Tuple[float, ...], List[float], np.ndarray],
+                                separate_z_anisotropy_threshold: float = ANISO_THRESHOLD) \
+        -> Tuple[bool, Union[np.ndarray, None]]:
     if force_separate_z is not None:
         do_separate_z = force_separate_z
         if force_separate_z:
@@ -63,6 +61,18 @@ def resample_data_or_seg_to_spacing(data: np.ndarray,
             do_separate_z = False
         else:
             pass
+    return do_separate_z, axis
+
+
+def resample_data_or_seg_to_spacing(data: np.ndarray,
+                                    current_spacing: Union[Tuple[float, ...], List[float], np.ndarray],
+                                    new_spacing: Union[Tuple[float, ...], List[float], np.ndarray],
+                                    is_seg: bool = False,
+                                    order: int = 3, order_z: int = 0,
+                                    force_separate_z: Union[bool, None] = False,
+                                    separate_z_anisotropy_threshold: float = ANISO_THRESHOLD):
+    do_separate_z, axis = determine_do_sep_z_and_axis(force_separate_z, current_spacing, new_spacing,
+                                                      separate_z_anisotropy_threshold)
 
     if data is not None:
         assert len(data.shape) == 4, "data must be c x y z"
@@ -87,33 +97,8 @@ def resample_data_or_seg_to_shape(data: Union[torch.Tensor, np.ndarray],
     """
     if isinstance(data, torch.Tensor):
         data = data.cpu().numpy()
-    if force_separate_z is not None:
-        do_separate_z = force_separate_z
-        if force_separate_z:
-            axis = get_lowres_axis(current_spacing)
-        else:
-            axis = None
-    else:
-        if get_do_separate_z(current_spacing, separate_z_anisotropy_threshold):
-            do_separate_z = True
-            axis = get_lowres_axis(current_spacing)
-        elif get_do_separate_z(new_spacing, separate_z_anisotropy_threshold):
-            do_separate_z = True
-            axis = get_lowres_axis(new_spacing)
-        else:
-            do_separate_z = False
-            axis = None
-
-    if axis is not None:
-        if len(axis) == 3:
-            # every axis has the same spacing, this should never happen, why is this code here?
-            do_separate_z = False
-        elif len(axis) == 2:
-            # this happens for spacings like (0.24, 1.25, 1.25) for example. In that case we do not want to resample
-            # separately in the out of plane axis
-            do_separate_z = False
-        else:
-            pass
+    do_separate_z, axis = determine_do_sep_z_and_axis(force_separate_z, current_spacing, new_spacing,
+                                                      separate_z_anisotropy_threshold)
 
     if data is not None:
         assert len(data.shape) == 4, "data must be c x y z"
@@ -140,7 +125,9 @@ def resample_data_or_seg(data: np.ndarray, new_shape: Union[Tuple[float, ...], L
     assert len(new_shape) == len(data.shape) - 1
 
     if is_seg:
-        resize_fn = resize_segmentation
+        # same result as batchgenerators' resize_segmentation but each label is only interpolated within its
+        # bounding box
+        resize_fn = resize_segmentation_bbox
         kwargs = OrderedDict()
     else:
         resize_fn = resize
@@ -173,6 +160,10 @@ def resample_data_or_seg(data: np.ndarray, new_shape: Union[Tuple[float, ...], L
                         reshaped_data.append(resize_fn(data[c, :, :, slice_id], new_shape_2d, order, **kwargs))
                 reshaped_data = np.stack(reshaped_data, axis)
                 if shape[axis] != new_shape[axis]:
+                    if is_seg and order_z != 0:
+                        reshaped_final_data.append(
+                            resize_segmentation_along_axis_bbox(reshaped_data, axis, new_shape[axis], order_z)[None])
+                        continue
 
                     # The following few lines are blatantly copied and modified from sklearn's resize()
                     rows, cols, dim = new_shape[0], new_shape[1], new_shape[2]
@@ -188,19 +179,8 @@ def resample_data_or_seg(data: np.ndarray, new_shape: Union[Tuple[float, ...], L
                     map_dims = dim_scale * (map_dims + 0.5) - 0.5
 
                     coord_map = np.array([map_rows, map_cols, map_dims])
-                    if not is_seg or order_z == 0:
-                        reshaped_final_data.append(map_coordinates(reshaped_data, coord_map, order=order_z,
-                                                                   mode='nearest')[None])
-                    else:
-                        unique_labels = np.sort(pd.unique(reshaped_data.ravel()))  # np.unique(reshaped_data)
-                        reshaped = np.zeros(new_shape, dtype=dtype_data)
-
-                        for i, cl in enumerate(unique_labels):
-                            reshaped_multihot = np.round(
-                                map_coordinates((reshaped_data == cl).astype(float), coord_map, order=order_z,
-                                                mode='nearest'))
-                            reshaped[reshaped_multihot > 0.5] = cl
-                        reshaped_final_data.append(reshaped[None])
+                    reshaped_final_data.append(map_coordinates(reshaped_data, coord_map, order=order_z,
+                                                               mode='nearest')[None])
                 else:
                     reshaped_final_data.append(reshaped_data[None])
             reshaped_final_data = np.vstack(reshaped_final_data)
@@ -0,0 +1,104 @@
+"""
+Building blocks for separable (one axis at a time) spline interpolation with torch. Each output voxel along an axis is
+a weighted sum of at most 4 input voxels (gathered with index_select). Coordinates follow
+ndimage.zoom(grid_mode=True) with mode 'nearest', which is what skimage.transform.resize uses, so the results match
+the default resampling functions up to floating point precision. Only orders 0, 1 and 3 are supported (these are the
+ones nnU-Net uses).
+"""
+from typing import Tuple, List, Union
+
+import numpy as np
+import torch
+from torch.nn import functional as F
+
+# ndimage pads with this many edge values before the spline prefilter (see scipy.ndimage._prepad_for_spline_filter)
+SPLINE_PAD = 12
+# the inverse of the cubic B-spline sampling kernel [1, 4, 1] / 6 is sqrt(3) * z^|k| with z = sqrt(3) - 2. Truncated
+# at |k| <= SPLINE_PREFILTER_TAPS the error is below 1e-7, so we can use a convolution instead of the recursive filter
+SPLINE_POLE = np.sqrt(3) - 2
+SPLINE_PREFILTER_TAPS = 12
+
+
+def grid_coordinates(old_size: int, new_size: int) -> np.ndarray:
+    """
+    input coordinates of the output voxels when resizing an axis from old_size to new_size (pixel centers are
+    aligned, same as ndimage.zoom(grid_mode=True))
+    """
+    return (np.arange(new_size) + 0.5) * (old_size / new_size) - 0.5
+
+
+def _pad_and_prefilter_along_axis(x: torch.Tensor, axis: int) -> torch.Tensor:
+    """
+    pads x with SPLINE_PAD edge values on both sides of axis and converts it to cubic B-spline coefficients along axis
+    """
+    k = np.arange(-SPLINE_PREFILTER_TAPS, SPLINE_PREFILTER_TAPS + 1)
+    kernel = torch.from_numpy(np.sqrt(3) * SPLINE_POLE ** np.abs(k)).to(dtype=x.dtype, device=x.device)
+    x = x.movedim(axis, -1)
+    shape = x.shape
+    x = F.pad(x.reshape(-1, 1, shape[-1]), (SPLINE_PAD, SPLINE_PAD), mode='replicate')
+    # mirror boundary, same as ndimage. Because of the edge padding this hardly matters
+    x = F.conv1d(F.pad(x, (SPLINE_PREFILTER_TAPS, SPLINE_PREFILTER_TAPS), mode='reflect'), kernel[None, None])
+    return x.reshape(*shape[:-1], shape[-1] + 2 * SPLINE_PAD).movedim(-1, axis)
+
+
+def _get_interpolation_taps(coords: np.ndarray, size: int, order: int, device: torch.device, dtype: torch.dtype) \
+        -> Tuple[List[torch.Tensor], List[torch.Tensor]]:
+    """
+    returns the input indices and weights (one tensor of len(coords) per tap) for sampling an axis of length size at
+    coords. Values outside the axis are the edge values (mode 'nearest'). For order 3 the indices refer to the input
+    padded with SPLINE_PAD voxels on each side
+    """
+    if order == 0:
+        indices = [np.clip(np.floor(coords + 0.5), 0, size - 1)]
+        weights = [np.ones(len(coords))]
+    elif order == 1:
+        lower = np.floor(coords)
+        t = coords - lower
+        indices = [np.clip(lower, 0, size - 1), np.clip(lower + 1, 0, size - 1)]
+        weights = [1 - t, t]
+    elif order == 3:
+        coords = np.clip(coords, -SPLINE_PAD + 1, size + SPLINE_PAD - 3) + SPLINE_PAD
+        lower = np.floor(coords)
+        t = coords - lower
+        indices = [lower - 1, lower, lower + 1, lower + 2]
+        weights = [(1 - t) ** 3 / 6, (3 * t ** 3 - 6 * t ** 2 + 4) / 6, (-3 * t ** 3 + 3 * t ** 2 + 3 * t + 1) / 6,
+                   t ** 3 / 6]
+    else:
+        raise NotImplementedError(f'separable interpolation supports order 0, 1 and 3, not {order}')
+    indices = [torch.from_numpy(i.astype(np.int64)).to(device) for i in indices]
+    weights = [torch.from_numpy(w).to(device=device, dtype=dtype) for w in weights]
+    return indices, weights
+
+
+def resize_along_axis(x: torch.Tensor, axis: int, new_size: int, order: int,
+                      coords: Union[np.ndarray, None] = None) -> torch.Tensor:
+    """
+    resizes x along axis to new_size with spline interpolation of the given order, mode 'nearest'. x must be floating
+    point unless order is 0.
+
+    coords optionally overrides the input coordinates (relative to x) that are sampled, for example to compute only
+    a part of the output. new_size is ignored in that case
+    """
+    old_size = x.shape[axis]
+    if coords is None:
+        if old_size == new_size:
+            return x
+        coords = grid_coordinates(old_size, new_size)
+    if order == 0:
+        # pure gather, no need to do any arithmetic (and works for integer tensors as well)
+        indices, _ = _get_interpolation_taps(coords, old_size, 0, x.device, torch.float32)
+        return x.index_select(axis, indices[0])
+    if order == 3:
+        x = _pad_and_prefilter_along_axis(x, axis)
+    indices, weights = _get_interpolation_taps(coords, old_size, order, x.device, x.dtype)
+    weight_shape = [1] * x.ndim
+    weight_shape[axis] = len(coords)
+    result = None
+    for i, w in zip(indices, weights):
+        tap = x.index_select(axis, i)
+        tap *= w.view(weight_shape)
+        if result is None:
+            result = tap
+        else:
+            result += tap
+    return result
@@ -0,0 +1,117 @@
+"""
+Drop in replacements for resample_data_or_seg_to_shape and resample_data_or_seg_to_spacing that run in float32 on the
+torch CPU backend (multithreaded, see torch.set_num_threads) instead of float64 skimage/scipy with Python loops over
+channels and slices. Select them in the plans via resampling_fn_data, resampling_fn_seg and
+resampling_fn_probabilities (the kwargs stay the same).
+
+Interpolation is separable, so the image is resampled one axis at a time (see separable_interpolation.py). This
+reproduces what skimage.transform.resize does (ndimage.zoom with grid_mode=True, mode 'nearest', spline prefilter for
+order 3, clipping to the input range) up to float32 precision. Only orders 0, 1 and 3 are supported (these are the
+ones nnU-Net uses). Segmentations are resampled label by label within the bounding box of each label, see
+segmentation_resampling.py. See nnunetv2/preprocessing/resampling_benchmark.py for a parity check and timings.
+"""
+from typing import Union, Tuple, List
+
+import numpy as np
+import torch
+
+from nnunetv2.configuration import ANISO_THRESHOLD
+from nnunetv2.preprocessing.resampling.default_resampling import compute_new_shape, determine_do_sep_z_and_axis
+from nnunetv2.preprocessing.resampling.segmentation_resampling import resize_segmentation_in_bboxes, \
+    resize_segmentation_along_axis_in_bboxes
+from nnunetv2.preprocessing.resampling.separable_interpolation import resize_along_axis
+
+
+def _resize_clipped(x: torch.Tensor, new_shape: Tuple[int, ...], order: int, axes: Tuple[int, ...]) -> torch.Tensor:
+    """
+    resizes the trailing len(new_shape) axes of x. Like skimage.transform.resize(clip=True), the result is clipped to
+    the value range of each image (everything but the trailing axes is treated as batch dimension)
+    """
+    if order > 1:
+        flat = x.flatten(-len(new_shape))
+        vmin = flat.amin(-1).view(*x.shape[:-len(new_shape)], *[1] * len(new_shape))
+        vmax = flat.amax(-1).view(*x.shape[:-len(new_shape)], *[1] * len(new_shape))
+    for a in axes:
+        x = resize_along_axis(x, a, new_shape[a - (x.ndim - len(new_shape))], order)
+    if order > 1:
+        x = torch.clamp(x, vmin, vmax)
+    return x
+
+
+def resample_torch(data: Union[torch.Tensor, np.ndarray], new_shape: Union[Tuple[int, ...], List[int], np.ndarray],
+                   is_seg: bool = False, axis: Union[None, np.ndarray] = None, order: int = 3,
+                   do_separate_z: bool = False, order_z: int = 0) -> Union[torch.Tensor, np.ndarray]:
+    """
+    torch version of resample_data_or_seg. Returns the same type (np.ndarray or torch.Tensor) and dtype as data.
+    Computations are done in float32 on the device of data
+    """
+    assert len(data.shape) == 4, "data must be (c, x, y, z)"
+    assert len(new_shape) == len(data.shape) - 1
+    new_shape = tuple([int(i) for i in new_shape])
+    if tuple(data.shape[1:]) == new_shape:
+        return data
+
+    is_numpy = isinstance(data, np.ndarray)
+    x = torch.from_numpy(data) if is_numpy else data
+    input_dtype = x.dtype
+
+    if do_separate_z:
+        assert len(axis) == 1, "only one anisotropic axis supported"
+        axis = int(axis[0])
+        in_plane_axes = tuple([i + 1 for i in range(3) if i != axis])
+        # in plane first (with the lowres axis treated as batch dimension, so we move it to the front), then along z
+        in_plane_shape = tuple([new_shape[i - 1] for i in in_plane_axes])
+        x = x.movedim(axis + 1, 1)
+        if is_seg:
+            x = resize_segmentation_in_bboxes(x, (*x.shape[:2], *in_plane_shape), order)
+        else:
+            x = _resize_clipped(x.float(), in_plane_shape, order, (2, 3))
+        x = x.movedim(1, axis + 1)
+        if x.shape[axis + 1] != new_shape[axis]:
+            if is_seg:
+                x = resize_segmentation_along_axis_in_bboxes(x, axis + 1, new_shape[axis], order_z)
+            else:
+                # no clipping here, map_coordinates in resample_data_or_seg doesn't do that either
+                x = resize_along_axis(x, axis + 1, new_shape[axis], order_z)
+    else:
+        if is_seg:
+            x = resize_segmentation_in_bboxes(x, (x.shape[0], *new_shape), order)
+        else:
+            x = _resize_clipped(x.float(), new_shape, order, (1, 2, 3))
+
+    if is_numpy:
+        return x.cpu().numpy().astype(data.dtype, copy=False)
+    return x.to(input_dtype)
+
+
+def resample_torch_to_shape(data: Union[torch.Tensor, np.ndarray],
+                            new_shape: Union[Tuple[int, ...], List[int], np.ndarray],
+                            current_spacing: Union[Tuple[float, ...], List[float], np.ndarray],
+                            new_spacing: Union[Tuple[float, ...], List[float], np.ndarray],
+                            is_seg: bool = False,
+                            order: int = 3, order_z: int = 0,
+                            force_separate_z: Union[bool, None] = False,
+                            separate_z_anisotropy_threshold: float = ANISO_THRESHOLD):
+    """
+    same arguments as resample_data_or_seg_to_shape
+    """
+    assert len(data.shape) == 4, "data must be c x y z"
+    do_separate_z, axis = determine_do_sep_z_and_axis(force_separate_z, current_spacing, new_spacing,
+                                                      separate_z_anisotropy_threshold)
+    return resample_torch(data, new_shape, is_seg, axis, order, do_separate_z, order_z=order_z)
+
+
+def resample_torch_to_spacing(data: Union[torch.Tensor, np.ndarray],
+                              current_spacing: Union[Tuple[float, ...], List[float], np.ndarray],
+                              new_spacing: Union[Tuple[float, ...], List[float], np.ndarray],
+                              is_seg: bool = False,
+                              order: int = 3, order_z: int = 0,
+                              force_separate_z: Union[bool, None] = False,
+                              separate_z_anisotropy_threshold: float = ANISO_THRESHOLD):
+    """
+    same arguments as resample_data_or_seg_to_spacing
+    """
+    assert len(data.shape) == 4, "data must be c x y z"
+    new_shape = compute_new_shape(data.shape[1:], current_spacing, new_spacing)
+    return resample_torch_to_shape(data, new_shape, current_spacing, new_spacing, is_seg, order, order_z,
+                                   force_separate_z, separate_z_anisotropy_threshold)
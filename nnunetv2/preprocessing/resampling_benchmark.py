@@ -0,0 +1,150 @@
+"""
+Compares the default (skimage/scipy) resampling with the torch implementation (torch_resampling.py) in terms of
+speed and numerical agreement, for the three use cases in nnU-Net: image data (order 3), segmentations (order 1, one
+hot per label) and probabilities/logits during export (order 1). For segmentations, the label wise bounding box
+resampling (segmentation_resampling.py, used by both) is also compared to full volume interpolation of every label
+(batchgenerators' resize_segmentation). Run with
+
+python -m nnunetv2.preprocessing.resampling_benchmark -i IMAGE.nii.gz -target_spacing 1 1 1
+
+or without -i for a synthetic volume.
+"""
+from time import time
+from typing import Tuple, Union, List
+
+import numpy as np
+import torch
+from batchgenerators.augmentations.utils import resize_segmentation
+from scipy.ndimage import gaussian_filter
+
+from nnunetv2.preprocessing.resampling.default_resampling import resample_data_or_seg_to_shape, compute_new_shape, \
+    get_do_separate_z
+from nnunetv2.preprocessing.resampling.segmentation_resampling import resize_segmentation_bbox
+from nnunetv2.preprocessing.resampling.torch_resampling import resample_torch_to_shape
+
+
+def _time(fn, *args, repeats: int = 1, **kwargs):
+    times = []
+    for _ in range(repeats):
+        start = time()
+        ret = fn(*args, **kwargs)
+        times.append(time() - start)
+    return ret, min(times)
+
+
+def compare_resampling(data: np.ndarray, seg: np.ndarray, logits: np.ndarray,
+                       current_spacing: Union[Tuple[float, ...], List[float]],
+                       target_spacing: Union[Tuple[float, ...], List[float]],
+                       repeats: int = 1, verbose: bool = True) -> List[dict]:
+    """
+    data, seg and logits must be (c, x, y, z). Returns one dict per use case with the timings of both
+    implementations and the deviation of the torch result (max abs error relative to the value range for data and
+    logits, fraction of differing voxels for seg)
+    """
+    new_shape = compute_new_shape(data.shape[1:], current_spacing, target_spacing)
+    cases = [
+        ('data', data, {'is_seg': False, 'order': 3, 'order_z': 0, 'force_separate_z': None}),
+        ('seg', seg, {'is_seg': True, 'order': 1, 'order_z': 0, 'force_separate_z': None}),
+        ('probabilities', logits, {'is_seg': False, 'order': 1, 'order_z': 0, 'force_separate_z': None}),
+    ]
+    results = []
+    for name, x, kwargs in cases:
+        reference, time_default = _time(resample_data_or_seg_to_shape, x, new_shape, current_spacing,
+                                        target_spacing, repeats=repeats, **kwargs)
+        resampled, time_torch = _time(resample_torch_to_shape, x, new_shape, current_spacing, target_spacing,
+                                      repeats=repeats, **kwargs)
+        if kwargs['is_seg']:
+            deviation = float(np.mean(reference != resampled))
+        else:
+            value_range = max(float(reference.max() - reference.min()), 1e-8)
+            deviation = float(np.max(np.abs(reference.astype(np.float64) - resampled))) / value_range
+        results.append({'name': name, 'shape': tuple(x.shape), 'new_shape': tuple([int(i) for i in new_shape]),
+                        'time_default': time_default, 'time_torch': time_torch, 'deviation': deviation})
+        if verbose:
+            print(f'{name:>13}: {tuple(x.shape)} -> {tuple([int(i) for i in new_shape])}. default {time_default:.3f} s, torch '
+                  f'{time_torch:.3f} s ({time_default / time_torch:.1f}x). Deviation: {deviation:.2e}'
+                  f'{" (fraction of voxels)" if kwargs["is_seg"] else " (relative to value range)"}')
+
+    if not get_do_separate_z(current_spacing) and not get_do_separate_z(target_spacing):
+        full_volume, time_full_volume = _time(lambda: np.stack([resize_segmentation(s, new_shape, 1) for s in seg]),
+                                              repeats=repeats)
+        bbox, time_bbox = _time(lambda: np.stack([resize_segmentation_bbox(s, new_shape, 1) for s in seg]),
+                                repeats=repeats)
+        deviation = float(np.mean(full_volume != bbox))
+        results.append({'name': 'seg_bbox', 'shape': tuple(seg.shape), 'new_shape': tuple([int(i) for i in new_shape]),
+                        'time_full_volume': time_full_volume, 'time_bbox': time_bbox, 'deviation': deviation})
+        if verbose:
+            print(f'{"seg labels":>13}: {len(np.unique(seg))} labels. full volume per label {time_full_volume:.3f} s, '
+                  f'bounding boxes {time_bbox:.3f} s ({time_full_volume / time_bbox:.1f}x). Deviation: '
+                  f'{deviation:.2e} (fraction of voxels)')
+    return results
+
+
+def _synthetic_case(shape: Tuple[int, ...], num_labels: int, small_objects: bool = False, seed: int = 1234) \
+        -> Tuple[np.ndarray, np.ndarray]:
+    rs = np.random.RandomState(seed)
+    data = gaussian_filter(rs.randn(*shape), 2).astype(np.float32)[None]
+    if small_objects:
+        seg = np.zeros(shape, dtype=np.uint8)
+        for label in range(1, num_labels + 1):
+            center = [rs.randint(0, s) for s in shape]
+            size = [rs.randint(2, max(3, s // 10)) for s in shape]
+            seg[tuple([slice(max(0, c - r), c + r) for c, r in zip(center, size)])] = label
+        seg = seg[None]
+    else:
+        blobs = gaussian_filter(rs.randn(*shape), 4)
+        seg = np.digitize(blobs, np.quantile(blobs, np.linspace(0, 1, num_labels + 1)[1:-1])).astype(np.uint8)[None]
+    return data, seg
+
+
+def resampling_benchmark_entry_point():
+    import argparse
+    parser = argparse.ArgumentParser(description='Speed and parity of the torch resampling functions compared to the '
+                                                 'default ones')
+    parser.add_argument('-i', type=str, required=False, default=None,
+                        help='Image file (any format SimpleITK can read). Default: synthetic volume')
+    parser.add_argument('-seg', type=str, required=False, default=None,
+                        help='Segmentation of the image. Default: synthetic labels')
+    parser.add_argument('-shape', nargs=3, type=int, required=False, default=(128, 160, 160),
+                        help='Shape of the synthetic volume. Default: 128 160 160')
+    parser.add_argument('-spacing', nargs=3, type=float, required=False, default=(2.5, 0.8, 0.8),
+                        help='Spacing of the synthetic volume. Default: 2.5 0.8 0.8')
+    parser.add_argument('-target_spacing', nargs=3, type=float, required=False, default=(1, 1, 1),
+                        help='Target spacing. Use one with an anisotropy ratio above 3 together with an anisotropic '
+                             'input to test the separate z code path. Default: 1 1 1')
+    parser.add_argument('-num_labels', type=int, required=False, default=5,
+                        help='Number of labels (synthetic segmentation) and number of logit channels. Default: 5')
+    parser.add_argument('--small_objects', action='store_true', required=False, default=False,
+                        help='Synthetic segmentation with num_labels small boxes instead of blobs that fill the '
+                             'volume (like organs at risk). That is where label wise bounding boxes shine')
+    parser.add_argument('-num_threads', type=int, required=False, default=None,
+                        help='torch threads. Default: torch default')
+    parser.add_argument('-repeats', type=int, required=False, default=3,
+                        help='Timings are the best of this many runs. Default: 3')
+    args = parser.parse_args()
+
+    if args.num_threads is not None:
+        torch.set_num_threads(args.num_threads)
+
+    if args.i is not None:
+        from nnunetv2.imageio.simpleitk_reader_writer import SimpleITKIO
+        data, properties = SimpleITKIO().read_images([args.i])
+        data = data.astype(np.float32)
+        spacing = properties['spacing']
+        if args.seg is not None:
+            seg, _ = SimpleITKIO().read_seg(args.seg)
+            seg = seg.astype(np.int16)
+        else:
+            _, seg = _synthetic_case(data.shape[1:], args.num_labels, args.small_objects)
+    else:
+        spacing = args.spacing
+        data, seg = _synthetic_case(tuple(args.shape), args.num_labels, args.small_objects)
+    num_classes = max(2, args.num_labels)
+    logits = np.stack([gaussian_filter(data[0], 1 + i) for i in range(num_classes)]).astype(np.float32)
+
+    print(f'torch threads: {torch.get_num_threads()}, spacing {tuple(spacing)} -> {tuple(args.target_spacing)}')
+    compare_resampling(data, seg, logits, spacing, args.target_spacing, args.repeats)
+
+
+if __name__ == '__main__':
+    resampling_benchmark_entry_point()
@@ -0,0 +1,131 @@
+import os
+
+import numpy as np
+import SimpleITK as sitk
+import torch
+from batchgenerators.utilities.file_and_folder_operations import join, maybe_mkdir_p, subfiles
+
+from nnunetv2.inference.data_iterators import preprocessing_iterator_fromfiles
+from nnunetv2.inference.predict_from_raw_data import nnUNetPredictor
+from nnunetv2.inference.work_queue import FileLockWorkQueue
+from nnunetv2.utilities.get_network_from_plans import get_network_from_plans
+from nnunetv2.utilities.plans_handling.plans_handler import PlansManager
+
+DATASET_JSON = {'labels': {'background': 0, 'a': 1}, 'file_ending': '.nii.gz', 'channel_names': {'0': 'CT'},
+                'numTraining': 1}
+
+
+def _get_plans() -> dict:
+    configuration = {
+        'data_identifier': 'test', 'preprocessor_name': 'DefaultPreprocessor', 'batch_size': 2,
+        'patch_size': [16, 16, 16], 'median_image_size_in_voxels': [24, 24, 24], 'spacing': [1., 1., 1.],
+        'normalization_schemes': ['CTNormalization'], 'use_mask_for_norm': [False],
+        'UNet_class_name': 'PlainConvUNet', 'UNet_base_num_features': 4,
+        'n_conv_per_stage_encoder': [1, 1], 'n_conv_per_stage_decoder': [1],
+        'num_pool_per_axis': [1, 1, 1], 'pool_op_kernel_sizes': [[1, 1, 1], [2, 2, 2]],
+        'conv_kernel_sizes': [[3, 3, 3]] * 2, 'unet_max_num_features': 8,
+        'resampling_fn_data': 'resample_data_or_seg_to_shape',
+        'resampling_fn_seg': 'resample_data_or_seg_to_shape',
+        'resampling_fn_data_kwargs': {'is_seg': False, 'order': 3, 'order_z': 0, 'force_separate_z': None},
+        'resampling_fn_seg_kwargs': {'is_seg': True, 'order': 1, 'order_z': 0, 'force_separate_z': None},
+        'resampling_fn_probabilities': 'resample_data_or_seg_to_shape',
+        'resampling_fn_probabilities_kwargs': {'is_seg': False, 'order': 1, 'order_z': 0, 'force_separate_z': None},
+        'batch_dice': False}
+    return {'dataset_name': 'Dataset999_Test', 'plans_name': 'nnUNetPlans',
+            'original_median_spacing_after_transp': [1, 1, 1], 'original_median_shape_after_transp': [24, 24, 24],
+            'image_reader_writer': 'SimpleITKIO', 'transpose_forward': [0, 1, 2], 'transpose_backward': [0, 1, 2],
+            'configurations': {'3d_fullres': configuration}, 'experiment_planner_used': 'ExperimentPlanner',
+            'label_manager': 'LabelManager',
+            'foreground_intensity_properties_per_channel': {
+                '0': {'mean': 0, 'std': 1, 'percentile_00_5': -1, 'percentile_99_5': 1, 'max': 2, 'min': -2,
+                      'median': 0}}}
+
+
+class GreedyWorkQueue(FileLockWorkQueue):
+    """
+    The first preprocessing worker that claims a case gets all of them, the other workers none. Makes the unequal
+    number of cases per worker deterministic
+    """
+    def claim_next(self):
+        if not getattr(self, '_is_owner', False):
+            try:
+                os.close(os.open(join(self.queue_folder, 'owner'), os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+            except FileExistsError:
+                return None
+            self._is_owner = True
+        return super().claim_next()
+
+
+def _get_predictor() -> nnUNetPredictor:
+    torch.manual_seed(0)
+    plans_manager = PlansManager(_get_plans())
+    configuration_manager = plans_manager.get_configuration('3d_fullres')
+    network = get_network_from_plans(plans_manager, DATASET_JSON, configuration_manager, 1, deep_supervision=False)
+    predictor = nnUNetPredictor(use_mirroring=False, device=torch.device('cpu'), allow_tqdm=False)
+    predictor.manual_initialization(network, plans_manager, configuration_manager, [network.state_dict()],
+                                    DATASET_JSON, 'nnUNetTrainer', None)
+    return predictor
+
+
+def _write_image(filename: str, shape, spacing: float) -> None:
+    image = sitk.GetImageFromArray(np.random.RandomState(0).rand(*shape).astype(np.float32))
+    image.SetSpacing([spacing] * 3)
+    sitk.WriteImage(image, filename)
+
+
+def test_returned_predictions_keep_input_order(tmp_path):
+    """
+    The first case takes much longer to preprocess (it is large and has to be resampled) than the second. Returned
+    predictions must still be in the order of the inputs
+    """
+    input_folder = str(tmp_path / 'imagesTs')
+    maybe_mkdir_p(input_folder)
+    shapes = [(128, 128, 128), (8, 8, 8)]
+    _write_image(join(input_folder, 'case0_0000.nii.gz'), shapes[0], 0.25)
+    _write_image(join(input_folder, 'case1_0000.nii.gz'), shapes[1], 1)
+    predictor = _get_predictor()
+
+    list_of_lists = [[join(input_folder, 'case0_0000.nii.gz')], [join(input_folder, 'case1_0000.nii.gz')]]
+    ret = predictor.predict_from_files(list_of_lists, None, num_processes_preprocessing=2,
+                                       num_processes_segmentation_export=1)
+    assert [i.shape for i in ret] == shapes
+
+    images, properties = [], []
+    for files in list_of_lists:
+        image, props = predictor.plans_manager.image_reader_writer_class().read_images(files)
+        images.append(image)
+        properties.append(props)
+    ret = predictor.predict_from_list_of_npy_arrays(images, None, properties, None, num_processes=2,
+                                                    num_processes_segmentation_export=1)
+    assert [i.shape for i in ret] == shapes
+
+
+def test_work_queue_predicts_all_cases(tmp_path):
+    """
+    3 cases and 2 preprocessing workers claiming from a work queue, one worker gets all cases and the other none. All
+    cases must still be predicted and released
+    """
+    input_folder, output_folder, queue_folder = [str(tmp_path / i) for i in ('imagesTs', 'out', 'queue')]
+    maybe_mkdir_p(input_folder)
+    rng = np.random.RandomState(0)
+    case_identifiers = [f'case{i}' for i in range(3)]
+    for c in case_identifiers:
+        sitk.WriteImage(sitk.GetImageFromArray(rng.rand(24, 24, 24).astype(np.float32)),
+                        join(input_folder, c + '_0000.nii.gz'))
+
+    predictor = _get_predictor()
+
+    maybe_mkdir_p(output_folder)
+    list_of_lists = [[join(input_folder, c + '_0000.nii.gz')] for c in case_identifiers]
+    output_filenames_truncated = [join(output_folder, c) for c in case_identifiers]
+    work_queue = GreedyWorkQueue(queue_folder, case_identifiers)
+    data_iterator = preprocessing_iterator_fromfiles(list_of_lists, None, output_filenames_truncated,
+                                                     predictor.plans_manager, DATASET_JSON,
+                                                     predictor.configuration_manager, 2, work_queue=work_queue)
+    predictor.predict_from_data_iterator(data_iterator, False, 1, work_queue)
+
+    assert sorted(subfiles(output_folder, suffix='.nii.gz', join=False)) == \
+           sorted([c + '.nii.gz' for c in case_identifiers])
+    assert len(subfiles(queue_folder, suffix='.lock')) == 0
+    assert sorted(subfiles(queue_folder, suffix='.done', join=False)) == \
+           sorted([c + '.done' for c in case_identifiers])
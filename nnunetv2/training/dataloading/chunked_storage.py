@@ -0,0 +1,68 @@
+"""
+Chunked, compressed storage for preprocessed cases. data and seg are stored as blosc2 ND arrays (one .b2nd file each,
+zstd compressed). Chunks roughly have the size of a patch and are subdivided into small blocks, which are the unit of
+decompression. Slicing a patch out of an opened array only reads and decompresses the blocks that overlap with it, so
+cases neither need to be unpacked before training nor loaded in full for every patch.
+"""
+from typing import Tuple, List, Union
+
+import blosc2
+import numpy as np
+from batchgenerators.utilities.file_and_folder_operations import isfile
+
+CHUNKED_FILE_ENDING = '.b2nd'
+# blocks are decompressed as a whole. Keep them small enough to stay in the L2 cache
+TARGET_BLOCK_BYTES = 128 * 1024
+
+
+def get_data_and_seg_file(output_filename_truncated: str) -> Tuple[str, str]:
+    return output_filename_truncated + CHUNKED_FILE_ENDING, output_filename_truncated + '_seg' + CHUNKED_FILE_ENDING
+
+
+def is_chunked_case(output_filename_truncated: str) -> bool:
+    return isfile(get_data_and_seg_file(output_filename_truncated)[0])
+
+
+def get_chunks_and_blocks(shape: Tuple[int, ...], patch_size: Union[Tuple[int, ...], List[int]], itemsize: int) \
+        -> Tuple[Tuple[int, ...], Tuple[int, ...]]:
+    """
+    shape is (c, x, y(, z)). Each chunk holds a patch sized region of one channel. 2D patch sizes refer to the last
+    two axes (the 2D data loader picks a slice along the first spatial axis first). Blocks are chunks halved along
+    their largest axis until they are no larger than TARGET_BLOCK_BYTES
+    """
+    spatial = shape[1:]
+    patch_size = [1] * (len(spatial) - len(patch_size)) + [int(i) for i in patch_size]
+    chunks = [1] + [min(p, s) for p, s in zip(patch_size, spatial)]
+    blocks = list(chunks)
+    while np.prod(blocks) * itemsize > TARGET_BLOCK_BYTES and max(blocks) > 1:
+        largest = int(np.argmax(blocks))
+        blocks[largest] = (blocks[largest] + 1) // 2
+    return tuple(chunks), tuple(blocks)
+
+
+def save_array_chunked(array: np.ndarray, filename: str, patch_size: Union[Tuple[int, ...], List[int]],
+                       clevel: int = 5) -> None:
+    chunks, blocks = get_chunks_and_blocks(array.shape, patch_size, array.itemsize)
+    blosc2.asarray(np.ascontiguousarray(array), urlpath=filename, mode='w', chunks=chunks, blocks=blocks,
+                   cparams={'codec': blosc2.Codec.ZSTD, 'clevel': clevel, 'nthreads': 1})
+
+
+def save_case_chunked(data: np.ndarray, seg: np.ndarray, output_filename_truncated: str,
+                      patch_size: Union[Tuple[int, ...], List[int]], clevel: int = 5) -> None:
+    data_file, seg_file = get_data_and_seg_file(output_filename_truncated)
+    save_array_chunked(data, data_file, patch_size, clevel)
+    save_array_chunked(seg, seg_file, patch_size, clevel)
+
+
+def open_chunked(filename: str) -> blosc2.NDArray:
+    """
+    opens the file without reading any data. Index it like a numpy array (for example arr[:, 10:74, 0:64, 32:96]) to
+    get the content of that region as np.ndarray, arr[:] returns everything. Decompression runs in the calling thread,
+    the data loaders already run in parallel
+    """
+    return blosc2.open(filename, mode='r', mmap_mode='r', dparams={'nthreads': 1})
+
+
+def load_case_chunked(output_filename_truncated: str) -> Tuple[blosc2.NDArray, blosc2.NDArray]:
+    data_file, seg_file = get_data_and_seg_file(output_filename_truncated)
+    return open_chunked(data_file), open_chunked(seg_file)
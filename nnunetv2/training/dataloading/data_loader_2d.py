@@ -40,7 +40,7 @@ class nnUNetDataLoader2D(nnUNetDataLoaderBase):
             if selected_class_or_region is not None:
                 selected_slice = np.random.choice(properties['class_locations'][selected_class_or_region][:, 1])
             else:
-                selected_slice = np.random.choice(len(data[0]))
+                selected_slice = np.random.choice(data.shape[1])
 
             data = data[:, selected_slice]
             seg = seg[:, selected_slice]
@@ -5,6 +5,8 @@ import numpy as np
 import shutil
 
 from batchgenerators.utilities.file_and_folder_operations import join, load_pickle, isfile
+from nnunetv2.training.dataloading.chunked_storage import is_chunked_case, get_data_and_seg_file, open_chunked, \
+    CHUNKED_FILE_ENDING
 from nnunetv2.training.dataloading.utils import get_case_identifiers
 
 
@@ -18,6 +20,7 @@ class nnUNetDataset(object):
         dataset[training_case] -> info
         Info has the following key:value pairs:
         - dataset[case_identifier]['properties']['data_file'] -> the full path to the npz file associated with the training case
+        (or the .b2nd file if the case was saved in chunked storage, see chunked_storage.py)
         - dataset[case_identifier]['properties']['properties_file'] -> the pkl file containing the case properties
 
         In addition, if the total number of cases is < num_images_properties_loading_threshold we load all the pickle files
@@ -43,7 +46,10 @@ class nnUNetDataset(object):
         self.dataset = {}
         for c in case_identifiers:
             self.dataset[c] = {}
-            self.dataset[c]['data_file'] = join(folder, "%s.npz" % c)
+            if is_chunked_case(join(folder, c)):
+                self.dataset[c]['data_file'] = get_data_and_seg_file(join(folder, c))[0]
+            else:
+                self.dataset[c]['data_file'] = join(folder, "%s.npz" % c)
             self.dataset[c]['properties_file'] = join(folder, "%s.pkl" % c)
             if folder_with_segs_from_previous_stage is not None:
                 self.dataset[c]['seg_from_prev_stage_file'] = join(folder_with_segs_from_previous_stage, "%s.npz" % c)
@@ -78,10 +84,19 @@ class nnUNetDataset(object):
         return self.dataset.values()
 
     def load_case(self, key):
+        """
+        For cases in chunked storage data and seg are blosc2 arrays that are only decompressed where they are indexed.
+        Use data[:] if you need everything (that also works for the numpy arrays returned for the other formats)
+        """
         entry = self[key]
+        is_chunked = entry['data_file'].endswith(CHUNKED_FILE_ENDING)
         if 'open_data_file' in entry.keys():
             data = entry['open_data_file']
             # print('using open data file')
+        elif is_chunked:
+            data = open_chunked(entry['data_file'])
+            if self.keep_files_open:
+                self.dataset[key]['open_data_file'] = data
         elif isfile(entry['data_file'][:-4] + ".npy"):
             data = np.load(entry['data_file'][:-4] + ".npy", 'r')
             if self.keep_files_open:
@@ -93,6 +108,10 @@ class nnUNetDataset(object):
         if 'open_seg_file' in entry.keys():
             seg = entry['open_seg_file']
             # print('using open data file')
+        elif is_chunked:
+            seg = open_chunked(get_data_and_seg_file(entry['data_file'][:-len(CHUNKED_FILE_ENDING)])[1])
+            if self.keep_files_open:
+                self.dataset[key]['open_seg_file'] = seg
         elif isfile(entry['data_file'][:-4] + "_seg.npy"):
             seg = np.load(entry['data_file'][:-4] + "_seg.npy", 'r')
             if self.keep_files_open:
@@ -106,7 +125,8 @@ class nnUNetDataset(object):
                 seg_prev = np.load(entry['seg_from_prev_stage_file'][:-4] + ".npy", 'r')
             else:
                 seg_prev = np.load(entry['seg_from_prev_stage_file'])['seg']
-            seg = np.vstack((seg, seg_prev[None]))
+            # seg[:] decompresses chunked segmentations, the cascade needs them in one piece
+            seg = np.vstack((seg[:], seg_prev[None]))
 
         return data, seg, entry['properties']
 
@@ -6,6 +6,7 @@ from typing import List
 import numpy as np
 from batchgenerators.utilities.file_and_folder_operations import isfile, subfiles
 from nnunetv2.configuration import default_num_processes
+from nnunetv2.training.dataloading.chunked_storage import CHUNKED_FILE_ENDING
 
 
 def _convert_to_npy(npz_file: str, unpack_segmentation: bool = True, overwrite_existing: bool = False) -> None:
@@ -38,9 +39,18 @@ def unpack_dataset(folder: str, unpack_segmentation: bool = True, overwrite_exis
 
 def get_case_identifiers(folder: str) -> List[str]:
     """
-    finds all npz files in the given folder and reconstructs the training case names from them
+    finds all npz files (and data files of cases in chunked storage, see chunked_storage.py) in the given folder and
+    reconstructs the training case names from them
     """
-    case_identifiers = [i[:-4] for i in os.listdir(folder) if i.endswith("npz") and (i.find("segFromPrevStage") == -1)]
+    files = os.listdir(folder)
+    case_identifiers = [i[:-4] for i in files if i.endswith("npz") and (i.find("segFromPrevStage") == -1)]
+    chunked = [i[:-len(CHUNKED_FILE_ENDING)] for i in files if i.endswith(CHUNKED_FILE_ENDING)]
+    # CASE_seg.b2nd is the segmentation of CASE, unless there is no CASE.b2nd
+    chunked_set = set(chunked)
+    chunked = [i for i in chunked if not (i.endswith('_seg') and i[:-4] in chunked_set)]
+    # a case may exist in both formats (if it was preprocessed again in the other one). List it only once
+    npz_set = set(case_identifiers)
+    case_identifiers += [i for i in chunked if i not in npz_set]
     return case_identifiers
 
 
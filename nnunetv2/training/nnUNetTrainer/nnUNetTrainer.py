@@ -1131,6 +1131,8 @@ class nnUNetTrainer(object):
 
                 self.print_to_log_file(f"predicting {k}")
                 data, seg, properties = dataset_val.load_case(k)
+                # decompresses the whole case if it is in chunked storage, no-op otherwise
+                data, seg = data[:], seg[:]
 
                 if self.is_cascaded:
                     data = np.vstack((data, convert_labelmap_to_one_hot(seg[-1], self.label_manager.foreground_labels,
@@ -0,0 +1,32 @@
+import hashlib
+import os
+from typing import Union
+
+
+def update_hash_with_file(filename: str, hasher) -> None:
+    with open(filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 24), b''):
+            hasher.update(chunk)
+
+
+def hash_file(filename: str) -> str:
+    hasher = hashlib.sha256()
+    update_hash_with_file(filename, hasher)
+    return hasher.hexdigest()
+
+
+def get_file_record(filename: str, previous_record: Union[dict, None] = None) -> dict:
+    """
+    Returns {'size': ..., 'mtime_ns': ..., 'sha256': ...} for filename. Hashing large images is expensive, so if
+    previous_record (a record of the same file from an earlier run) has the same size and modification time, its hash
+    is reused. Compare records with records_match: files that were touched or copied but not changed still match
+    """
+    stat = os.stat(filename)
+    if previous_record is not None and previous_record.get('size') == stat.st_size and \
+            previous_record.get('mtime_ns') == stat.st_mtime_ns:
+        return previous_record
+    return {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'sha256': hash_file(filename)}
+
+
+def records_match(record: Union[dict, None], other_record: Union[dict, None]) -> bool:
+    return record is not None and other_record is not None and record['sha256'] == other_record['sha256']
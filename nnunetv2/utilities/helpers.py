@@ -25,3 +25,21 @@ class dummy_context(object):
 
     def __exit__(self, exc_type, exc_val, exc_tb):
         pass
+
+
+def cpu_supports_bf16() -> bool:
+    """
+    Autocast to bfloat16 on the CPU is only faster if the CPU has native bf16 instructions (AVX512-BF16, AMX or the
+    ARM bf16 extension). Everywhere else it is emulated and much slower than float32. Only implemented for linux,
+    returns False elsewhere
+    """
+    try:
+        with open('/proc/cpuinfo', 'r') as f:
+            cpuinfo = f.read()
+    except OSError:
+        return False
+    flags = set()
+    for line in cpuinfo.splitlines():
+        if line.startswith('flags') or line.startswith('Features'):
+            flags.update(line.split(':', 1)[-1].split())
+    return len(flags.intersection(('avx512_bf16', 'amx_bf16', 'bf16'))) > 0
@@ -0,0 +1,168 @@
+"""
+Lightweight timing spans for the inference pipeline. Profiling is switched on by setting the nnUNet_profile_folder
+environment variable (enable_profiling does that). Background workers are started with spawn and inherit the
+environment, so preprocessing and export workers record their spans as well. Each process buffers its spans in memory
+and appends them to profile_folder/spans_PID.jsonl at case boundaries (set_profiled_case), at process exit and in
+write_profiling_report, so recording a span does not touch the file system. write_profiling_report merges the files
+into a per case report (and optionally a Chrome trace that can be opened in chrome://tracing or
+https://ui.perfetto.dev). Besides spans, counts per case (for example the number of skipped tiles) can be recorded with
+record_value.
+
+If profiling is disabled, profile_span costs one dict lookup.
+"""
+
+import atexit
+import json
+import os
+import threading
+from contextlib import contextmanager
+from glob import glob
+from time import time
+from typing import Union
+
+import torch
+from batchgenerators.utilities.file_and_folder_operations import join, maybe_mkdir_p, save_json
+
+PROFILE_FOLDER_ENV = 'nnUNet_profile_folder'
+NO_CASE = 'no_case'
+
+_current_case = None
+# (profile_folder, span) of this process that have not been written yet
+_buffered_spans = []
+_buffered_spans_lock = threading.Lock()
+
+
+def enable_profiling(profile_folder: str) -> None:
+    """
+    spans of earlier runs in profile_folder are removed
+    """
+    maybe_mkdir_p(profile_folder)
+    for f in glob(join(profile_folder, 'spans_*.jsonl')):
+        os.remove(f)
+    os.environ[PROFILE_FOLDER_ENV] = profile_folder
+
+
+def disable_profiling() -> None:
+    os.environ.pop(PROFILE_FOLDER_ENV, None)
+
+
+def profiling_enabled() -> bool:
+    return os.environ.get(PROFILE_FOLDER_ENV) is not None
+
+
+def flush_spans() -> None:
+    """
+    appends the spans buffered in this process to profile_folder/spans_PID.jsonl
+    """
+    global _buffered_spans
+    with _buffered_spans_lock:
+        spans, _buffered_spans = _buffered_spans, []
+    spans_per_folder = {}
+    for profile_folder, span in spans:
+        spans_per_folder.setdefault(profile_folder, []).append(json.dumps(span) + '\n')
+    for profile_folder, lines in spans_per_folder.items():
+        with open(join(profile_folder, f'spans_{os.getpid()}.jsonl'), 'a') as f:
+            f.writelines(lines)
+
+
+# spawned workers exit through sys.exit, so this also covers preprocessing and export workers that finish normally
+atexit.register(flush_spans)
+
+
+def set_profiled_case(case: Union[str, None]) -> None:
+    """
+    spans without an explicit case are attributed to this case (per process). A new case is a good moment to write
+    the spans of the previous one
+    """
+    global _current_case
+    _current_case = case
+    if len(_buffered_spans) > 0:
+        flush_spans()
+
+
+def record_span(name: str, start: float, end: float, case: Union[str, None] = None) -> None:
+    profile_folder = os.environ.get(PROFILE_FOLDER_ENV)
+    if profile_folder is None:
+        return
+    span = {'name': name, 'case': case if case is not None else _current_case, 'start': start, 'end': end,
+            'pid': os.getpid(), 'tid': threading.get_ident()}
+    with _buffered_spans_lock:
+        _buffered_spans.append((profile_folder, span))
+
+
+def record_value(name: str, value: float, case: Union[str, None] = None) -> None:
+    """
+    values with the same name are summed per case in the report
+    """
+    profile_folder = os.environ.get(PROFILE_FOLDER_ENV)
+    if profile_folder is None:
+        return
+    entry = {'name': name, 'case': case if case is not None else _current_case, 'value': value}
+    with _buffered_spans_lock:
+        _buffered_spans.append((profile_folder, entry))
+
+
+@contextmanager
+def profile_span(name: str, case: Union[str, None] = None, device: Union[torch.device, None] = None):
+    """
+    if device is a cuda device, it is synchronized before the span ends so that asynchronous kernels are attributed to
+    the right span (only while profiling)
+    """
+    if not profiling_enabled():
+        yield
+        return
+    start = time()
+    try:
+        yield
+    finally:
+        if device is not None and device.type == 'cuda':
+            torch.cuda.synchronize(device)
+        record_span(name, start, time(), case)
+
+
+def write_profiling_report(profile_folder: str, chrome_trace: bool = False) -> dict:
+    """
+    Writes profile_folder/profile_report.json: for each case the total time and number of calls per stage plus the
+    wall time from the first to the last span of the case as well as the sum of the values recorded for the case
+    (record_value). Waiting for other stages (wait_for_*, queue_put_wait) is
+    recorded as separate stages, so pipeline stalls are visible. If chrome_trace, all spans are also exported to
+    profile_folder/profile_trace.json
+    """
+    flush_spans()
+    spans = []
+    values = []
+    for f in sorted(glob(join(profile_folder, 'spans_*.jsonl'))):
+        with open(f, 'r') as fh:
+            for line in fh:
+                if len(line.strip()) > 0:
+                    entry = json.loads(line)
+                    (values if 'value' in entry else spans).append(entry)
+
+    report = {'cases': {}, 'total': {}}
+    for s in spans:
+        case = s['case'] if s['case'] is not None else NO_CASE
+        if case not in report['cases']:
+            report['cases'][case] = {'stages': {}, 'first_start': s['start'], 'last_end': s['end']}
+        case_report = report['cases'][case]
+        for stages in (case_report['stages'], report['total']):
+            if s['name'] not in stages:
+                stages[s['name']] = {'total': 0., 'count': 0}
+            stages[s['name']]['total'] += s['end'] - s['start']
+            stages[s['name']]['count'] += 1
+        case_report['first_start'] = min(case_report['first_start'], s['start'])
+        case_report['last_end'] = max(case_report['last_end'], s['end'])
+    for case_report in report['cases'].values():
+        case_report['wall_time'] = case_report['last_end'] - case_report['first_start']
+    for v in values:
+        case = v['case'] if v['case'] is not None else NO_CASE
+        case_values = report['cases'].setdefault(case, {'stages': {}}).setdefault('values', {})
+        case_values[v['name']] = case_values.get(v['name'], 0) + v['value']
+    save_json(report, join(profile_folder, 'profile_report.json'), sort_keys=False)
+
+    if chrome_trace:
+        events = [{'name': s['name'], 'cat': 'nnUNet', 'ph': 'X', 'ts': s['start'] * 1e6,
+                   'dur': (s['end'] - s['start']) * 1e6, 'pid': s['pid'], 'tid': s['tid'],
+                   'args': {'case': s['case']}} for s in spans]
+        with open(join(profile_folder, 'profile_trace.json'), 'w') as f:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
+    return report
@@ -31,7 +31,8 @@ setup(name='nnunetv2',
           "matplotlib",
           "seaborn",
           "imagecodecs",
-          "yacs"
+          "yacs",
+          "blosc2"
       ],
       entry_points={
           'console_scripts': [
@@ -42,6 +43,10 @@ setup(name='nnunetv2',
               'nnUNetv2_train = nnunetv2.run.run_training:run_training_entry',  # api available
               'nnUNetv2_predict_from_modelfolder = nnunetv2.inference.predict_from_raw_data:predict_entry_point_modelfolder',  # api available
               'nnUNetv2_predict = nnunetv2.inference.predict_from_raw_data:predict_entry_point',  # api available
+              'nnUNetv2_predict_server = nnunetv2.inference.predict_server:predict_server_entry_point',  # api available
+              'nnUNetv2_export_torchscript = nnunetv2.inference.export_torchscript:export_torchscript_entry_point',  # api available
+              'nnUNetv2_quantize = nnunetv2.inference.quantization:quantize_entry_point',  # api available
+              'nnUNetv2_tune_tile_size = nnunetv2.inference.tile_size_tuning:tune_tile_size_entry_point',  # api available
               'nnUNetv2_convert_old_nnUNet_dataset = nnunetv2.dataset_conversion.convert_raw_dataset_from_old_nnunet_format:convert_entry_point',  # api available
               'nnUNetv2_find_best_configuration = nnunetv2.evaluation.find_best_configuration:find_best_configuration_entry_point',  # api available
               'nnUNetv2_determine_postprocessing = nnunetv2.postprocessing.remove_connected_components:entry_point_determine_postprocessing_folder',  # api available